@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for Export. Synthetic Viia7 export files are generated and each stage of Export.new is timed separately.
+Runs headless, without the win32 modules, e.g. on Linux:
+
+    python Benchmark.py --out results.json
+    python Benchmark.py --wells 384 --targets 8 --repeat 10 --compare results.json
+
+Results are written as json with the versions of the libraries used, so runs from different versions of GenoTools can
+be compared with --compare.
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from statistics import median
+from time import perf_counter, strftime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TARGETS = ['Neo', 'LacZ', 'tm1b', 'Uprt', 'Cre', 'Acsl4_wt', 'Bar_ce', 'Foo_TG', 'Sry', 'Unknown1']
+# The 14 header lines of a Viia7 export: older versions of Export read Endogenous Control from line 5, Reference Sample
+# from line 13 and the table header from the 15th or 16th non-blank line, so generated files must keep these positions.
+HEADER = ['Block Type = {wells}-Well Block', 'Calibration Background is expired  = No', 'Chemistry = TAQMAN',
+          'Experiment Barcode = ', 'Endogenous Control = {endo}', 'Experiment File Name = {name}.eds',
+          'Experiment Name = {name}', 'Experiment Run End Time = 2019-08-14 10:24:03 AM BST',
+          'Experiment Type = Comparative Cт (ΔΔCт)', 'Instrument Name = 278870044', 'Instrument Type = ViiA 7',
+          'Passive Reference = ROX', 'Reference Sample = {ctrl}', 'Signal Smoothing On = true']
+
+
+def generate(path, wells=384, targets=4, sep='\t', endo='Dot1l', ctrl='het ctrl', undetermined=0.1, omitted=0.03,
+             seed=1):
+    """
+    Writes a synthetic Viia7 export file. Each target has the same samples: mice, a blastocyst, the reference sample
+    (a het control by default), a WT control and an NTC. Every well has a target row and an endogenous control row.
+    :param path: file path to write
+    :param wells: 96 or 384
+    :param targets: number of targets, the plate is split evenly between them
+    :param sep: delimiter, tab or comma
+    :param endo: endogenous control target
+    :param ctrl: reference sample name, 'het' in the name makes it a het control
+    :param undetermined: fraction of Cт values that are Undetermined
+    :param omitted: fraction of wells that are omitted
+    :param seed: random seed, the same arguments always give the same file
+    """
+    rnd = random.Random(seed)
+    name = os.path.splitext(os.path.basename(path))[0]
+    targets = [TARGETS[i % len(TARGETS)] + ('' if i < len(TARGETS) else str(i)) for i in range(targets)]
+    per_target = wells // len(targets)
+    samples = ['PMGB{}.{}{}'.format(rnd.randint(1, 99), rnd.randint(1, 9), rnd.choice('abcdefgh'))
+               for _ in range(per_target - 4)] + ['M0298{:04d}'.format(rnd.randint(0, 9999)), ctrl, 'WT', 'NTC']
+    columns = ['Well ', 'Well Position', 'Omitted ', 'Sample', 'Target', 'Task', 'Reporter', 'Quencher', 'RQ   ',
+               'RQ Min', 'RQ Max', 'Cт', 'Cт Mean', 'Cт SD', 'ΔCт', 'ΔCт Mean', 'ΔCт SD', 'ΔΔCт']
+    lines = ['* ' + line.format(wells=wells, endo=endo, name=name, ctrl=ctrl) for line in HEADER] + ['', '[Results]']
+    lines.append(sep.join(columns))
+    well = 0
+    for target in targets:
+        for sample in samples:
+            well += 1
+            position = 'ABCDEFGHIJKLMNOP'[(well - 1) // 24 % 16] + str((well - 1) % 24 + 1)
+            well_omitted = 'true' if rnd.random() < omitted else 'false'
+            for row_target in (target, endo):
+                if sample == 'NTC' or rnd.random() < undetermined:
+                    ct, rq, dct, ddct = 'Undetermined', '', '', ''
+                else:
+                    ct = '{:.3f}'.format(rnd.uniform(20, 35))
+                    rq = '{:.3f}'.format(rnd.uniform(0, 1.2)) if row_target != endo else ''
+                    dct, ddct = '{:.3f}'.format(rnd.uniform(-3, 3)), '{:.3f}'.format(rnd.uniform(-3, 3))
+                task = 'NTC' if sample == 'NTC' else 'UNKNOWN'
+                lines.append(sep.join([str(well), position, well_omitted, sample, row_target, task, 'FAM', 'NFQ-MGB',
+                                       rq, '', '', ct, ct, '', dct, '', '', ddct]))
+    with open(path, 'w', encoding='utf-8', newline='\r\n') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def export_instance(work_dir):
+    """
+    Returns a headless Export using the Assays and Formulas files next to this script, via a config.ini in work_dir.
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(HERE, 'config.ini'))
+    config['File paths']['assays'] = os.path.join(HERE, 'Assays.txt')
+    config['File paths']['formulas'] = os.path.join(HERE, 'Formulas.xlsx')
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as f:
+        config.write(f)
+    os.chdir(work_dir)  # Export reads config.ini from the working directory first.
+    sys.path.insert(0, HERE)
+    import Export
+    export = Export.Export()
+    export.headless = True
+    return export
+
+
+def time_stages(export, path, repeat=5):
+    """
+    Times each stage of Export.new on path.
+    :return: dict: stage: list of seconds, one per repeat
+    """
+    times = {stage: [] for stage in export.stages + ['to_xlsx']}
+    for _ in range(repeat):
+        xlsx = os.path.splitext(path)[0] + '.xlsx'
+        if os.path.isfile(xlsx):
+            os.remove(xlsx)
+        export.inp = path
+        with redirect_stdout(StringIO()):
+            for stage in export.stages + ['to_xlsx']:
+                start = perf_counter()
+                getattr(export, stage)()
+                times[stage].append(perf_counter() - start)
+    return times
+
+
+def run(cases, repeat=5, label=None, keep=None):
+    """
+    Generates a file for each case and times it.
+    :param cases: list of dicts of generate() arguments
+    :param repeat: times each file is exported
+    :param label: str recorded in the results, e.g. the version
+    :param keep: directory to keep the generated files in, default a temporary directory
+    :return: dict of results
+    """
+    import numpy
+    import openpyxl
+    import pandas
+    work_dir = keep or tempfile.mkdtemp(prefix='genotools_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        export = export_instance(work_dir)
+        results = {'label': label, 'date': strftime('%Y-%m-%d %H:%M:%S'), 'repeat': repeat,
+                   'python': platform.python_version(), 'platform': platform.platform(),
+                   'pandas': pandas.__version__, 'numpy': numpy.__version__, 'openpyxl': openpyxl.__version__,
+                   'cases': []}
+        for case in cases:
+            name = '{}w_{}t_{}'.format(case['wells'], case['targets'], 'comma' if case['sep'] == ',' else 'tab')
+            path = os.path.join(work_dir, 'SL000' + name + '_data.txt')
+            generate(path, **case)
+            times = time_stages(export, path, repeat)
+            stages = {stage: {'median': median(t), 'min': min(t), 'max': max(t)} for stage, t in times.items()}
+            results['cases'].append({'name': name, 'args': case, 'rows': int(export.samples.shape[0]),
+                                     'stages': stages, 'total': sum(s['median'] for s in stages.values())})
+            print_case(results['cases'][-1])
+        return results
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_case(case, old=None):
+    """Prints the median time of each stage in ms, and the change from old if given."""
+    print('{}  ({} rows)'.format(case['name'], case['rows']))
+    for stage, t in list(case['stages'].items()) + [('total', {'median': case['total']})]:
+        line = '  ' + stage.ljust(16) + '{:9.1f} ms'.format(t['median'] * 1000)
+        if old:
+            before = old['total'] if stage == 'total' else old['stages'].get(stage, {}).get('median')
+            if before:
+                line += '   {:+6.0f}%'.format((t['median'] / before - 1) * 100)
+        print(line)
+
+
+def compare(results, old_results):
+    """Prints each case against the case with the same name in old_results."""
+    old = {case['name']: case for case in old_results['cases']}
+    print('\nCompared with ' + str(old_results.get('label') or old_results.get('date')))
+    for case in results['cases']:
+        print_case(case, old.get(case['name']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times each stage of Export on synthetic Viia7 export files.')
+    parser.add_argument('--wells', type=int, nargs='+', default=[96, 384], choices=[96, 384])
+    parser.add_argument('--targets', type=int, nargs='+', default=[4])
+    parser.add_argument('--sep', nargs='+', default=['tab', 'comma'], choices=['tab', 'comma'])
+    parser.add_argument('--repeat', type=int, default=5, help='times each file is exported, the median is reported')
+    parser.add_argument('--out', default='benchmark.json', help='json file to write the results to')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    parser.add_argument('--label', help='recorded in the results, default the version in config.ini')
+    parser.add_argument('--keep', help='directory to keep the generated files in')
+    args = parser.parse_args()
+
+    if args.label is None:
+        version = configparser.ConfigParser()
+        version.read(os.path.join(HERE, 'config.ini'))
+        args.label = version.get('Update', 'Version', fallback=None)
+    out = os.path.abspath(args.out)
+    old_file = os.path.abspath(args.compare) if args.compare else None
+    bench_cases = [{'wells': wells, 'targets': targets, 'sep': '\t' if sep == 'tab' else ','}
+                   for wells in args.wells for targets in args.targets for sep in args.sep]
+    bench = run(bench_cases, repeat=args.repeat, label=args.label, keep=args.keep and os.path.abspath(args.keep))
+    with open(out, 'w') as f:
+        json.dump(bench, f, indent=1)
+    print('Results written to ' + out)
+    if old_file:
+        with open(old_file) as f:
+            compare(bench, json.load(f))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Clipboard providers for Monitor.ClipboardWatcher. A provider tells the watcher when the clipboard changes, gets images
+from it and puts images on it.
+    WindowsClipboard - Windows tells a hidden window when the clipboard changes (AddClipboardFormatListener), so the
+                       watcher sleeps until something is copied.
+    MemoryClipboard  - an in-memory clipboard, for running the watcher without Windows, e.g. testing on Linux.
+"""
+import ctypes
+import os
+from collections import deque
+from queue import Queue
+from threading import Lock, Thread
+from time import sleep
+
+WM_CLIPBOARDUPDATE = 0x031D
+
+
+class ClipboardProvider(object):
+    """
+    Base class. Subclasses call changed() when the clipboard changes and implement grab_image() and set_images().
+    """
+    def __init__(self):
+        self._changes = Queue()
+
+    def start(self):
+        """Starts listening for changes."""
+        pass
+
+    def stop(self):
+        """Stops listening, wait() returns False."""
+        self._changes.put(False)
+
+    def changed(self):
+        self._changes.put(True)
+
+    def wait(self):
+        """
+        Blocks until the clipboard changes. Changes that arrived while the last one was handled are counted as one.
+        :return: True on a change, False once stopped.
+        """
+        change = self._changes.get()
+        while change and not self._changes.empty():
+            change = self._changes.get()
+        return change
+
+    def grab_image(self):
+        """Returns the image on the clipboard as a PIL Image, or None if there isn't one."""
+        raise NotImplementedError
+
+    def set_images(self, *images):
+        """
+        Puts images on the clipboard one after another, so all of them are in the Office Clipboard history.
+        Doesn't count as a change, so the watcher doesn't try to crop its own output.
+        :param images: bytes, device independent bitmaps, see Gel.to_dib()
+        """
+        raise NotImplementedError
+
+
+class WindowsClipboard(ClipboardProvider):
+    """
+    Listens for WM_CLIPBOARDUPDATE messages on a message-only window, run by its own thread.
+    """
+    def __init__(self):
+        super(WindowsClipboard, self).__init__()
+        self._hwnd = None
+        self._own = deque(maxlen=20)  # Clipboard sequence numbers of set_images(), not reported as changes.
+        self._writing = Lock()  # Held while set_images() writes, until its sequence number is in _own.
+
+    def start(self):
+        Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        """Creates the window and runs its message loop until stop()."""
+        import win32api
+        import win32con
+        import win32gui
+        from ctypes import wintypes
+        window = win32gui.WNDCLASS()
+        window.lpfnWndProc = self.window_proc
+        window.lpszClassName = 'GenoToolsClipboard'
+        window.hInstance = win32api.GetModuleHandle(None)
+        win32gui.RegisterClass(window)
+        self._hwnd = win32gui.CreateWindow(window.lpszClassName, window.lpszClassName, 0, 0, 0, 0, 0,
+                                           win32con.HWND_MESSAGE, 0, window.hInstance, None)
+        ctypes.windll.user32.AddClipboardFormatListener.argtypes = [wintypes.HWND]
+        ctypes.windll.user32.RemoveClipboardFormatListener.argtypes = [wintypes.HWND]
+        ctypes.windll.user32.AddClipboardFormatListener(self._hwnd)
+        win32gui.PumpMessages()
+
+    def window_proc(self, hwnd, msg, wparam, lparam):
+        import win32clipboard
+        import win32con
+        import win32gui
+        if msg == WM_CLIPBOARDUPDATE:
+            with self._writing:  # Waits for a write in progress, so its update isn't taken for the user's.
+                if win32clipboard.GetClipboardSequenceNumber() not in self._own:
+                    self.changed()
+            return 0
+        if msg == win32con.WM_DESTROY:
+            ctypes.windll.user32.RemoveClipboardFormatListener(hwnd)
+            win32gui.PostQuitMessage(0)
+            return 0
+        return win32gui.DefWindowProc(hwnd, msg, wparam, lparam)
+
+    def stop(self):
+        if self._hwnd is not None:
+            import win32con
+            import win32gui
+            win32gui.PostMessage(self._hwnd, win32con.WM_CLOSE, 0, 0)  # Destroys the window, ending listen().
+        super(WindowsClipboard, self).stop()
+
+    def grab_image(self):
+        from PIL import ImageGrab
+        return ImageGrab.grabclipboard()
+
+    def set_images(self, *images):
+        import win32clipboard
+        for item in images:
+            with self._writing:
+                win32clipboard.OpenClipboard()
+                try:
+                    win32clipboard.EmptyClipboard()
+                    win32clipboard.SetClipboardData(win32clipboard.CF_DIB, item)
+                finally:
+                    win32clipboard.CloseClipboard()
+                self._own.append(win32clipboard.GetClipboardSequenceNumber())
+            sleep(0.05)  # small wait for Office Clipboard.
+
+
+class MemoryClipboard(ClipboardProvider):
+    """
+    An in-memory clipboard. copy() is the user copying an image. Images set by the watcher are kept in history.
+    """
+    def __init__(self):
+        super(MemoryClipboard, self).__init__()
+        self.image = None
+        self.history = []  # List: bytes given to set_images(), oldest first
+
+    def copy(self, image):
+        """Puts a PIL Image on the clipboard as if copied by the user."""
+        self.image = image
+        self.changed()
+
+    def grab_image(self):
+        return self.image
+
+    def set_images(self, *images):
+        self.image = None  # Replaced by the set images, which are bytes not PIL Images.
+        self.history.extend(images)
+
+
+def provider():
+    """Returns the clipboard provider for this platform, or None if there isn't one, e.g. on Linux."""
+    if os.name != 'nt':
+        return None
+    try:
+        import win32clipboard  # noqa: F401
+        import win32gui  # noqa: F401
+    except ImportError:
+        return None
+    return WindowsClipboard()
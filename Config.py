@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+config.ini, shared by Monitor and Export. The file is only re-parsed when its modified time changes, so checking it
+often is one stat of the file rather than a read. Subscribers are told which keys changed, so e.g. new paths apply
+without restarting.
+"""
+import configparser
+import os
+from sys import argv
+from threading import Lock
+
+_shared = {}  # Dict: absolute path: ConfigFile, see shared()
+_shared_lock = Lock()
+
+
+def default_path():
+    """config.ini in the working directory, or else next to the program."""
+    if os.path.isfile(os.getcwd() + '/config.ini'):
+        return os.getcwd() + '/config.ini'
+    return os.path.normpath(os.path.dirname(argv[0]) + '/config.ini')
+
+
+def cache_dir():
+    """Local folder for GenoTools caches and logs, created if needed. %LOCALAPPDATA%\\GenoTools on Windows."""
+    path = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~/.cache'), 'GenoTools')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def shared(path=None):
+    """
+    Returns the ConfigFile for path, the same one each time it is asked for in this process.
+    :param path: config.ini path, default see default_path()
+    """
+    path = os.path.abspath(path or default_path())
+    with _shared_lock:
+        if path not in _shared:
+            _shared[path] = ConfigFile(path)
+        return _shared[path]
+
+
+class ConfigFile(object):
+    """
+    A config.ini, read like a ConfigParser e.g. config['File paths']['assays'] or config.getint('Jobs', 'Workers').
+    reload() re-parses the file if it has changed and calls the subscribers with the keys that changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self._parser = configparser.ConfigParser()
+        self._subscribers = []  # List: (callback, sections or None for all)
+        self._lock = Lock()
+        self.reload()
+
+    def reload(self):
+        """
+        Re-parses the file if its modified time or size has changed. If the file can't be found or read, the last
+        values are kept.
+        :return: set of (section, key) that changed, keys are lower case.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return set()
+        if (stat.st_mtime, stat.st_size) == self.mtime:
+            return set()
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(self.path)  # config.ini = ANSI
+        except configparser.Error:
+            return set()  # Kept, and read again next time in case it was being saved.
+        if not parser.sections():
+            return set()  # Empty while being saved.
+        with self._lock:
+            old, self._parser, self.mtime = self._parser, parser, (stat.st_mtime, stat.st_size)
+            subscribers = list(self._subscribers)
+        changed = self.diff(old, parser)
+        for callback, sections in subscribers:
+            keys = {key for key in changed if sections is None or key[0] in sections}
+            if keys:
+                callback(keys)
+        return changed
+
+    @staticmethod
+    def diff(old, new):
+        """Returns the set of (section, key) that are different, added or removed between two ConfigParsers."""
+        changed = set()
+        for section in set(old.sections()) | set(new.sections()):
+            old_items = dict(old.items(section, raw=True)) if old.has_section(section) else {}
+            new_items = dict(new.items(section, raw=True)) if new.has_section(section) else {}
+            changed.update((section, key) for key in set(old_items) | set(new_items)
+                           if old_items.get(key) != new_items.get(key))
+        return changed
+
+    def subscribe(self, callback, sections=None):
+        """
+        Calls callback with the set of changed (section, key) after a reload() that changed any of them.
+        Called from the thread that runs reload(), e.g. Monitor.Watcher.
+        :param callback: function taking a set of (section, key)
+        :param sections: list of section names to be told about, default all
+        """
+        with self._lock:
+            self._subscribers.append((callback, sections))
+
+    def __getitem__(self, section):
+        return self._parser[section]
+
+    def __contains__(self, section):
+        return section in self._parser
+
+    def __getattr__(self, name):  # get, getint, getfloat, getboolean, sections ...
+        return getattr(self._parser, name)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Watchdog emitters used by Monitor.Watcher. The backend is chosen in config.ini [Watcher]:
+    windows - ReadDirectoryChangesW, the default on Windows.
+    inotify - Linux inotify, the default on Linux.
+    polling - compares directory listings, for network mounts where inotify misses changes made by other computers.
+
+Instruments write .eds files in many small chunks, each giving a modified event. Modified events for a file are held
+until the file has stopped changing, then one "settled" event is sent to the handler.
+"""
+import importlib
+import os
+from collections import deque
+from threading import Lock, Thread
+from time import sleep, monotonic
+
+from watchdog.events import EVENT_TYPE_MODIFIED
+
+BACKENDS = {    # backend name: (module, emitter class)
+    'windows': ('watchdog.observers.read_directory_changes', 'WindowsApiEmitter'),
+    'inotify': ('watchdog.observers.inotify', 'InotifyEmitter'),
+    'polling': ('watchdog.observers.polling', 'PollingEmitter'),
+}
+
+
+def emitter_class(backend='auto', settle=2.0):
+    """
+    Returns the emitter class for a backend, with MyEmitter's reconnecting and coalescing.
+    :param backend: str 'auto', 'windows', 'inotify' or 'polling'. auto picks windows or inotify by platform.
+    :param settle: seconds a file must go without being modified before its modified event is sent. 0 = send all.
+    """
+    backend = backend.strip().lower()
+    if backend == 'auto':
+        backend = 'windows' if os.name == 'nt' else 'inotify'
+    if backend not in BACKENDS:
+        raise ValueError('Unknown watcher backend "' + backend + '" in config.ini, use one of: auto, '
+                         + ', '.join(BACKENDS))
+    module, name = BACKENDS[backend]
+    base = getattr(importlib.import_module(module), name)
+    return type('My' + name, (MyEmitter, base), {'settle': settle})
+
+
+class MyEmitter(object):
+    """
+    Mixed in to a watchdog emitter by emitter_class().
+    This class is used to catch an un-catchable exception in watchdog
+    that would occur when the connection to the network drive was
+    temporarily lost
+    This can still sometimes cause a crash if the program is run from
+    the network drive, but this is to do with the build method of the
+    exe. A single exe build may fix but antivirus prevents it.
+    Currently recommend installing to a local drive C:// - not U://
+    It also coalesces bursts of modified events, see queue_event().
+    """
+    message = deque(maxlen=2)  # This is used by thread_print to prevent duplicate messages from threads.
+    settle = 2.0               # Float: seconds without a modified event before a file counts as settled
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = {}              # Dict: path: (last modified event, monotonic time of it)
+        self._pending_lock = Lock()
+        self._releaser = None           # Thread: runs release_loop()
+
+    def on_thread_start(self):
+        super().on_thread_start()
+        if self.settle and self._releaser is None:  # on_thread_start is called again when reconnecting
+            self._releaser = Thread(target=self.release_loop, daemon=True)
+            self._releaser.start()
+
+    def queue_event(self, event):
+        """Holds modified events for files until the file has settled. Other events are sent straight away."""
+        if self.settle and event.event_type == EVENT_TYPE_MODIFIED and not event.is_directory:
+            with self._pending_lock:
+                self._pending[event.src_path] = (event, monotonic())
+        else:
+            super().queue_event(event)
+
+    def release_settled(self, force=False):
+        """
+        Sends one modified event for each file that hasn't been modified for settle seconds.
+        :param force: send all held events, settled or not.
+        """
+        now = monotonic()
+        with self._pending_lock:
+            settled = [path for path, (event, seen) in self._pending.items() if force or now - seen >= self.settle]
+            settled = [self._pending.pop(path)[0] for path in settled]
+        for event in settled:
+            super().queue_event(event)
+
+    def release_loop(self):
+        while not self.stopped_event.wait(self.settle / 4):
+            self.release_settled()
+
+    def queue_events(self, timeout):  # Subclass queue events - this is where the exception occurs
+        try:
+            super().queue_events(timeout)
+        except OSError as e:    # Catch the exception and print error
+            self.thread_print(str(e))
+            self.thread_print('Lost connection to team drive!')
+            connected = False
+            while not connected:  # resume when connection to network drive is restored
+                try:
+                    self.on_thread_start()  # need to re-set the directory handle.
+                    connected = True
+                    self.thread_print('Reconnected!')
+                except OSError:
+                    sleep(10)
+                    self.thread_print('Reconnecting...')
+
+    def thread_print(self, msg):
+        """
+        Prevents duplicate print statements from threads. If it has been sent recently, it is not re sent.
+        message is a deque with length 2.
+        """
+        if msg not in self.message:
+            print(msg)
+            self.message.append(msg)
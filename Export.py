@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
-import configparser
+import argparse
+import copy
+import csv
+import fnmatch
+import getpass
+import hashlib
+import json
 import os
-from sys import argv
 import re
+import sqlite3
+from io import BytesIO, StringIO
+from collections import namedtuple
+from time import perf_counter
+from multiprocessing import Pool
+from threading import RLock, Thread, Timer
 
 import PIL
 import numpy as np
@@ -10,11 +21,27 @@ import pandas as pd
 from openpyxl import load_workbook
 from openpyxl.styles import Alignment, PatternFill
 from openpyxl.formatting.rule import FormulaRule
+from openpyxl.utils import get_column_letter
+from colorama import init as colorama_init
 
-from Monitor import Message
+import Config
+import Formulas
+import Manifest
+from Message import Message
+import Results
+import Stats
+import Xlsx
+
+# Header information from a Viia7 export file. endo and ctrl_name are the Endogenous Control and Reference Sample,
+# sep is the delimiter of the Results table, fields is a dict of every 'key = value' line in the header.
+ExportInfo = namedtuple('ExportInfo', ['endo', 'ctrl_name', 'sep', 'fields', 'digest'])
 
 
 class Export(object):
+    # The stages of prepare(), in order. Each is a method without arguments, so they can be timed separately.
+    stages = ['read_file', 'read_endo_ctrl', 'endo_cleanup', 'separate_ctrls', 'annotate', 'add_formulas', 'finish']
+    # Columns filled in by users after export. They are kept when a plate is exported again, see update_sheet().
+    user_columns = ['Allele', 'Locked', 'Comment', 'Name', 'Compare', 'Gender']
 
     def __init__(self):
         """Initialise the exporter. Loading files here means they only need to be loaded once."""
@@ -22,75 +49,151 @@ class Export(object):
                            'Genotype', 'Allele', 'Locked', 'Plate Barcode', 'Assay Type', 'Assay Name', 'Result',
                            'Confirmed', 'Comment', 'Name', 'Compare', 'Gender', 'Het Control?', 'X-Linked?',
                            'Omitted_endo']
-        self.config = configparser.ConfigParser()
-
-        if os.path.isfile(os.getcwd() + '/config.ini'):  # may have changed.
-            self.config.read(os.getcwd() + '/config.ini')
-        else:
-            self.config.read(os.path.normpath(os.path.dirname(argv[0]) + '/config.ini'))
+        self.config = Config.shared()  # The same config as Monitor, re-read by Monitor when it changes.
+        self.config.subscribe(self.paths_changed, sections=['File paths'])
 
-        self.assay_df = self.read_assay_file()  # Reads Assay info from file
-        self.genf, self.assayf, self.confirmf = self.read_formulas()
+        self.assays = self.read_assay_file()  # Reads Assay info from file
+        self.genf = self.assayf = self.confirmf = None  # Str: formula templates, set by read_formulas()
+        self._evaluator = None          # Formulas.Evaluator: of the templates, see evaluator()
+        self.read_formulas()
+        self.template = self.make_template()  # Xlsx.SheetTemplate: the formatting of every sheet
 
         self.inp = self.samples = self.ctrls = self.ctrl_targets = self.ctrl_name = self.endo = None
 
         self.xlsx_file = None           # Str: path
         self._last_file = None          # Str: path
-        self._multi_export = False      # Bool
+        self.output = None              # Str: path of the workbook the last plate was exported to
+        self.pending = False            # Bool: if the last plate's sheet is waiting in the Multi session to be written
+        self._session = None            # MultiSession: while Multi export is on
+        self.headless = False           # Bool: if True, finished files are not opened. see batch()
+        self._lock = RLock()            # Held while writing, and while changing Multi export state
+        self.timings = None             # Stats.Stages: of the last prepare()
+        self.cached = None              # Dict: cell: result of its formula, saved with the formulas. see evaluate()
+        self.genotypes = None           # Dict: column: array of the calculated formula results, see evaluate()
+        self.formula_rows = 0           # Int: number of rows with formulas, the samples before the controls
 
     def new(self, inp: str):
         """
-        This is called by Monitor.Labhandler.On_Created(), and takes the input from csv through to completed file.
+        This is called by Monitor's export jobs, and takes the input from csv through to completed file.
+        Files are prepared on a copy of this Export, so several can be prepared at once from different threads. Writing
+        is done one at a time, since it uses the Multi export state.
+        :param inp: file path of exported csv.
+        :raises ValueError: if inp isn't an export file
+        :raises OSError: if the file or workbook can't be read or written, e.g. the workbook is open
+        """
+        job = copy.copy(self)  # Shares the loaded assays and formulas.
+        try:
+            job.prepare(inp)
+        except (ValueError, OSError) as e:
+            self.record(inp, 'failed', error=e)
+            raise
+        try:
+            with self._lock:
+                self.inp, self.samples, self.cached, self.genotypes = job.inp, job.samples, job.cached, job.genotypes
+                start = perf_counter()
+                self.to_xlsx()
+                output, pending, job.genotypes = self.output, self.pending, self.genotypes  # Changed by an update
+            job.timings.add('to_xlsx', perf_counter() - start, len(job.samples))
+            start = perf_counter()
+            job.save_results()
+            job.timings.add('store', perf_counter() - start, len(job.samples))
+            job.timings.write()
+            if not pending:  # Sheets in a Multi session are recorded by MultiSession, once they are written.
+                self.record(inp, 'exported', output=output, seconds=perf_counter() - job.timings.start)
+        except PermissionError as e:  # Re-raised so the job shows as failed. Not retried, the user has to close it.
+            print(Message("You already have an export of this file open. Close it and re-try.").red())
+            self.record(inp, 'failed', error=e)
+            raise
+        except ValueError as e:  # if file is missing cols or is not an export - raised in read_file()
+            self.record(inp, 'failed', error=e)
+            raise
+
+    def export_file(self, inp: str):
+        """
+        Exports a plate to a new workbook of its own, replacing any earlier export of it, on a copy of this Export.
+        Multi, ToFile and Last don't apply and the workbook isn't opened. Several can run at once from different
+        threads, e.g. Monitor's backfill.
+        :param inp: file path of exported csv.
+        :return: tuple (file path, error message or None, seconds taken)
+        """
+        job = copy.copy(self)  # Shares the loaded assays and formulas.
+        start = perf_counter()
+        try:
+            job.prepare(inp)
+            job.output = os.path.splitext(inp)[0] + '.xlsx'
+            job.write_sheet(job.output, job.get_sheet_name())
+            job.save_results()
+        except (ValueError, OSError) as e:  # ValueError: not an export file. OSError: file open or drive unavailable.
+            job.record(inp, 'failed', error=e, seconds=perf_counter() - start)
+            return inp, ' '.join(str(e).split('\n')[:2]), perf_counter() - start
+        job.record(inp, 'exported', output=job.output, seconds=perf_counter() - start)
+        return inp, None, perf_counter() - start
+
+    def prepare(self, inp: str):
+        """
+        Reads the export file and builds the finished samples dataframe, ready for to_xlsx(). Each stage is timed in
+        self.timings.
         :param inp: file path of exported csv.
         """
         self.inp = inp
-        self.samples = self.read_file()
-        self.read_endo_ctrl()
-        self.endo_cleanup()
-        self.separate_ctrls()
-        self.samples['Assay Type'] = self.samples.apply(lambda line: pd.Series([self.assay_type(line)]), axis=1)
-        self.samples = self.samples.sort_values(by=['Assay Type', 'Target', 'Sample'])  # Sort rows
-        self.add_formulas()
+        self.timings = Stats.Stages('Export', inp)
+        for stage in self.stages:
+            start = perf_counter()
+            getattr(self, stage)()
+            self.timings.add(stage, perf_counter() - start, len(self.samples))
+
+    def save_results(self):
+        """Adds the prepared plate to the results store, see Results. Failing to save never stops an export."""
+        try:
+            Results.store.add(self.info, self.store_samples(), self.inp)
+        except (sqlite3.Error, OSError) as e:
+            print(Message("Couldn't add the results to the results store. " + str(e)).yellow())
+
+    def store_samples(self):
+        """
+        Returns samples for the results store: Genotype, Result and Confirmed are their results if they were calculated
+        (Output = values or cached, see evaluate()), or else None rather than formulas.
+        """
+        calculated = {}
+        for column in ('Genotype', 'Result', 'Confirmed'):
+            values = [None] * self.samples.shape[0]
+            if self.genotypes is not None:
+                values[:self.formula_rows] = list(self.genotypes[column])
+            calculated[column] = values
+        return self.samples.assign(**calculated)
+
+    @staticmethod
+    def record(inp, status, output=None, error=None, seconds=None):
+        """Adds the export file to the manifest of processed files, see Manifest. Failing to save never stops it."""
+        try:
+            Manifest.manifest.record(inp, 'export', status, output=output, error=error, seconds=seconds)
+        except (sqlite3.Error, OSError) as e:
+            print(Message("Couldn't add the file to the manifest. " + str(e)).yellow())
+
+    def finish(self):
+        """Adds the controls back to the end of samples and sets the column order."""
         # Insert ctrls to end of file, sort + remove unneeded columns
         self.samples = pd.concat([self.samples, self.ctrls], sort=True)[self.cols_order]
         # CT floats are str because of a mixture of strings and floats, this causes 'number formatted as text' flags in
         # excel. Here we convert back into floats where possible.
         self.samples['Cт'] = pd.to_numeric(self.samples['Cт'], errors='coerce')
         self.samples['Cт'] = self.samples['Cт'].fillna("Undetermined")
-        try:
-            self.to_xlsx()
-        except PermissionError as e:
-            print(e)
-            print(Message("You already have an export of this file open. Close it and re-try.").red())
-        except ValueError as e:  # if file is missing cols or is not an export - raised in read_file()
-            print(e)
 
     def read_file(self):
-        """Reads the file given as input and returns a dataframe. Only accepts columns in the first 9 of cols_order."""
-        params = [(14, "\t"), (15, "\t"), (14, ","), (15, ",")]  # list of parameters to try
-        for header, sep in params:
-            try:
-                return pd.read_csv(self.inp, header=header, sep=sep, usecols=self.cols_order[:9])
-            except ValueError:
-                continue
-        else:
-            raise ValueError(
-                "That file doesnt look right.\nIt is either missing a column we need, or it is not an export" +
-                " file.\nCheck that you ticked 'Results' when exporting.\nColumns needed: " +
-                ", ".join(self.cols_order[:9]) + ".")
+        """
+        Reads the file given as input into samples. Only accepts columns in the first 9 of cols_order.
+        The header information is kept in self.info, see read_export().
+        """
+        self.info, self.samples = read_export(self.inp, self.cols_order[:9])
+        Manifest.manifest.hashed(self.inp, self.info.digest)  # So recording the export doesn't read the file again.
 
     def read_endo_ctrl(self):
         """
-        Reads CSV to get control name, and endogenous control name, then uses control name to get a list of targets
-        that the control applies to.
+        Gets control name, and endogenous control name from the file header, then uses control name to get a list of
+        targets that the control applies to.
         """
-        with open(self.inp, "r") as file:
-            for i in range(4):
-                next(file)
-            self.endo = file.readline().split(sep='=')[1].strip().lower()
-            for i in range(7):
-                next(file)
-            self.ctrl_name = file.readline().split(sep='=')[1].strip().lower()
+        self.endo = self.info.endo.lower()
+        self.ctrl_name = self.info.ctrl_name.lower()
         self.ctrl_targets = set(self.samples[self.samples.Sample.str.lower() == self.ctrl_name]['Target'].tolist())
 
     def endo_cleanup(self):
@@ -103,16 +206,40 @@ class Export(object):
         self.samples = pd.merge(self.samples, endos, on='Well ', how='inner')  # Merge endos with samples
 
     def read_formulas(self):
-        """Loads excel formulas used from a file, calls get_formula_sub to format them and sets the finished formulas"""
+        """
+        Sets the formula templates, from the local cache if there is one, see FormulaCache. The Formulas file is then
+        checked in the background, so starting up doesn't wait on the network share.
+        """
+        cache = FormulaCache(self.config['File paths']['Formulas'], os.path.join(Config.cache_dir(), 'formulas.json'),
+                             on_update=self.set_formulas)
+        if cache.formulas:
+            self.set_formulas(cache.formulas)
+            cache.start()
+            return
         try:
-            wb = load_workbook(self.config['File paths']['Formulas'])
-        except FileNotFoundError:
-            wb = input("Can't find the Formulas file! If it has moved, please update config.ini with its new location."
-                       "\nPress Enter to quit")
+            cache.revalidate()
+        except OSError:
+            input("Can't find the Formulas file! If it has moved, please update config.ini with its new location."
+                  "\nPress Enter to quit")
             quit()
-        return self.get_formula_sub(wb['Sheet1'].cell(row=2, column=11).value),\
-            self.get_formula_sub(wb['Sheet1'].cell(row=2, column=17).value),\
-            self.get_formula_sub(wb['Sheet1'].cell(row=2, column=18).value)
+        self.set_formulas(cache.formulas)
+
+    def paths_changed(self, changed):
+        """Called by config when File paths change. Loads the Assays or Formulas file from its new location."""
+        if ('File paths', 'assays') in changed:
+            try:
+                self.assays = AssayIndex(self.config['File paths']['assays'])
+                print(Message(' Assays file moved').timestamp(machine='Export'))
+            except (OSError, KeyError, ValueError) as e:
+                print(Message("Can't read the new Assays file, using the old one. " + str(e)).yellow())
+        if ('File paths', 'formulas') in changed:
+            FormulaCache(self.config['File paths']['Formulas'], os.path.join(Config.cache_dir(), 'formulas.json'),
+                         on_update=self.set_formulas).start()
+
+    def set_formulas(self, formulas):
+        """Sets the genotype, result and confirmed formula templates, called by FormulaCache when the file changes."""
+        self.genf, self.assayf, self.confirmf = formulas
+        self._evaluator = None
 
     @staticmethod
     def get_formula_sub(formula):
@@ -120,7 +247,7 @@ class Export(object):
         from openpyxl.formula import Tokenizer
         formula_sub = "="
         for t in Tokenizer(formula).items:  # Tokenizer is part of openpyxl
-            if t.subtype is 'RANGE':  # if token is a cell reference
+            if t.subtype == 'RANGE':  # if token is a cell reference
                 t.value = t.value[0] + "{0}"  # replace row number with {0} e.g F3 -> F{0}
                 formula_sub += t.value  # add it to formula_sub
             else:
@@ -128,11 +255,9 @@ class Export(object):
         return formula_sub
 
     def read_assay_file(self):
-        """Reads the assay file and returns a dataframe. The assay file path is specified in config.ini"""
+        """Reads the assay file and returns an AssayIndex. The assay file path is specified in config.ini"""
         try:
-            assays = pd.read_csv(self.config['File paths']['assays'], sep='\t')  # reads file.
-            assays['Variant'] = assays['Variant'].str.lower()  # sets variant col to lower-case
-            return assays.set_index('Variant', drop=False)  # set variant col as index, keeping variant as a column
+            return AssayIndex(self.config['File paths']['assays'])
         except FileNotFoundError:
             input("Can't find the Assays file! If it has moved, please update config.ini with its new location."
                   "\nPress Enter to quit.")
@@ -146,15 +271,28 @@ class Export(object):
         self.samples = self.samples.loc[self.samples['Sample'].str.lower().str.contains(regex)]  # Remove ctrls from df
         self.ctrls = self.ctrls.sort_values(by=['Target', 'Sample'])
 
-    def assay_type(self, line):
-        """Determines if the assay type is LoA or qPCR. List of assays is read in from a file."""
-        target = line['Target'].lower()
-        if target in self.assay_df['Variant']:      # If the target is in list of assays, set assay type accordingly.
-            return self.assay_df.loc[target, 'Type']
-        elif "_wt" in target or "_ce" in target:
-            return "LoA"
-        else:
-            return "Unknown"
+    def annotate(self):
+        """
+        Adds Assay Type, Assay Name, Het Control?, X-Linked? and RQ to samples using whole-column operations, then
+        sorts the rows. Assay Type and Assay Name are looked up in the assay file, see AssayIndex.
+        """
+        target = self.samples['Target']
+        self.samples['Assay Type'], self.samples['Assay Name'] = self.assays.resolve(target)
+
+        # If the control in export is a het and applies to that target, the excel formula adjusts the analysis.
+        ctrl_target = target.isin(self.ctrl_targets)
+        het = ctrl_target & ("het" in self.ctrl_name)
+        self.samples['Het Control?'] = np.where(het, "Yes", None)
+        # If the assay is a transgene assay, the excel formula adjusts the analysis accordingly.
+        transgene = self.samples['Assay Name'].str.upper().str.contains('_TG', regex=False)
+        self.samples['X-Linked?'] = np.where(transgene, "Transgene", None)
+
+        # If Cт is Undetermined, RQ should be 0 rather than None, but only if the control applies to that target.
+        # If the endogenous control has been omitted, RQ is always NaN.
+        undetermined = self.samples['Cт'] == "Undetermined"
+        rq = self.samples['RQ   '].where(~undetermined, np.where(ctrl_target, 0, np.nan))
+        self.samples['RQ   '] = rq.mask(self.samples['Omitted_endo'].astype(bool))
+        self.samples = self.samples.sort_values(by=['Assay Type', 'Target', 'Sample'])  # Sort rows
 
     def add_formulas(self):
         """ Adds formulas and extra columns. Row number is added by string formatting based on df['index']
@@ -162,62 +300,68 @@ class Export(object):
 
         self.samples['index'] = range(2, self.samples.shape[0] + 2)  # make index == to excel row number
         barcode = os.path.basename(self.inp).split("_")[0].upper()     # get plate barcode from input file path
-        self.samples['Assay Name'] = self.samples.apply(lambda line: pd.Series([self.assay_name(line)]), axis=1)
         columns_add = {'Mouse': self.samples['Sample'], 'Plate Barcode': barcode,
                        'Allele': np.nan, 'Locked': np.nan, 'Comment': np.nan, 'Name': np.nan,
                        'Compare': np.nan, 'Gender': np.nan,
 
-                       'Het Control?': self.samples.apply(lambda line: pd.Series([self.is_het_ctrl(line)]), axis=1),
-                       'X-Linked?': self.samples.apply(lambda line: pd.Series([self.is_transgene(line)]), axis=1),
-                       'RQ   ': self.samples.apply(lambda line: pd.Series([self.rq_add_zero(line)]), axis=1),
-
-                       'Genotype': self.samples.apply(lambda line: pd.Series([self.genf.format(line['index'])]),
-                                                      axis=1),
-                       'Result': self.samples.apply(lambda line: pd.Series([self.assayf.format(line['index'])]),
-                                                    axis=1),
-                       'Confirmed': self.samples.apply(lambda line: pd.Series([self.confirmf.format(line['index'])]),
-                                                       axis=1)
+                       'Genotype': self.fill_formula(self.genf, self.samples['index']),
+                       'Result': self.fill_formula(self.assayf, self.samples['index']),
+                       'Confirmed': self.fill_formula(self.confirmf, self.samples['index'])
                        }  # dict of columns we need to add and their values
         for col_name in columns_add:  # Add the columns in columns_add, and set its value respectively.
             self.samples[col_name] = columns_add[col_name]
-
-    def assay_name(self, line):
+        self.cached = self.genotypes = None
+        self.formula_rows = self.samples.shape[0]
+        output = self.config.get('Export', 'Output', fallback='formulas').strip().lower()
+        if output in ('values', 'cached'):
+            self.evaluate(output)
+
+    def evaluator(self):
+        """Returns the Formulas.Evaluator of the formula templates, parsed the first time it is needed."""
+        if self._evaluator is None:
+            self._evaluator = Formulas.Evaluator({'Genotype': self.genf, 'Result': self.assayf,
+                                                  'Confirmed': self.confirmf}, self.cols_order)
+        return self._evaluator
+
+    def evaluate(self, output):
         """
-        Checks Target against a list of common spelling mistakes and corrects them, for uniformity in the database.
+        Calculates the Genotype, Result and Confirmed formulas for every row, see Formulas. If a formula can't be
+        calculated in python, the formulas are written on their own for Excel to calculate.
+        :param output: str 'values' replaces the formulas with their results, 'cached' keeps the formulas and saves
+                       their results with them, see write_sheet().
         """
-        target = line['Target'].lower()
-        if line['Target'].lower() in self.assay_df['Variant']:
-            return self.assay_df.loc[target, 'Assay']
+        frame = self.samples.iloc[:self.formula_rows]  # Rows are in sheet order, from excel row 2.
+        try:
+            results = self.evaluator().evaluate(frame)
+        except Formulas.FormulaError as e:
+            print(Message("Couldn't calculate the genotypes, writing formulas for Excel. " + str(e)).yellow())
+            return
+        self.genotypes = results
+        if output == 'values':
+            for column, values in results.items():
+                if len(frame) == self.samples.shape[0]:
+                    self.samples[column] = values
+                else:
+                    self.samples.iloc[:len(frame), self.samples.columns.get_loc(column)] = values
         else:
-            return line['Target']
+            self.cached = {get_column_letter(self.cols_order.index(column) + 1) + str(row): value
+                           for column, values in results.items() for row, value in enumerate(values.tolist(), 2)}
 
-    def is_het_ctrl(self, line):
+    @staticmethod
+    def fill_formula(formula_sub, rows):
         """
-        If the control in export is a het, and applies to that target, return "Yes". The excel formula will adjust
-        the analysis accordingly.
+        Column-wise version of formula_sub.format(row), fills in the excel row number of every row at once.
+        :param formula_sub: str formula from get_formula_sub()
+        :param rows: pd.Series of excel row numbers
+        :return: pd.Series of formulas
         """
-        if "het" in self.ctrl_name and line['Target'] in self.ctrl_targets:
-            return "Yes"
-
-    @staticmethod
-    def is_transgene(line):
-        """If the assay is a transgene assay, returns Transgene. The excel formula adjusts the analysis accordingly."""
-        target = line['Assay Name'].upper()
-        if "_TG" in target:
-            return "Transgene"
-
-    def rq_add_zero(self, line):
-        """
-        If the Cт value is undetermined, the RQ value should be 0 rather than None. This should only be done if the
-        control applies to that sample/target and should not be done if the endogenous control has been omitted.
-        """
-        if line['Omitted_endo']:
-            return np.nan  # If endo is omitted, insert NaN.
-        if line['Cт'] == "Undetermined":  # If CT is Undetermined
-            # Add 0 to RQ if target also applies to the control
-            return 0 if line['Target'] in self.ctrl_targets else np.nan
-        else:
-            return line['RQ   ']  # Keep same RQ value.
+        marker = '\0'
+        parts = formula_sub.format(marker).split(marker)
+        rows = rows.astype(str)
+        formulas = pd.Series(parts[0], index=rows.index)
+        for part in parts[1:]:
+            formulas = formulas + rows + part
+        return formulas
 
     @property
     def multi(self):
@@ -225,23 +369,33 @@ class Export(object):
         Returns string indicating if Multi export mode is on of off. If multi export is OFF and there is an xlsz file,
         then multi must have been toggled off recently, and the file is launched etc.
         """
-        if not self._multi_export and self.xlsx_file:
-            os.startfile(self.xlsx_file)  # Try/except shouldn't be needed here.
+        if not self._session and self.xlsx_file:
+            if not self.headless:
+                os.startfile(self.xlsx_file)  # Try/except shouldn't be needed here.
             print(Message(' ' + os.path.split(self.xlsx_file)[1]).timestamp('Export'))
             self._last_file = self.xlsx_file
             self.xlsx_file = None
-        return Message(''.ljust(25, ' ') + 'Multi export processing ON') if self._multi_export \
+        return Message(''.ljust(25, ' ') + 'Multi export processing ON') if self._session \
             else Message(''.ljust(25, ' ') + 'Multi export processing OFF')
 
     @multi.setter
     def multi(self, value):
-        # Sets _multi_export flag with value, if value is none, toggles _multi_export. Prints multi.
-        if value is not None:
-            if not self._multi_export == value:  # Only change value (and print) if value changes
-                self._multi_export = value
-                print(self.multi)
-        else:
-            self._multi_export = not self._multi_export
+        # Starts or finishes a MultiSession, if value is none, toggles. Prints multi.
+        with self._lock:
+            if value is None:
+                value = not self._session
+            if value == bool(self._session):  # Only change value (and print) if value changes
+                return
+            if value:
+                self._session = MultiSession(self.xlsx_file, self.config.getint('Multi', 'Checkpoint', fallback=0))
+            else:
+                try:
+                    self._session.save()  # The sheets are only written to the file now.
+                except PermissionError as e:
+                    print(e)
+                    print(Message("You have the Multi export file open. Close it and type done again.").red())
+                    return
+                self._session = None
             print(self.multi)
 
     def multi_toggle(self):
@@ -250,6 +404,12 @@ class Export(object):
     def multi_off(self):
         self.multi = False
 
+    def close(self):
+        """Writes the sheets of an unfinished Multi export, without opening the file. Called on exit."""
+        with self._lock:
+            if self._session:
+                self._session.save()
+
     def last_file(self):
         self.xlsx_file = self._last_file
         print(''.ljust(25, ' ') + "Exporting to last exported file.")
@@ -283,7 +443,7 @@ class Export(object):
             pass
         # It is difficult to separate user names from gene names like cd4 etc, so we use a list of user names.
         users = self.config['Users']['users'].split(',')
-        users.append(os.getlogin())
+        users.append(getpass.getuser())
         user, plates, assays_etc, plates_small = [], [], [], []  # 4 lists representing what the filename is split into
         for item in plate2:
             if item in users:  # If the element is a username add to user list
@@ -307,59 +467,544 @@ class Export(object):
             final = final[:31]  # Truncate.
         return final
 
+    def make_template(self):
+        """
+        Formats a sheet of one row with the export's column widths, centred columns and conditional formatting based on
+        genotype. Every sheet is given its formatting by write_sheet(), see Xlsx.SheetTemplate.
+        :return: Xlsx.SheetTemplate
+        """
+        out = BytesIO()
+        writer = pd.ExcelWriter(out, engine='openpyxl')
+        pd.DataFrame([[''] * len(self.cols_order)], columns=self.cols_order).to_excel(
+            writer, sheet_name='Template', index=False)
+        ws = writer.book['Template']
+
+        col_width = {'A': 5, 'C': 11, 'J': 11, 'K': 9.14, 'N': 12.57, 'O': 10, 'P': 18, 'R': 10, 'S': 15.14, 'W': 11.43,
+                     'Y': 13.43}
+        for col in col_width:  # set column widths
+            ws.column_dimensions[col].width = col_width[col]
+            for cell in ws[col]:    # set center align
+                cell.alignment = Alignment(horizontal='center')
+
+        conditions = {'Het': PatternFill(patternType='solid', bgColor='DCE6F0'),
+                      'Hom': PatternFill(patternType='solid', bgColor='B8CCE4'),
+                      'Hemi': PatternFill(patternType='lightUp', bgColor='DCE6F0', fgColor='B8CCE4'),
+                      'Fail': PatternFill(patternType='solid', bgColor='FFC7CE'),
+                      'Retest': PatternFill(patternType='solid', bgColor='FFC7CE')}
+        for genotype in conditions:  # Add conditional formatting
+            ws.conditional_formatting.add('K2:K3', FormulaRule(formula=['NOT(ISERROR(SEARCH("' + genotype + '",K2)))'],
+                                                               stopIfTrue=True, fill=conditions[genotype]))
+        writer.save()
+        return Xlsx.SheetTemplate(out.getvalue())
+
+    def write_sheet(self, path, sheet):
+        """
+        Writes samples to a new workbook with a top row freeze pane, formatted from the template, see make_template().
+        :param path: str file path or file-like object to save the workbook to
+        :param sheet: str sheet name
+        """
+        out = BytesIO()
+        writer = pd.ExcelWriter(out, engine='openpyxl')
+        self.samples.to_excel(writer, sheet_name=sheet, index=False, freeze_panes=(1, 0))  # Write dataframe to excel
+        if self.cached:  # Excel shows the saved results, and recalculates formulas when their cells change.
+            writer.book.calculation.fullCalcOnLoad = False
+        writer.save()  # Save xlsx.
+        data = self.template.apply(out.getvalue(), self.samples.shape[0])
+        if self.cached:
+            data = Xlsx.set_cached_values(data, self.cached)
+        if hasattr(path, 'write'):
+            path.write(data)
+        else:
+            with Xlsx.replacing(path) as f:  # An existing workbook is only replaced once the new one is written.
+                f.write(data)
+
     def to_xlsx(self):
         """
-        Exports to xlsx file and formats it with correct column widths, top row freeze pane and conditional formatting
-        based on genotype.
+        Exports samples to a new xlsx file, or adds it as a new sheet if the file exists (Multi, ToFile and Last).
         """
         sheet = self.get_sheet_name()
         if not self.xlsx_file:
             self.xlsx_file = os.path.splitext(self.inp)[0] + '.xlsx'
+        self.output, self.pending = self.xlsx_file, False
 
         if os.path.isfile(self.xlsx_file):
             self.multi = True
-            book = load_workbook(self.xlsx_file)
-            writer = pd.ExcelWriter(self.xlsx_file, engine='openpyxl')
-            writer.book = book
-            if sheet in book.sheetnames:  # if the sheet already exists, add a digit on the end.
+        if self._session:
+            if self._session.xlsx_file != self.xlsx_file:  # Last or ToFile part way through a session
+                self._session.save()
+                self._session = MultiSession(self.xlsx_file, self._session.checkpoint)
+            sheet_names = self._session.sheet_names()
+            if sheet in sheet_names and self.config.get('Export', 'Reexport', fallback='sheet').strip().lower() == \
+                    'update':
+                try:
+                    self.update_sheet(sheet)
+                    return
+                except ValueError as e:  # Not an export sheet, so it is added as a new one.
+                    print(Message(str(e)).yellow())
+            if sheet in sheet_names:  # if the sheet already exists, add a digit on the end.
                 for i in range(1, 100):
                     sheet1 = sheet + str(i)
                     if len(sheet1) > 31:
                         sheet1 = sheet[:30] + str(i)
                     if len(sheet1) > 31:
                         sheet1 = sheet[:29] + str(i)
-                    if sheet1 not in book.sheetnames:
+                    if sheet1 not in sheet_names:
                         sheet = sheet1
                         break
+            # Write the sheet on its own, it is added to the file when the session is finished.
+            new_sheet = BytesIO()
+            self.write_sheet(new_sheet, sheet)
+            self._session.add(sheet, new_sheet.getvalue(), self.inp)
+            self.pending = True
         else:
-            writer = pd.ExcelWriter(self.xlsx_file, engine='openpyxl')
-        self.samples.to_excel(writer, sheet_name=sheet, index=False, freeze_panes=(1, 0))  # Write dataframe to excel
-        """Formatting for a pretty output"""
-        wb = writer.book
-        ws = wb[sheet]
-
-        col_width = {'A': 5, 'C': 11, 'J': 11, 'K': 9.14, 'N': 12.57, 'O': 10, 'P': 18, 'R': 10, 'S': 15.14, 'W': 11.43,
-                     'Y': 13.43}
-        for col in col_width:  # set column widths
-            ws.column_dimensions[col].width = col_width[col]
-            for cell in ws[col]:    # set center align
-                cell.alignment = Alignment(horizontal='center')
-
-        conditions = {'Het': PatternFill(patternType='solid', bgColor='DCE6F0'),
-                      'Hom': PatternFill(patternType='solid', bgColor='B8CCE4'),
-                      'Hemi': PatternFill(patternType='lightUp', bgColor='DCE6F0', fgColor='B8CCE4'),
-                      'Fail': PatternFill(patternType='solid', bgColor='FFC7CE'),
-                      'Retest': PatternFill(patternType='solid', bgColor='FFC7CE')}
-        for genotype in conditions:  # Add conditional formatting
-            ws.conditional_formatting.add('K2:K' + str(self.samples.shape[0] + 2),
-                                          FormulaRule(formula=['NOT(ISERROR(SEARCH("' + genotype + '",K2)))'],
-                                                      stopIfTrue=True, fill=conditions[genotype]))
-        wb.active = ws
-        writer.save()  # Save xlsx.
-        if self._multi_export:
+            self.write_sheet(self.xlsx_file, sheet)
+        if self._session:
             print(Message(' Added sheet ' + sheet).timestamp(machine='Export'))
         else:
             print(Message(' ' + os.path.split(self.xlsx_file)[1]).timestamp(machine='Export'))
             self._last_file = self.xlsx_file
-            os.startfile(self.xlsx_file)
+            if not self.headless:
+                os.startfile(self.xlsx_file)
             self.xlsx_file = None
+
+    def update_sheet(self, sheet):
+        """
+        Updates the sheet of a plate exported to the workbook before, rather than adding the plate again as a new sheet.
+        Wells are matched by Well and Target: the columns users fill in (user_columns) are kept from the sheet, the
+        rest is from the new export. The sheet is only re-written if a well has changed, been added or been removed.
+        :param sheet: str name of the existing sheet
+        :return: tuple of int numbers of wells (changed, added, removed)
+        """
+        key = ['Well ', 'Target']
+        old = self._session.read_sheet(sheet)
+        if not set(key).issubset(old.columns):
+            raise ValueError("Sheet {} doesn't look like an export, adding the plate as a new sheet.".format(sheet))
+        old = old.dropna(subset=key).drop_duplicates(key).set_index(key)
+        wells = pd.MultiIndex.from_arrays([self.samples[column].values for column in key], names=key)
+        previous = old.reindex(wells)  # The old row of each new row, blank if the well is new.
+        for column in self.user_columns:
+            if column in previous.columns:
+                self.samples[column] = previous[column].values
+
+        data = [column for column in self.cols_order
+                if column not in key + self.user_columns + ['Genotype', 'Result', 'Confirmed']]
+        before = previous.reindex(columns=data).values.astype(object)
+        after = self.samples[data].values.astype(object)
+        same = ((before == after) | (pd.isna(before) & pd.isna(after))).all(axis=1)
+        found = wells.isin(old.index)
+        changed, added = int((found & ~same).sum()), int((~found).sum())
+        removed = len(old.index.difference(wells))
+        if not (changed or added or removed):
+            print(Message(' No changes to sheet ' + sheet).timestamp(machine='Export'))
+            return changed, added, removed
+
+        output = self.config.get('Export', 'Output', fallback='formulas').strip().lower()
+        if output in ('values', 'cached'):  # Kept Gender and Compare values can change the results.
+            self.evaluate(output)
+        new_sheet = BytesIO()
+        self.write_sheet(new_sheet, sheet)
+        self._session.replace(sheet, new_sheet.getvalue(), self.inp)
+        self.pending = True
+        print(Message(' Updated sheet {}: {} wells changed, {} added, {} removed'.format(
+            sheet, changed, added, removed)).timestamp(machine='Export'))
+        return changed, added, removed
+
+
+class AssayIndex(object):
+    """
+    Assay names and types from the assay file, which lists the spelling variants of each assay, for uniformity in the
+    database. Variants are matched in lower case.
+    Variants containing * or ? are rules, tried in file order for targets that match no variant, e.g. *_wt* is LoA.
+    A rule with an Assay of * keeps the target's own name. Targets matching nothing are Unknown.
+    The file is re-read when it changes, so new variants apply without restarting.
+    """
+    default_rules = [('*', '*_wt*', 'LoA'), ('*', '*_ce*', 'LoA')]  # (Assay, Variant, Type), if the file has no rules
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.names = {}     # Dict: variant: assay name
+        self.types = {}     # Dict: variant: assay type
+        self.rules = []     # List: (compiled pattern, assay name or * , assay type) in the order they are tried
+        self.load()
+
+    def load(self):
+        """Reads the assay file, raises FileNotFoundError if it isn't there."""
+        mtime = os.stat(self.path).st_mtime
+        assays = pd.read_csv(self.path, sep='\t', dtype=str).dropna(subset=['Variant'])
+        assays[['Assay', 'Type']] = assays[['Assay', 'Type']].fillna('')  # Blank cells are read as NaN
+        names, types, rules = {}, {}, []
+        for assay, variant, assay_type in assays[['Assay', 'Variant', 'Type']].itertuples(index=False):
+            variant, assay_type = variant.strip().lower(), assay_type.strip()
+            if '*' in variant or '?' in variant:
+                rules.append((re.compile(fnmatch.translate(variant)), assay.strip(), assay_type))
+            elif variant not in names:  # The first spelling listed wins.
+                names[variant], types[variant] = assay.strip(), assay_type
+        if not rules:
+            rules = [(re.compile(fnmatch.translate(variant)), assay, assay_type)
+                     for assay, variant, assay_type in self.default_rules]
+        self.names, self.types, self.rules, self.mtime = names, types, rules, mtime
+
+    def reload(self):
+        """Re-reads the assay file if it has changed. If it can't be read, the assays already loaded are kept."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self.mtime:
+                self.mtime = mtime  # A broken file is only reported once.
+                self.load()
+                print(Message(' Assay file updated').timestamp(machine='Export'))
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            print(Message("Couldn't read the Assays file, using the last version. " + str(e)).red())
+
+    def resolve(self, targets):
+        """
+        Looks up a column of targets.
+        :param targets: pd.Series of target names
+        :return: tuple (pd.Series of assay types, pd.Series of assay names)
+        """
+        self.reload()
+        variant = targets.str.strip().str.lower()
+        assay_type = variant.map(self.types)
+        assay_name = variant.map(self.names)
+        for pattern, name, rule_type in self.rules:
+            match = assay_type.isna() & variant.str.match(pattern, na=False)
+            assay_type = assay_type.mask(match, rule_type)
+            assay_name = assay_name.mask(match, targets if name == '*' else name)
+        return assay_type.fillna('Unknown'), assay_name.fillna(targets)
+
+
+class FormulaCache(Thread):
+    """
+    The formula templates from the Formulas file, compiled by Export.get_formula_sub and cached locally so starting up
+    doesn't wait on the network share. The cache is keyed by the Formulas file's mtime, size and sha1.
+    If there is a cache it is used straight away, and start() checks the Formulas file in the background, recompiling
+    the templates if it has changed. If the share can't be reached the last good templates are kept.
+    """
+    cells = ('K2', 'Q2', 'R2')  # Genotype, Result and Confirmed formulas in Sheet1
+
+    def __init__(self, path, cache_file, on_update=None):
+        """
+        :param path: Formulas.xlsx path
+        :param cache_file: local json file for the compiled templates
+        :param on_update: called with the new templates when the Formulas file has changed
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.cache_file = cache_file
+        self.on_update = on_update
+        self.key = None         # Dict: mtime, size and sha1 of the Formulas file the templates were compiled from
+        self.formulas = None    # Tuple: genotype, result, confirmed formula templates
+        self.read_cache()
+
+    def read_cache(self):
+        """Loads the templates from the cache file, if it is for the same Formulas file."""
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache['path'] == self.path:
+                self.key, self.formulas = cache['key'], tuple(cache['formulas'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # No cache, or it's unreadable: the Formulas file is read instead.
+
+    def write_cache(self):
+        """Saves the templates to the cache file. The cache is only a speed up, so failing to write it is ignored."""
+        try:
+            with open(self.cache_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'path': self.path, 'key': self.key, 'formulas': self.formulas}, f, indent=1)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError:
+            pass
+
+    def compile(self, data):
+        """
+        :param data: bytes of the Formulas file
+        :return: tuple of formula templates
+        """
+        ws = load_workbook(BytesIO(data), read_only=True)['Sheet1']
+        return tuple(Export.get_formula_sub(ws[cell].value) for cell in self.cells)
+
+    def revalidate(self):
+        """
+        Checks the Formulas file against the cache key, recompiling the templates if it has changed.
+        Raises OSError if the file can't be read.
+        :return: True if the templates changed
+        """
+        stat = os.stat(self.path)
+        if self.key and self.key['mtime'] == stat.st_mtime and self.key['size'] == stat.st_size:
+            return False
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        changed = not self.key or self.key['sha1'] != sha1  # A touched but unchanged file only updates the key.
+        if changed:
+            self.formulas = self.compile(data)
+        self.key = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1}
+        self.write_cache()
+        return changed
+
+    def run(self):
+        """Revalidates in the background, passing new templates to on_update."""
+        try:
+            if self.revalidate():
+                print(Message(' Formulas file updated').timestamp(machine='Export'))
+                if self.on_update:
+                    self.on_update(self.formulas)
+        except (OSError, KeyError, ValueError) as e:
+            print(Message("Couldn't check the Formulas file, using the cached formulas. " + str(e)).yellow())
+
+
+class MultiSession(object):
+    """
+    The sheets of one Multi export. Sheets are kept in memory as plates are exported and written to the workbook in one
+    go when Multi export is turned off, rather than loading and saving the workbook for every plate.
+    If Checkpoint is set in config.ini, a timer also writes the sheets Checkpoint seconds after a plate is added, so a
+    crash loses little work. The session is used by the export thread and the timer, so each method holds its lock.
+    """
+    def __init__(self, xlsx_file=None, checkpoint=0):
+        self.xlsx_file = xlsx_file      # Str: path, set by Export.to_xlsx() when the first plate is exported
+        self.checkpoint = checkpoint    # Int: seconds between saves, 0 to only save when the session is finished
+        self.sheets = []                # List: (sheet name, bytes of a workbook with just that sheet) not yet written
+        self.updates = {}               # Dict: sheet name: bytes of a new version of a sheet already in xlsx_file
+        self.sources = {}               # Dict: sheet name: list of the export files in the sheets not written yet
+        self._file_sheets = None        # List: names of the sheets already in xlsx_file
+        self._timer = None              # Timer: the next checkpoint save, while there are sheets not written
+        self._lock = RLock()
+
+    def sheet_names(self):
+        """Returns the names of all the sheets in the workbook, including those not written yet."""
+        with self._lock:
+            if self._file_sheets is None:
+                self._file_sheets = Xlsx.sheet_names(self.xlsx_file) if os.path.isfile(self.xlsx_file) else []
+            return self._file_sheets + [name for name, data in self.sheets]
+
+    def read_sheet(self, sheet):
+        """Returns a sheet's values, from the session's latest version or else the file, with the header as columns."""
+        with self._lock:  # The file is kept open while reading, so it isn't saved over.
+            pending = dict(self.sheets, **self.updates)
+            wb = load_workbook(BytesIO(pending[sheet]) if sheet in pending else self.xlsx_file, read_only=True)
+            try:
+                rows = list(wb[sheet].iter_rows(values_only=True))
+            finally:
+                wb.close()
+        return pd.DataFrame(rows[1:], columns=rows[0] if rows else None)
+
+    def replace(self, sheet, data, source=None):
+        """
+        Replaces a sheet, one not written yet or one in xlsx_file, with a new version of it.
+        :param source: str path of the export file, recorded in the manifest as pending until the sheet is written
+        """
+        with self._lock:
+            for i, (name, _) in enumerate(self.sheets):
+                if name == sheet:
+                    self.sheets[i] = (sheet, data)
+                    break
+            else:
+                self.updates[sheet] = data
+            self.track(sheet, source)
+
+    def add(self, sheet, data, source=None):
+        with self._lock:
+            self.sheets.append((sheet, data))
+            self.track(sheet, source)
+
+    def track(self, sheet, source):
+        """Records the export file of a sheet as pending and starts the checkpoint timer."""
+        if source is not None:
+            self.sources.setdefault(sheet, []).append(source)
+            Export.record(source, 'pending', output=self.xlsx_file)
+        self.arm()
+
+    def written(self, sheets):
+        """Records the export files of sheets that have been written as exported."""
+        for sheet in sheets:
+            for source in self.sources.pop(sheet, []):
+                Export.record(source, 'exported', output=self.xlsx_file)
+
+    def arm(self):
+        """Starts the checkpoint timer, if Checkpoint is set and there are sheets not written and it isn't running."""
+        with self._lock:
+            if self.checkpoint and self._timer is None and (self.sheets or self.updates):
+                self._timer = Timer(self.checkpoint, self.checkpoint_save)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def checkpoint_save(self):
+        """Called by the timer, saves the sheets not written yet."""
+        with self._lock:
+            self._timer = None
+            try:
+                self.save()
+            except OSError as e:  # The file may be open or the drive slow, the sheets are kept for the next save.
+                print(Message(' Checkpoint save failed, will try again later. ' + str(e)).timestamp(machine='Export'))
+
+    def save(self):
+        """
+        Writes the sheets not written yet to xlsx_file. If the file doesn't exist, it is created from the first. If
+        writing fails the sheets are kept, and the timer is started again to retry.
+        """
+        with self._lock:
+            self.cancel()
+            try:
+                if self.updates:  # Only sheets already in the file, so it exists.
+                    Xlsx.replace_sheets(self.xlsx_file, self.updates)
+                    updated, self.updates = self.updates, {}
+                    self.written(updated)
+                if not self.sheets:
+                    return
+                names = self.sheet_names()
+                if not os.path.isfile(self.xlsx_file):
+                    with open(self.xlsx_file, 'wb') as file:
+                        file.write(self.sheets[0][1])
+                    self.written([self.sheets.pop(0)[0]])
+                    self._file_sheets = None
+                if self.sheets:
+                    Xlsx.append_sheets(self.xlsx_file, [data for name, data in self.sheets])
+                    self.written(name for name, data in self.sheets)
+                self._file_sheets, self.sheets = names, []
+            finally:
+                self.arm()
+
+    def cancel(self):
+        """Stops the checkpoint timer."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+def read_export(path, columns):
+    """
+    Reads a Viia7 export file in one pass. The header lines are parsed, the Results table header line is found by its
+    column names, which also gives the delimiter (tab or comma), and the table is read from memory.
+    :param path: str file path of exported csv
+    :param columns: list of the columns to read from the Results table, all must be present
+    :return: tuple (ExportInfo, pd.DataFrame), ExportInfo.digest is the Manifest.data_hash() of the file
+    """
+    not_an_export = "That file doesnt look right.\n{}\nCheck that you ticked 'Results' when exporting.\n" \
+                    "Columns needed: " + ", ".join(columns) + "."
+    with open(path, 'rb') as file:
+        data = file.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError(not_an_export.format("It is not an export file."))
+
+    lines = text.splitlines(keepends=True)
+    fields, header, offset, closest = {}, None, 0, []
+    for row, line in enumerate(lines):
+        if line.startswith('*'):
+            key, _, value = line.lstrip('* ').partition('=')
+            fields[key.strip()] = value.strip()
+        elif line.strip():
+            for sep in ('\t', ','):
+                cells = next(csv.reader([line], delimiter=sep))
+                found = [col for col in columns if col in cells]
+                if len(found) == len(columns):
+                    header = sep
+                    break
+                if len(found) > len(closest):
+                    closest = found
+        if header:
+            break
+        offset += len(line)
+    if not header:
+        if closest:  # Looks like the table, but columns are missing.
+            missing = [col for col in columns if col not in closest]
+            raise ValueError(not_an_export.format("It is missing columns: " + ", ".join(repr(col) for col in missing)))
+        raise ValueError(not_an_export.format("It is not an export file."))
+
+    # Older exports have no key names, but the controls are always on these lines.
+    endo = fields.get('Endogenous Control', _header_value(lines, 4))
+    ctrl_name = fields.get('Reference Sample', _header_value(lines, 12))
+    if endo is None or ctrl_name is None:
+        raise ValueError(not_an_export.format("Its header is missing the Endogenous Control or Reference Sample."))
+
+    table = text[offset:]
+    end = re.search(r'^\[', table, re.MULTILINE)  # Stop at the next section, e.g. [Amplification Data]
+    if end:
+        table = table[:end.start()]
+    return ExportInfo(endo, ctrl_name, header, fields, Manifest.data_hash(data)), \
+        pd.read_csv(StringIO(table), sep=header, usecols=columns)
+
+
+def _header_value(lines, row):
+    """Returns the value of a 'key = value' line, or None."""
+    try:
+        return lines[row].split(sep='=')[1].strip()
+    except IndexError:
+        return None
+
+
+def find_exports(paths):
+    """
+    Expands a list of files and directories into a sorted list of export files. Directories are searched for .txt files,
+    but not recursively.
+    """
+    files = []
+    for path in paths:
+        path = os.path.normpath(path.strip('\'"'))
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith('.txt') and os.path.isfile(os.path.join(path, name)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(Message("Can't find " + path).red())
+    return files
+
+
+_batch_export = None  # Export instance of a batch worker process, set by _batch_init()
+
+
+def _batch_init():
+    """Pool initializer. Each worker loads the assay and formula files once and reuses them for every plate."""
+    global _batch_export
+    _batch_export = Export()
+    _batch_export.headless = True
+
+
+def _batch_job(inp):
+    """
+    Exports one plate in a batch worker.
+    :return: tuple (file path, error message or None, seconds taken)
+    """
+    return _batch_export.export_file(inp)  # Each plate gets a new workbook, replacing any earlier one.
+
+
+def batch(paths, jobs=None):
+    """
+    Exports many files without any user interaction, one plate per worker process. Bad files are reported and skipped.
+    :param paths: list of export files and/or directories containing them
+    :param jobs: int number of worker processes, defaults to the number of CPUs
+    :return: list of (file path, error message or None, seconds taken), in the order files were given
+    """
+    files = find_exports(paths)
+    if not files:
+        print('No export files found.')
+        return []
+    start = perf_counter()
+    if jobs == 1:
+        _batch_init()
+        results = [_batch_job(inp) for inp in files]
+    else:
+        with Pool(processes=jobs, initializer=_batch_init) as pool:
+            results = pool.map(_batch_job, files, chunksize=1)
+
+    print('\n' + Message('Batch export summary').white())
+    for inp, error, seconds in results:
+        status = Message('Failed: ' + error).red() if error else Message('Done').green()
+        print('{:>8.2f}s  '.format(seconds) + os.path.basename(inp).ljust(40) + ' ' + status)
+    failed = sum(1 for result in results if result[1])
+    print('{} files exported, {} failed in {:.2f}s'.format(len(results) - failed, failed, perf_counter() - start))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process Viia7 export files into formatted xlsx workbooks.')
+    parser.add_argument('--batch', nargs='+', required=True, metavar='PATH',
+                        help='export files, or directories of export files, to process')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (default: CPU count)')
+    args = parser.parse_args()
+    colorama_init()  # Enables coloured text on the windows console.
+    batch(args.batch, jobs=args.jobs)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Calculates the Genotype, Result and Confirmed formulas from the Formulas file in python, a whole column at a time, so
+exports can hold the results rather than formulas for Excel to calculate. See Export.evaluate().
+
+The formulas are parsed with openpyxl's Tokenizer into a tree, and each node is evaluated over numpy arrays holding one
+value per row. Only what the Formulas file needs is supported: references to cells on the same row, numbers, text,
+TRUE/FALSE, comparisons, arithmetic, & and the functions in FUNCTIONS. Anything else raises FormulaError, and Export
+writes the formulas instead. Excel's rules are followed for blank cells (0, "" or FALSE depending on what they are
+compared with), comparing text (case insensitive, text is greater than any number) and ROUND (halves away from zero).
+As in Excel, IF only calculates the branch each row takes, so e.g. IF(F2=0,"",1/F2) doesn't fail on rows where F2 is 0.
+"""
+import operator
+import re
+
+import numpy as np
+from openpyxl.formula import Tokenizer
+from openpyxl.formula.tokenizer import Token
+from openpyxl.utils import get_column_letter
+
+PRECEDENCE = {'=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1, '&': 2, '+': 3, '-': 3, '*': 4, '/': 4, '^': 5}
+COMPARE = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '>': operator.gt, '<=': operator.le,
+           '>=': operator.ge}
+ARITHMETIC = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide, '^': np.power}
+CELL = re.compile(r'^\$?([A-Z]{1,3})\$?(\d+)$')
+
+
+class FormulaError(ValueError):
+    """A formula that can't be calculated here, Excel has to calculate it."""
+    pass
+
+
+def parse(formula, row=2):
+    """
+    Parses a formula into a tree of tuples:
+        ('value', numpy scalar or str)  ('ref', column letter)  ('op', operator, left, right)
+        ('neg', node)  ('func', NAME, [args])
+    :param formula: str e.g. '=IF(ISBLANK(F2),"Omitted",...)'
+    :param row: the row the formula is on, references must be to this row
+    """
+    tokens = [token for token in Tokenizer(formula).items if token.type != Token.WSPACE]
+    parser = _Parser(tokens, row)
+    tree = parser.expression()
+    if parser.pos != len(tokens):
+        raise FormulaError('Unexpected ' + tokens[parser.pos].value + ' in ' + formula)
+    return tree
+
+
+class _Parser(object):
+    """Precedence climbing parser over Tokenizer tokens."""
+    def __init__(self, tokens, row):
+        self.tokens = tokens
+        self.row = row
+        self.pos = 0
+
+    def peek(self, token_type, subtype=None, value=None):
+        if self.pos >= len(self.tokens):
+            return False
+        token = self.tokens[self.pos]
+        return token.type == token_type and (subtype is None or token.subtype == subtype) \
+            and (value is None or token.value == value)
+
+    def take(self):
+        if self.pos >= len(self.tokens):
+            raise FormulaError('Formula ends too soon')
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expression(self, min_precedence=1):
+        left = self.unary()
+        while self.peek(Token.OP_IN) and PRECEDENCE.get(self.tokens[self.pos].value, 0) >= min_precedence:
+            op = self.take().value
+            right = self.expression(PRECEDENCE[op] + 1)  # Left to right, as Excel
+            left = ('op', op, left, right)
+        if self.peek(Token.OP_IN) and self.tokens[self.pos].value not in PRECEDENCE:
+            raise FormulaError('Operator ' + self.tokens[self.pos].value + " isn't supported")
+        return left
+
+    def unary(self):
+        if self.peek(Token.OP_PRE):
+            op = self.take().value
+            node = self.unary()
+            return ('neg', node) if op == '-' else node
+        node = self.primary()
+        while self.peek(Token.OP_POST, value='%'):
+            self.take()
+            node = ('op', '/', node, ('value', np.float64(100)))
+        return node
+
+    def primary(self):
+        token = self.take()
+        if token.type == Token.OPERAND:
+            if token.subtype == Token.NUMBER:
+                return 'value', np.float64(token.value)
+            if token.subtype == Token.TEXT:
+                return 'value', token.value[1:-1].replace('""', '"')
+            if token.subtype == Token.LOGICAL:
+                return 'value', np.bool_(token.value.upper() == 'TRUE')
+            if token.subtype == Token.RANGE:
+                match = CELL.match(token.value.upper())
+                if not match or int(match.group(2)) != self.row:
+                    raise FormulaError('Only cells on the same row are supported, not ' + token.value)
+                return 'ref', match.group(1)
+            raise FormulaError(token.value + " isn't supported")
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            name, args = token.value[:-1].upper(), []
+            if name not in FUNCTIONS:
+                raise FormulaError('Function ' + name + " isn't supported")
+            if self.peek(Token.FUNC, Token.CLOSE):
+                self.take()
+                return 'func', name, args
+            while True:
+                args.append(self.expression())
+                token = self.take()
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    return 'func', name, args
+                if not (token.type == Token.SEP and token.subtype == Token.ARG):
+                    raise FormulaError('Unexpected ' + token.value + ' in ' + name)
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            node = self.expression()
+            if not self.peek(Token.PAREN, Token.CLOSE):
+                raise FormulaError('Missing )')
+            self.take()
+            return node
+        raise FormulaError('Unexpected ' + token.value)
+
+
+class Evaluator(object):
+    """
+    Formulas for some columns of a sheet, evaluated over a dataframe holding the other columns.
+    """
+    def __init__(self, formulas, columns, row=2):
+        """
+        :param formulas: dict column name: formula, or template from Export.get_formula_sub with {0} for the row
+        :param columns: list of column names in sheet order, e.g. Export.cols_order, giving each column's letter
+        :param row: the row the formulas are written for
+        """
+        self.names = {get_column_letter(n + 1): name for n, name in enumerate(columns)}  # Dict: letter: column name
+        self.letters = {name: letter for letter, name in self.names.items()}
+        self.trees = {name: parse(formula.format(row), row) for name, formula in formulas.items()}
+        for name in self.trees:
+            self.check(name, [])
+
+    def check(self, name, seen):
+        """Raises FormulaError for references to columns that aren't exported, or formulas that refer to themselves."""
+        if name in seen:
+            raise FormulaError('Circular reference in ' + ' -> '.join(seen + [name]))
+        for letter in _refs(self.trees[name]):
+            if letter not in self.names:
+                raise FormulaError('The ' + name + ' formula refers to column ' + letter + ", which isn't exported")
+            if self.names[letter] in self.trees:
+                self.check(self.names[letter], seen + [name])
+
+    def evaluate(self, frame):
+        """
+        :param frame: pd.DataFrame with the columns that the formulas refer to
+        :return: dict column name: numpy array of results, in the frame's row order
+        """
+        results = {}  # Dict: column name: values, each column is evaluated once however often it is referred to
+
+        def column(letter):
+            name = self.names[letter]
+            if name not in results:
+                results[name] = self.node(self.trees[name], column, len(frame)) if name in self.trees \
+                    else _column(frame[name].values)
+            return results[name]
+
+        return {name: column(self.letters[name]) for name in self.trees}
+
+    def node(self, tree, column, n):
+        kind = tree[0]
+        if kind == 'value':
+            return np.full(n, tree[1], dtype=object if isinstance(tree[1], str) else type(tree[1]))
+        if kind == 'ref':
+            return column(tree[1])
+        if kind == 'neg':
+            return -_numbers(self.node(tree[1], column, n))
+        if kind == 'op':
+            op, left, right = tree[1], self.node(tree[2], column, n), self.node(tree[3], column, n)
+            if op in COMPARE:
+                return _compare(op, left, right)
+            if op == '&':
+                return np.array([a + b for a, b in zip(_text(left), _text(right))], dtype=object)
+            with np.errstate(divide='raise', invalid='raise'):
+                try:
+                    return ARITHMETIC[op](_numbers(left), _numbers(right))
+                except FloatingPointError:
+                    raise FormulaError('#DIV/0! or #NUM! in ' + op)
+        return FUNCTIONS[tree[1]](self, tree[2], column, n)
+
+
+def _refs(tree):
+    """Yields the column letters a tree refers to."""
+    if tree[0] == 'ref':
+        yield tree[1]
+    for child in tree[1:]:
+        if isinstance(child, tuple):
+            yield from _refs(child)
+        elif isinstance(child, list):
+            for arg in child:
+                yield from _refs(arg)
+
+
+# Cell values are numpy arrays: float with NaN for blank cells, bool, or object holding str, numbers, bools and None
+# for blank cells.
+
+def _column(values):
+    """Returns a dataframe column's values as they are in Excel once written: NaN and None are blank cells."""
+    if values.dtype.kind in 'fiu':
+        return values.astype(np.float64)
+    if values.dtype.kind == 'b':
+        return values
+    return np.array([None if value is None or value != value else value for value in values], dtype=object)
+
+
+def _blank(values):
+    if values.dtype.kind == 'f':
+        return np.isnan(values)
+    if values.dtype.kind == 'b':
+        return np.zeros(len(values), dtype=bool)
+    return np.array([value is None or value != value for value in values], dtype=bool)
+
+
+def _number(value):
+    if value is None or value != value:
+        return 0.0
+    if isinstance(value, str):
+        try:
+            return float(value)  # Excel reads numbers written as text in arithmetic.
+        except ValueError:
+            raise FormulaError('#VALUE! from "' + value + '" in arithmetic')
+    return float(value)
+
+
+def _numbers(values):
+    """Values as numbers for arithmetic, blank cells are 0."""
+    if values.dtype.kind == 'f':
+        return np.nan_to_num(values)
+    if values.dtype.kind == 'b':
+        return values.astype(np.float64)
+    return np.array([_number(value) for value in values], dtype=np.float64)
+
+
+def _text(values):
+    """Values as text, as & shows them."""
+    def text(value):
+        if value is None or value != value:
+            return ''
+        if isinstance(value, (bool, np.bool_)):
+            return 'TRUE' if value else 'FALSE'
+        if isinstance(value, str):
+            return value
+        return '{:.15g}'.format(value)
+    return [text(value) for value in values]
+
+
+def _truth(values):
+    """Values as TRUE/FALSE for IF, AND, OR and NOT. Blank cells are FALSE, numbers are TRUE unless 0."""
+    if values.dtype.kind == 'b':
+        return values
+    if values.dtype.kind == 'f':
+        return np.nan_to_num(values) != 0
+
+    def truth(value):
+        if isinstance(value, str):
+            raise FormulaError('#VALUE! from "' + value + '" used as TRUE/FALSE')
+        return bool(_number(value))
+    return np.array([truth(value) for value in values], dtype=bool)
+
+
+def _rank(value):
+    """Excel sorts numbers before text, and text before TRUE/FALSE."""
+    if isinstance(value, (bool, np.bool_)):
+        return 2
+    return 1 if isinstance(value, str) else 0
+
+
+def _compare_values(op, a, b):
+    if a is None or a != a:  # A blank cell is whatever is blank for the other side: 0, "" or FALSE
+        a = '' if isinstance(b, str) else False if isinstance(b, (bool, np.bool_)) else 0.0
+    if b is None or b != b:
+        b = '' if isinstance(a, str) else False if isinstance(a, (bool, np.bool_)) else 0.0
+    if _rank(a) != _rank(b):
+        return COMPARE[op](_rank(a), _rank(b))
+    if isinstance(a, str):
+        return COMPARE[op](a.casefold(), b.casefold())
+    return COMPARE[op](a, b)
+
+
+def _compare(op, left, right):
+    if left.dtype.kind in 'fb' and right.dtype.kind in 'fb' and left.dtype.kind == right.dtype.kind:
+        return COMPARE[op](np.nan_to_num(left), np.nan_to_num(right))
+    return np.array([_compare_values(op, a, b) for a, b in zip(left.astype(object), right.astype(object))],
+                    dtype=bool)
+
+
+def _on_rows(evaluator, tree, column, rows):
+    """Evaluates tree for some rows only, rows: array of row positions. Errors on the other rows aren't raised."""
+    return evaluator.node(tree, lambda letter: column(letter)[rows], len(rows))
+
+
+def _if(evaluator, args, column, n):
+    if not 2 <= len(args) <= 3:
+        raise FormulaError('IF needs 2 or 3 arguments')
+    condition = _truth(evaluator.node(args[0], column, n))
+    true_rows, false_rows = np.flatnonzero(condition), np.flatnonzero(~condition)
+    then = _on_rows(evaluator, args[1], column, true_rows)
+    otherwise = _on_rows(evaluator, args[2], column, false_rows) if len(args) == 3 \
+        else np.zeros(len(false_rows), dtype=bool)
+    if then.dtype != otherwise.dtype:  # Keeps numbers, text and TRUE/FALSE apart
+        then, otherwise = then.astype(object), otherwise.astype(object)
+    result = np.empty(n, dtype=then.dtype)
+    result[true_rows] = then
+    result[false_rows] = otherwise
+    return result
+
+
+def _and(evaluator, args, column, n):
+    return np.logical_and.reduce([_truth(evaluator.node(arg, column, n)) for arg in args])
+
+
+def _or(evaluator, args, column, n):
+    return np.logical_or.reduce([_truth(evaluator.node(arg, column, n)) for arg in args])
+
+
+def _not(evaluator, args, column, n):
+    return ~_truth(evaluator.node(args[0], column, n))
+
+
+def _isblank(evaluator, args, column, n):
+    if args[0][0] != 'ref':
+        return np.zeros(n, dtype=bool)
+    return _blank(evaluator.node(args[0], column, n))
+
+
+def _round(evaluator, args, column, n):
+    values = _numbers(evaluator.node(args[0], column, n))
+    factor = 10.0 ** np.trunc(_numbers(evaluator.node(args[1], column, n)) if len(args) > 1 else 0)
+    # Rounded to 9 places first, to drop float error, e.g. 0.1195 * 1000 = 119.49999999999999, which Excel rounds up.
+    return np.sign(values) * np.floor(np.round(np.abs(values) * factor, 9) + 0.5) / factor
+
+
+def _abs(evaluator, args, column, n):
+    return np.abs(_numbers(evaluator.node(args[0], column, n)))
+
+
+FUNCTIONS = {'IF': _if, 'AND': _and, 'OR': _or, 'NOT': _not, 'ISBLANK': _isblank, 'ROUND': _round, 'ABS': _abs}
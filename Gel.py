@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Crops Qiaxcel gel images for pasting into summary files. The scale and lanes are found from the image's brightness
+profiles, see detect(). Used by Monitor.Egel on clipboard images, and on saved images in batch:
+
+    python Gel.py --batch <image files or directories> --crops standard small scale --format png --jobs N
+
+Nothing here uses the clipboard or win32, so batches also run on Linux.
+"""
+import argparse
+import os
+from io import BytesIO
+from multiprocessing import Pool
+from time import perf_counter
+
+from PIL import Image
+from colorama import init as colorama_init
+
+from Message import Message
+
+# Qiaxcel image heights at different dpi levels, some PCs give 505 rather than 504. Only images of these heights are
+# accepted: other screenshots, e.g. a bordered grid, often have a step at every edge detect() looks for.
+HEIGHTS = {1575, 788, 504, 505, 394}
+CROPS = ['standard', 'small', 'scale']
+IMAGE_TYPES = ('.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif')
+
+
+def ratio_edges(size):
+    """
+    The crop edges as fixed ratios of the image height, which fit Qiaxcel images at the dpi levels in HEIGHTS.
+    :param size: tuple (width, height)
+    :return: dict edge: position in pixels. top: below the border, scale: right of the scale, small: left of the
+             marker lane on the right, right: left of the right border.
+    """
+    width, height = size
+    return {'top': height / 71.7, 'scale': height / 5.54,
+            'small': width - height / 5.325, 'right': width - height / 168}
+
+
+def edge_boxes(edges, size):
+    """Returns a dict of crop type: box, see crop_box(), from a dict of edges, see ratio_edges()."""
+    height = size[1]
+    return {'small': (edges['scale'], edges['top'], edges['small'], height),     # Samples without scale
+            'scale': (0, edges['top'], edges['scale'], height),                  # Scale only
+            'standard': (edges['scale'], edges['top'], edges['right'], height)}  # Samples with scale attached
+
+
+def crop_box(size, crop_type='standard'):
+    """
+    Returns the box to crop for crop_type from the fixed ratios, in pixels (left, top, right, bottom).
+    :param size: tuple (width, height) of the Qiaxcel image
+    :param crop_type: 'standard' samples with scale attached, 'small' samples without scale, 'scale' scale only
+    """
+    return edge_boxes(ratio_edges(size), size)[crop_type]
+
+
+def find_edge(strips, expected, window, contrast=6.0, strips_agree=2):
+    """
+    Finds the sharpest step in brightness near an expected position. The image is split into strips across the edge,
+    e.g. 4 bands of rows when looking for a vertical edge. A layout edge runs the whole length of the image, so the step
+    must show in every strip. A band or label only shows in some strips.
+    :param strips: 2d array, the mean brightness profile of each strip
+    :param expected: expected position in pixels
+    :param window: how far from expected to look, in pixels
+    :param contrast: smallest step in grey levels (0-255) counted as an edge
+    :param strips_agree: how far, in pixels, the step in each strip may be from the overall step
+    :return: int position of the first pixel after the step, or None if there isn't a clear edge.
+    """
+    import numpy as np
+    steps = np.abs(np.diff(strips, axis=1))  # step between pixel i and i + 1
+    lo = int(max(0, expected - window))
+    hi = int(min(steps.shape[1], expected + window + 1))
+    if hi - lo < 3:
+        return None
+    steps = steps[:, lo:hi]
+    overall = steps.mean(axis=0)
+    peak = int(overall.argmax())
+    if overall[peak] < contrast or overall[peak] < 3 * np.median(overall):
+        return None
+    in_strips = steps[:, max(0, peak - strips_agree):peak + strips_agree + 1].max(axis=1)
+    if (in_strips < overall[peak] / 2).any():
+        return None
+    return lo + peak + 1
+
+
+def detect(image, strips=4):
+    """
+    Finds the crop boxes of a Qiaxcel image from its brightness profiles, so the crops follow the scale and lanes
+    exactly. Each edge is searched for near where the fixed ratios put it. The found edges are only used if all of
+    them are found, otherwise the boxes are all from the fixed ratios, rather than mixing edges found on different
+    grounds.
+    :param image: PIL Image
+    :param strips: number of strips the image is split into, see find_edge()
+    :return: tuple (dict crop type: box, fraction of edges found 0-1)
+    """
+    import numpy as np  # Imported here so Monitor starts without waiting for numpy, see Monitor.ExportLoader.
+    gray = np.asarray(image.convert('L'), dtype=np.float32)
+    row_strips = np.stack([strip.mean(axis=0) for strip in np.array_split(gray, strips, axis=0)])
+    col_strips = np.stack([strip.mean(axis=1) for strip in np.array_split(gray, strips, axis=1)])
+    width, height = image.size
+    windows = {'top': max(3, height / 36), 'scale': height / 20, 'small': height / 20, 'right': max(3, height / 84)}
+    expected = ratio_edges(image.size)
+    edges = {edge: find_edge(col_strips if edge == 'top' else row_strips, position, windows[edge])
+             for edge, position in expected.items()}
+    confidence = sum(position is not None for position in edges.values()) / len(edges)
+    return edge_boxes(edges if confidence == 1 else expected, image.size), confidence
+
+
+def is_gel(image):
+    """Returns True if image looks like a Qiaxcel gel: one of the known heights, see HEIGHTS."""
+    return image.size[1] in HEIGHTS
+
+
+def crop(image, crop_type='standard', boxes=None):
+    """
+    Crops a Qiaxcel image and rotates it so lanes run top to bottom.
+    :param image: PIL Image
+    :param crop_type: see crop_box()
+    :param boxes: from detect(), if already run
+    :return: PIL Image in RGB
+    """
+    boxes = boxes or detect(image)[0]
+    return image.crop(boxes[crop_type]).rotate(270, expand=True).convert('RGB')
+
+
+def to_dib(image):
+    """Returns the image as a device independent bitmap, the format windows uses for images on the clipboard."""
+    img_out = BytesIO()
+    image.save(img_out, 'BMP')
+    return img_out.getvalue()[14:]  # the first 14 bytes are the bmp file header.
+
+
+def find_images(paths):
+    """Expands a list of files and directories into a sorted list of image files. Directories are not recursed."""
+    files = []
+    for path in paths:
+        path = os.path.normpath(path.strip('\'"'))
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_TYPES) and os.path.isfile(os.path.join(path, name)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(Message("Can't find " + path).red())
+    return files
+
+
+def _batch_job(job):
+    """
+    Crops one image in a batch worker.
+    :param job: tuple (image path, output directory or None, crop types, format)
+    :return: tuple (image path, error message or None, seconds taken, output paths)
+    """
+    path, out_dir, crops, fmt = job
+    start = perf_counter()
+    out_dir = out_dir or os.path.join(os.path.dirname(path), 'Cropped')
+    name = os.path.splitext(os.path.basename(path))[0]
+    outputs = []
+    try:
+        with Image.open(path) as image:
+            if not is_gel(image):
+                return path, "Not a Qiaxcel image, it is {}x{}".format(*image.size), perf_counter() - start, outputs
+            boxes = detect(image)[0]
+            os.makedirs(out_dir, exist_ok=True)
+            for crop_type in crops:
+                out = os.path.join(out_dir, name + '_' + crop_type + '.' + fmt)
+                crop(image, crop_type, boxes).save(out)
+                outputs.append(out)
+    except OSError as e:  # Not an image, or couldn't write.
+        return path, str(e), perf_counter() - start, outputs
+    return path, None, perf_counter() - start, outputs
+
+
+def batch(paths, out_dir=None, crops=None, fmt='png', jobs=None):
+    """
+    Crops many gel images, one image per worker process. Images that aren't Qiaxcel images are reported and skipped.
+    :param paths: list of image files and/or directories containing them
+    :param out_dir: directory for the cropped images, default a Cropped folder next to each image
+    :param crops: list of crop types, default all, see crop_box()
+    :param fmt: 'png' or 'bmp'
+    :param jobs: int number of worker processes, defaults to the number of CPUs
+    :return: list of (image path, error message or None, seconds taken, output paths), in the order given
+    """
+    files = find_images(paths)
+    if not files:
+        print('No images found.')
+        return []
+    start = perf_counter()
+    work = [(path, out_dir, crops or CROPS, fmt) for path in files]
+    if jobs == 1:
+        results = [_batch_job(job) for job in work]
+    else:
+        with Pool(processes=jobs) as pool:
+            results = pool.map(_batch_job, work, chunksize=4)
+
+    print('\n' + Message('Batch gel summary').white())
+    for path, error, seconds, outputs in results:
+        status = Message('Skipped: ' + error).red() if error else Message('Done').green()
+        print('{:>8.2f}s  '.format(seconds) + os.path.basename(path).ljust(40) + ' ' + status)
+    failed = sum(1 for result in results if result[1])
+    print('{} images cropped, {} skipped in {:.2f}s'.format(len(results) - failed, failed, perf_counter() - start))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crop saved Qiaxcel gel images like the clipboard tool does.')
+    parser.add_argument('--batch', nargs='+', required=True, metavar='PATH',
+                        help='image files, or directories of images, to crop')
+    parser.add_argument('--out', default=None, help='output directory (default: a Cropped folder next to each image)')
+    parser.add_argument('--crops', nargs='+', default=CROPS, choices=CROPS, help='crops to make (default: all)')
+    parser.add_argument('--format', default='png', choices=['png', 'bmp'], help='output image format')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (default: CPU count)')
+    args = parser.parse_args()
+    colorama_init()  # Enables coloured text on the windows console.
+    batch(args.batch, out_dir=args.out, crops=args.crops, fmt=args.format, jobs=args.jobs)
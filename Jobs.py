@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Export jobs for Monitor. Export files from auto-processing and from pasted paths are queued and run by a pool of worker
+threads. Exports that fail because the team drive is slow or unavailable are retried with increasing waits.
+"""
+import os
+from collections import deque
+from queue import Queue, Full
+from threading import Lock, Thread
+from time import sleep, monotonic
+
+from Message import Message
+
+
+class Job(object):
+    """One export file and what has happened to it."""
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source        # Str: 'auto' or 'pasted'
+        self.state = 'pending'      # Str: 'pending', 'running', 'retrying', 'done' or 'failed'
+        self.attempts = 0
+        self.error = None           # Str: last error
+        self.queued = monotonic()
+        self.started = self.finished = None
+
+    @property
+    def seconds(self):
+        """Seconds running (or waiting if pending), or taken once finished."""
+        if self.started is None:
+            return monotonic() - self.queued
+        return (self.finished or monotonic()) - self.started
+
+    def __str__(self):
+        line = '  ' + self.state.ljust(10) + os.path.basename(self.path)[:40].ljust(42)
+        line += '{:6.1f} s'.format(self.seconds)
+        if self.attempts > 1:
+            line += '  attempt ' + str(self.attempts)
+        if self.error and self.state in ('retrying', 'failed'):
+            line += '  ' + self.error
+        return line
+
+
+class ExportScheduler(object):
+    """
+    Runs export jobs on a pool of worker threads. The queue is bounded: when it is full, submit() waits for space, so
+    a burst of files slows the watcher's export thread rather than piling up work.
+    """
+    def __init__(self, func, workers=1, size=20, retries=4, backoff=2.0):
+        """
+        :param func: called with the file path to export it, e.g. Export.new
+        :param workers: number of exports run at once
+        :param size: max number of jobs waiting
+        :param retries: times an export is retried after an OSError
+        :param backoff: seconds before the first retry, doubled for each retry after
+        """
+        self.func = func
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue(maxsize=size)
+        self.jobs = []                  # List: pending and running jobs
+        self.finished = deque(maxlen=20)
+        self._lock = Lock()
+
+    def start(self):
+        for n in range(self.workers):
+            Thread(target=self.work, daemon=True).start()
+
+    def submit(self, path, source='auto'):
+        """
+        Queues a file for export, waiting for space if the queue is full.
+        :param path: export file path
+        :param source: str 'auto' or 'pasted', shown by status()
+        :return: Job
+        """
+        job = Job(path, source)
+        with self._lock:
+            self.jobs.append(job)
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            print(Message(''.ljust(25, ' ') + 'Export queue is full, waiting...').yellow())
+            self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            self.run(job)
+            with self._lock:
+                self.jobs.remove(job)
+                self.finished.append(job)
+
+    def run(self, job):
+        """
+        Runs a job, retrying with exponential backoff on OSError, e.g. the team drive being unavailable. A
+        PermissionError, a file open in Excel, fails straight away: it won't go away until the user closes the file.
+        """
+        job.state, job.started = 'running', monotonic()
+        while True:
+            job.attempts += 1
+            try:
+                self.func(job.path)
+                job.state = 'done'
+                break
+            except PermissionError as e:
+                job.state, job.error = 'failed', str(e)
+                print(Message("Couldn't export " + os.path.basename(job.path) + ': ' + str(e)).red())
+                break
+            except OSError as e:
+                job.error = str(e)
+                if job.attempts > self.retries:
+                    job.state = 'failed'
+                    print(Message("Couldn't export " + os.path.basename(job.path) + ': ' + str(e)).red())
+                    break
+                job.state = 'retrying'
+                sleep(self.backoff * 2 ** (job.attempts - 1))
+                job.state = 'running'
+            except (ValueError, TypeError) as e:  # The file is bad, retrying won't help.
+                job.state, job.error = 'failed', str(e)
+                print(e)
+                break
+            except Exception as e:  # Anything else is a bug, fail the job rather than lose the worker thread.
+                job.state, job.error = 'failed', repr(e)
+                print(Message("Couldn't export " + os.path.basename(job.path) + ': ' + repr(e)).red())
+                break
+        job.finished = monotonic()
+
+    def status(self):
+        """Prints pending, running and recently finished jobs with timings."""
+        with self._lock:
+            jobs = list(self.finished) + self.jobs
+        counts = {state: sum(job.state == state for job in jobs) for state in ('pending', 'running', 'failed')}
+        counts['running'] += sum(job.state == 'retrying' for job in jobs)
+        print(''.ljust(25, ' ') + 'Export jobs: {running} running, {pending} pending, {failed} failed'.format(**counts)
+              + ' (' + str(self.workers) + ' workers)')
+        for job in jobs:
+            print(Message(str(job)).red() if job.state == 'failed' else job)
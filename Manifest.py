@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+A local record of every file GenoTools has processed: exports (with the workbook they went to) and notified Viia7 and
+Qiaxcel runs. Files are recorded with their size, modified time and a hash of their contents, so after a restart a
+file that has already been handled is skipped, and what happened to any file can be looked up:
+
+    python Manifest.py 12348_Neo_data.txt
+
+The manifest is an SQLite database, manifest.sqlite in the local GenoTools folder. Each time a file is processed adds a
+row, so its whole history is kept.
+Files are skipped by (path, mtime, size) only, so a new save of a run is notified again. The content hash is only used
+by history(), to find copies and renamed files.
+"""
+import argparse
+import getpass
+import hashlib
+import os
+import platform
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import strftime
+
+from colorama import init as colorama_init
+
+from Config import cache_dir
+from Message import Message
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT NOT NULL, name TEXT COLLATE NOCASE, kind TEXT, size INTEGER, mtime REAL,
+    hash TEXT, status TEXT, output TEXT, error TEXT, processed TEXT, seconds REAL, user TEXT, computer TEXT);
+CREATE INDEX IF NOT EXISTS files_key ON files (path, mtime, size);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+"""
+
+DONE = ('exported', 'notified')  # Statuses of files that don't need processing again.
+
+
+def key(path):
+    """Returns (path, mtime, size) of a file, the same key as Monitor.DedupeCache."""
+    try:
+        stat = os.stat(path)
+        return path, stat.st_mtime, stat.st_size
+    except OSError:
+        return path, None, None
+
+
+def data_hash(data, whole=2 ** 20, sample=2 ** 16):
+    """Returns the file_hash() of a file's contents that have already been read, e.g. by Export.read_export."""
+    if len(data) <= whole:
+        return hashlib.sha1(data).hexdigest()
+    return hashlib.sha1(str(len(data)).encode() + data[:sample] + data[-sample:]).hexdigest()
+
+
+def file_hash(path, whole=2 ** 20, sample=2 ** 16):
+    """
+    Returns the sha1 of a file's contents. Files larger than whole bytes, e.g. .eds runs, are hashed from their size and
+    first and last sample bytes, so hashing a run on the team drive doesn't read all of it.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= whole:
+            sha.update(f.read())
+        else:
+            sha.update(str(size).encode())
+            sha.update(f.read(sample))
+            f.seek(-sample, os.SEEK_END)
+            sha.update(f.read(sample))
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    """
+    The processed files database. The keys of files done are also kept in memory, so checking a file is a set lookup.
+    Each call opens its own connection, so the manifest can be used from any thread and from batch worker processes.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: database file, default manifest.sqlite in Config.cache_dir()
+        """
+        self._path = path
+        self._ready = False
+        self._done = None       # Set: (path, mtime, size) of files done, loaded by seen() the first time
+        self._hashes = OrderedDict()  # Dict: (path, mtime, size): hash of recently read files, see hashed()
+        self._lock = Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(cache_dir(), 'manifest.sqlite')
+        return self._path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            with self._lock:
+                connection.executescript(SCHEMA)
+                self._ready = True
+        return connection
+
+    def load(self):
+        """Reads the keys of the files done into memory."""
+        connection = self.connect()
+        try:
+            rows = connection.execute('SELECT path, mtime, size FROM files WHERE status IN (?, ?)', DONE).fetchall()
+        finally:
+            connection.close()
+        with self._lock:
+            self._done = set(rows)
+
+    def seen(self, file_key):
+        """
+        Returns True if the file has been exported or notified before with the same modified time and size.
+        :param file_key: tuple (path, mtime, size) see key()
+        """
+        if self._done is None:
+            try:
+                self.load()
+            except sqlite3.Error as e:  # Files are processed as if new, rather than not at all.
+                print(Message("Couldn't read the manifest of processed files. " + str(e)).yellow())
+                self._done = set()
+        return file_key in self._done
+
+    def hashed(self, path, digest, keep=100):
+        """
+        Keeps the hash of a file that has been read anyway, so record() doesn't read it again.
+        :param digest: str see data_hash()
+        :param keep: int number of hashes kept, the oldest are dropped
+        """
+        file_key = key(path)
+        with self._lock:
+            self._hashes[file_key] = digest
+            while len(self._hashes) > keep:
+                self._hashes.popitem(last=False)
+
+    def record(self, path, kind, status, output=None, error=None, seconds=None):
+        """
+        Adds a row for a file that has been processed.
+        :param path: file path
+        :param kind: str 'export', 'viia7' or 'qiaxcel'
+        :param status: str 'exported', 'notified', 'failed' or 'pending' (in a Multi export not written yet)
+        :param output: str path of the workbook an export was written to
+        :param error: str or exception, why it failed
+        :param seconds: float time taken
+        """
+        file_key = key(path)
+        with self._lock:
+            digest = self._hashes.get(file_key)
+        if digest is None:
+            try:
+                digest = file_hash(path)
+            except OSError:
+                pass
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT INTO files (path, name, kind, size, mtime, hash, status, output, error, processed, seconds,'
+                    ' user, computer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, os.path.basename(path), kind, file_key[2], file_key[1], digest, status, output,
+                     None if error is None else ' '.join(str(error).split('\n')[:2]), strftime('%Y-%m-%d %H:%M:%S'),
+                     seconds, getpass.getuser(), platform.node()))
+        finally:
+            connection.close()
+        if status in DONE and file_key[1] is not None:
+            with self._lock:
+                if self._done is not None:
+                    self._done.add(file_key)
+
+    def count(self):
+        """Returns the number of files done that are remembered."""
+        self.seen(None)
+        return len(self._done)
+
+    def history(self, term):
+        """
+        Finds what happened to a file, by path or name ignoring case. If the file exists, files with the same contents
+        are found too, e.g. a copy or a renamed file.
+        :param term: str file path or name
+        :return: list of dicts: column: value, oldest first
+        """
+        term = term.strip('\'"')
+        where, args = ['path = ? COLLATE NOCASE', 'name = ?'], [term, os.path.basename(term)]
+        if os.path.isfile(term):
+            try:
+                where.append('hash = ?')
+                args.append(file_hash(term))
+            except OSError:
+                pass
+        connection = self.connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            rows = connection.execute('SELECT * FROM files WHERE ' + ' OR '.join(where) + ' ORDER BY id',
+                                      args).fetchall()
+        finally:
+            connection.close()
+        return [dict(row) for row in rows]
+
+    def print_history(self, term):
+        """Prints the results of history() as a table."""
+        rows = self.history(term)
+        if not rows:
+            print(''.ljust(25, ' ') + 'Nothing is known about ' + term)
+            return
+        print(Message('History of {} ({} rows)'.format(os.path.basename(term.strip('\'"')), len(rows))).white())
+        for row in rows:
+            status = row['status'] or ''
+            status = Message(status.ljust(9)).red() if status == 'failed' else status.ljust(9)
+            line = '  ' + (row['processed'] or '')[:16].ljust(18) + (row['kind'] or '').ljust(9) + status + ' ' + \
+                   row['name'] + ' by ' + str(row['user'])
+            if row['seconds'] is not None:
+                line += ' in {:.1f} s'.format(row['seconds'])
+            print(line)
+            if row['output']:
+                print('      -> ' + row['output'])
+            if row['error']:
+                print('      ' + Message(row['error']).red())
+
+
+manifest = Manifest()  # The manifest shared by Monitor and Export.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show what GenoTools did with a file.')
+    parser.add_argument('file', nargs='+', help='file paths or names')
+    parser.add_argument('--db', default=None, help='database file (default: manifest.sqlite in the local folder)')
+    args = parser.parse_args()
+    colorama_init()  # Enables coloured text on the windows console.
+    if args.db:
+        manifest = Manifest(args.db)
+    for term in args.file:
+        manifest.print_history(term)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import re
+from time import strftime, localtime
+from collections import UserString
+
+from colorama import Fore, Style
+
+
+class Message(UserString):
+
+    def __init__(self, seq):
+        self.data = ''
+        super().__init__(seq)
+
+    def __repr__(self):
+        # for debugging
+        return f'{type(self).__name__}({super().__repr__()})'
+
+    def __radd__(self, other):
+        """
+        Defining a reverse add method so that "string + Message instance" returns a Message instance
+        :param other: str
+        :return: Message()
+        """
+        if isinstance(other, str):
+            return self.__class__(other + self.data)
+        return self.__class__(str(other) + self.data)
+
+    def __str__(self):
+        """
+        String representation of Message(). Here we can add colour highlighting to specific words
+        """
+        new = re.sub(r'Qiaxcel', Fore.MAGENTA + 'Qiaxcel' + Style.RESET_ALL, self.data)
+        new = re.sub(r'\bQ\b', Fore.MAGENTA + 'Q' + Style.RESET_ALL, new)
+        new = re.sub(r'Viia7', Fore.CYAN + 'Viia7' + Style.RESET_ALL, new)
+        new = re.sub(r'\bV\b', Fore.CYAN + 'V' + Style.RESET_ALL, new)
+        new = re.sub(r'\(Toggle\)', Fore.LIGHTBLACK_EX + '(Toggle)' + Style.RESET_ALL, new)
+        new = re.sub(r'\bON\b', Fore.GREEN + 'ON' + Style.RESET_ALL, new)
+        new = re.sub(r'\bOFF\b', Fore.RED + 'OFF' + Style.RESET_ALL, new)
+        return new
+
+    def reset(self):
+        return Message(self.data + Style.RESET_ALL)
+
+    def pre_reset(self):
+        return Message(Style.RESET_ALL + self.data)
+
+    def normal(self):
+        return Message(self.data).pre_reset().reset()
+
+    def white(self):
+        return Message(Style.BRIGHT + self.data + Style.RESET_ALL)
+
+    def white2(self):
+        return Message(Fore.LIGHTWHITE_EX + self.data + Style.RESET_ALL)
+
+    def grey(self):
+        return Message(Fore.LIGHTBLACK_EX + self.data + Style.RESET_ALL)
+
+    def green(self):
+        return Message(Fore.GREEN + self.data + Style.RESET_ALL)
+
+    def cyan(self):  # Viia7 colour
+        return Message(Fore.CYAN + self.data + Style.RESET_ALL)
+
+    def magenta(self):  # Qiaxcel colour
+        return Message(Fore.MAGENTA + self.data + Style.RESET_ALL)
+
+    def red(self):
+        return Message(Fore.RED + self.data + Style.RESET_ALL)
+
+    def yellow(self):
+        return Message(Fore.YELLOW + self.data + Style.RESET_ALL)
+
+    def timestamp(self, machine=None, distinguish=False):
+        """
+        Adds a timestamp to messages
+        :param machine: Str : None, Viia7 or Qiaxcel
+        :param distinguish: bool : Green >>> if true
+        :return: Message() : Highlighted message
+        """
+        # TODO could this make use of the __str__ method?
+        pad = 12  # The .ljust pad value- because colour is added as 0-width characters, this value changes.
+        if machine:  # None, Viia7, Qiaxcel or Export
+            if machine == 'Viia7' or machine == 'Qiaxcel':
+                pad += 9
+                machine = Message(machine)
+
+        if distinguish:
+            pad += 9
+            pref = Message('>>> ').green()
+        else:
+            pref = ' -  '
+        if machine:
+            pref = pref + '{}:'.format(machine)
+        ret = Message(self.bright_time() + pref.ljust(pad, ' '))
+        return Message(ret + self)
+
+    @staticmethod
+    def bright_time():
+        """Returns the current time formatted nicely, flanked by ANSI escape codes for bright text."""
+        return Message(strftime("%d.%m %H:%M ", localtime())).white()
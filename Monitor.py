@@ -1,26 +1,40 @@
 #!/usr/bin/env python3
-import configparser
+from time import sleep, perf_counter, monotonic
+_import_start = perf_counter()  # For --profile-startup
+import atexit
+import getpass
+import importlib
 import os
+import sqlite3
+import sys
 from sys import argv
-import re
 
-from time import sleep, strftime, localtime
 from datetime import datetime, date, timedelta
 import ctypes
-from collections import deque, UserString
-from threading import Lock, Thread
-from io import BytesIO
-import win32clipboard
-import win32file
-
-from watchdog import events, observers
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event, Lock, Thread
+import _thread
+from queue import Queue
+try:
+    import win32file
+except ImportError:  # Not Windows. Export watching and notifications still work, the clipboard tools don't.
+    win32file = None
+
+from watchdog import events
 from watchdog.observers.api import DEFAULT_OBSERVER_TIMEOUT, BaseObserver
-from colorama import Fore, Style, init as colorama_init
-from pandas.io import clipboard
-from PIL import ImageGrab
+from colorama import init as colorama_init
 import PIL  # required by openpyxl to allow handling of xlsx files with images in them
 
-import Export
+import Clipboard
+import Config
+import Emitters
+import Gel
+import Jobs
+import Manifest
+import Results
+import Stats
+from Message import Message
 
 __version__ = '14.08.2019'
 
@@ -65,114 +79,32 @@ class Counter(object):
             return ''.ljust(25, ' ') + self._machine + ' Notify OFF'
 
 
-class Message(UserString):
-
-    def __init__(self, seq):
-        self.data = ''
-        super().__init__(seq)
-
-    def __repr__(self):
-        # for debugging
-        return f'{type(self).__name__}({super().__repr__()})'
-
-    def __radd__(self, other):
-        """
-        Defining a reverse add method so that "string + Message instance" returns a Message instance
-        :param other: str
-        :return: Message()
-        """
-        if isinstance(other, str):
-            return self.__class__(other + self.data)
-        return self.__class__(str(other) + self.data)
-
-    def __str__(self):
-        """
-        String representation of Message(). Here we can add colour highlighting to specific words
-        """
-        new = re.sub(r'Qiaxcel', Fore.MAGENTA + 'Qiaxcel' + Style.RESET_ALL, self.data)
-        new = re.sub(r'\bQ\b', Fore.MAGENTA + 'Q' + Style.RESET_ALL, new)
-        new = re.sub(r'Viia7', Fore.CYAN + 'Viia7' + Style.RESET_ALL, new)
-        new = re.sub(r'\bV\b', Fore.CYAN + 'V' + Style.RESET_ALL, new)
-        new = re.sub(r'\(Toggle\)', Fore.LIGHTBLACK_EX + '(Toggle)' + Style.RESET_ALL, new)
-        new = re.sub(r'\bON\b', Fore.GREEN + 'ON' + Style.RESET_ALL, new)
-        new = re.sub(r'\bOFF\b', Fore.RED + 'OFF' + Style.RESET_ALL, new)
-        return new
-
-    def reset(self):
-        return Message(self.data + Style.RESET_ALL)
-
-    def pre_reset(self):
-        return Message(Style.RESET_ALL + self.data)
-
-    def normal(self):
-        return Message(self.data).pre_reset().reset()
-
-    def white(self):
-        return Message(Style.BRIGHT + self.data + Style.RESET_ALL)
-
-    def white2(self):
-        return Message(Fore.LIGHTWHITE_EX + self.data + Style.RESET_ALL)
-
-    def grey(self):
-        return Message(Fore.LIGHTBLACK_EX + self.data + Style.RESET_ALL)
-
-    def green(self):
-        return Message(Fore.GREEN + self.data + Style.RESET_ALL)
-
-    def cyan(self):  # Viia7 colour
-        return Message(Fore.CYAN + self.data + Style.RESET_ALL)
-
-    def magenta(self):  # Qiaxcel colour
-        return Message(Fore.MAGENTA + self.data + Style.RESET_ALL)
-
-    def red(self):
-        return Message(Fore.RED + self.data + Style.RESET_ALL)
-
-    def yellow(self):
-        return Message(Fore.YELLOW + self.data + Style.RESET_ALL)
-
-    def timestamp(self, machine=None, distinguish=False):
-        """
-        Adds a timestamp to messages
-        :param machine: Str : None, Viia7 or Qiaxcel
-        :param distinguish: bool : Green >>> if true
-        :return: Message() : Highlighted message
-        """
-        # TODO could this make use of the __str__ method?
-        pad = 12  # The .ljust pad value- because colour is added as 0-width characters, this value changes.
-        if machine:  # None, Viia7, Qiaxcel or Export
-            if machine == 'Viia7' or machine == 'Qiaxcel':
-                pad += 9
-                machine = Message(machine)
-
-        if distinguish:
-            pad += 9
-            pref = Message('>>> ').green()
-        else:
-            pref = ' -  '
-        if machine:
-            pref = pref + '{}:'.format(machine)
-        ret = Message(self.bright_time() + pref.ljust(pad, ' '))
-        return Message(ret + self)
-
-    @staticmethod
-    def bright_time():
-        """Returns the current time formatted nicely, flanked by ANSI escape codes for bright text."""
-        return Message(strftime("%d.%m %H:%M ", localtime())).white()
-
-
 class LabHandler(events.PatternMatchingEventHandler):  # inheriting from watchdog's PatternMatchingEventHandler
     patterns = ['*.xdrx', '*.eds', '*.txt']  # Events are only generated for these file types.
 
     def __init__(self):
         super(LabHandler, self).__init__()
-        self.recent_events = deque('ghi', maxlen=30)  # A list of recent events to prevent duplicate messages.
+        self.recent_events = DedupeCache(ttl=config.getfloat('Watcher', 'DedupeTTL', fallback=600),
+                                         size=config.getint('Watcher', 'DedupeSize', fallback=1000),
+                                         manifest=Manifest.manifest)
         self.error_message = deque(maxlen=1)
         self.v_counter = Counter(machine='Viia7')
         self.q_counter = Counter(machine='Qiaxcel')
         self._auto_export = True
         self._user_only = False
-        self.user = os.getlogin()
+        self.user = getpass.getuser()
+        self.tracker = ReadyTracker(window=config.getfloat('Watcher', 'Stable', fallback=1))
+        self.viia7_runs = Queue()   # Ready .eds events, see viia7_done()
+        self.exports = Queue()      # Ready export file paths, see auto_process()
+        self.notified = Queue()     # (path, kind, seconds) of notified runs, see remember()
+        self.consumers = [Consumer(self.viia7_runs, self.viia7_done), Consumer(self.exports, self.auto_process),
+                          Consumer(self.notified, self.remember)]
+
+    def start(self):
+        """Starts the threads that wait for files to be ready and process them."""
+        self.tracker.start()
+        for consumer in self.consumers:
+            consumer.start()
 
     """
     The Observer passes events to the handler (this class), which then calls functions based on the type of event
@@ -186,44 +118,74 @@ class LabHandler(events.PatternMatchingEventHandler):  # inheriting from watchdo
     """
 
     def on_modified(self, event):
-        """Called when a modified event is detected. aka Viia7 events."""
-
-        sleep(1)  # wait here to allow file to be fully written - prevents some errors with os.stat
-        if '.eds' in event.src_path and event.src_path not in self.recent_events:  # .eds files we haven't seen recently
-            if self.is_large_enough(event.src_path):  # this is here instead of ^ to prevent double error message
-                with v_lock:
-                    self.v_counter.count = self.notif(event, self.v_counter.count)
+        """Called when a modified event is detected. aka Viia7 events. The run is reported once the file is ready."""
+        if '.eds' in event.src_path:
+            self.tracker.add(event.src_path, self.viia7_runs, (event, Stats.Stages('Viia7', event.src_path)))
+
+    def viia7_done(self, item):
+        """Called by a Consumer when an .eds file has finished being written."""
+        event, timings = item
+        timings.add('ready', perf_counter() - timings.start)
+        # .eds files we haven't seen recently. is_large_enough is checked after to prevent double error message
+        if not self.recent_events.check(event.src_path) and self.is_large_enough(event.src_path):
+            start = perf_counter()
+            with v_lock:
+                self.v_counter.count = self.notif(event, self.v_counter.count)
+            timings.add('notify', perf_counter() - start)
+            timings.write()
+            self.notified.put((event.src_path, 'viia7', perf_counter() - timings.start))
 
     def on_created(self, event):
         """Called when a new file is created. aka Qiaxcel/ Export events."""
 
-        if '.xdrx' in event.src_path and event.src_path not in self.recent_events:  # .xdrx file we haven't seen
+        if '.xdrx' in event.src_path and not self.recent_events.check(event.src_path):  # .xdrx file we haven't seen
+            timings = Stats.Stages('Qiaxcel', event.src_path)
             with q_lock:
                 self.q_counter.count = self.notif(event, self.q_counter.count)
+            timings.add('notify', perf_counter() - timings.start)
+            timings.write()
+            self.notified.put((event.src_path, 'qiaxcel', perf_counter() - timings.start))
         if '.txt' in event.src_path and self.user in event.src_path \
                 and "Export" in event.src_path and self._auto_export:
-            sleep(0.3)  # wait here to allow file to be fully written # increase if timeout happens a lot
-            try:
-                export.new(event.src_path)
-            except OSError:  # if team drive is being slow, wait longer.
-                sleep(4)
-                export.new(event.src_path)
-            except ValueError as e:  # When the exported file is bad
-                print(e)
+            self.tracker.add(event.src_path, self.exports)  # Exported once the file has been fully written.
+
+    def auto_process(self, path):
+        """
+        Called by a Consumer when an export file has finished being written. Queues it as an export job, unless it has
+        been exported before, e.g. before a restart.
+        """
+        if self.recent_events.check(path):
+            print(Message(' Already exported ' + os.path.basename(path)).timestamp(machine='Export'))
+            return
+        scheduler.submit(path, 'auto')
+
+    @staticmethod
+    def remember(item):
+        """
+        Called by a Consumer with (path, kind, seconds) of a notified run. Adds it to the manifest, so it isn't notified
+        again after a restart, see Manifest. Hashing the run reads the team drive, so it isn't done on the watcher's
+        thread.
+        """
+        path, kind, seconds = item
+        try:
+            Manifest.manifest.record(path, kind, 'notified', seconds=seconds)
+        except (sqlite3.Error, OSError) as e:
+            print(Message("Couldn't add the run to the manifest. " + str(e)).yellow())
 
     def notif(self, event, x_counter):
         """Prints a notification about the event to console. May be normal or distinguished.
          Distinguished notifications flash the console window.
          Notif will be distinguished if users windows login is in path or x_counter = 1 or > 9 (now/ always setting)"""
 
-        self.recent_events.append(event.src_path)  # Add to recent events queue to prevent duplicate notifications.
         machine, file = self.get_event_info(event)
 
-        if os.getlogin() in event.src_path.lower() or x_counter == 1 or x_counter > 9:  # distinguished notif
+        if self.user in event.src_path.lower() or x_counter == 1 or x_counter > 9:  # distinguished notif
 
             file = Message(file).green()
             message = ' {} has finished!'.format(file)
-            ctypes.windll.user32.FlashWindow(ctypes.windll.kernel32.GetConsoleWindow(), True)  # Flash console window
+            if os.name == 'nt':
+                # Flash console window
+                ctypes.windll.user32.FlashWindow(ctypes.windll.kernel32.GetConsoleWindow(), True)
             print(Message(message).timestamp(machine, distinguish=True))
 
         elif not self._user_only:  # non distinguished notification
@@ -259,7 +221,7 @@ class LabHandler(events.PatternMatchingEventHandler):  # inheriting from watchdo
     def get_event_info(event):
         """Returns the machine name and file path."""
         machine = 'Viia7' if event.event_type == 'modified' else 'Qiaxcel'
-        file = str(os.path.splitext(event.src_path)[0].split('\\')[-1])  # Get file name
+        file = os.path.splitext(os.path.basename(event.src_path))[0]  # Get file name
         return machine, file
 
     @staticmethod
@@ -268,7 +230,7 @@ class LabHandler(events.PatternMatchingEventHandler):  # inheriting from watchdo
         try:
             return os.stat(path).st_size > 1300000
         except (FileNotFoundError, OSError) as e:
-            file = str(os.path.splitext(path)[0].split('\\')[-1])
+            file = os.path.splitext(os.path.basename(path))[0]
             print(Message(e).red())  # If not, print error, assume True.
             print(Message(file + " wasn't saved properly! You'll need to analyse "
                                  "and save the run again from the machine.").timestamp())
@@ -276,15 +238,142 @@ class LabHandler(events.PatternMatchingEventHandler):  # inheriting from watchdo
             return True  # Better to inform than not. I think this happens when .eds isn't saved or is deleted?
 
 
+class DedupeCache(object):
+    """
+    Files that have recently been notified, to prevent duplicate messages. Files are keyed on (path, mtime, size), so a
+    new save of the same file is notified again. Entries expire after ttl seconds, and the oldest are dropped after size
+    entries. Files handled before a restart are found in the manifest. hits and misses count duplicates found and new
+    files, see status().
+    """
+    def __init__(self, ttl=600, size=1000, manifest=None):
+        self.ttl = ttl
+        self.size = size
+        self.manifest = manifest    # Manifest.Manifest: of files processed, kept across restarts
+        self.hits = self.misses = 0
+        self._seen = OrderedDict()  # Dict: (path, mtime, size): expiry time, oldest first
+        self._lock = Lock()
+
+    key = staticmethod(Manifest.key)
+
+    def check(self, path):
+        """
+        Returns True if path has been seen recently, or is in the manifest, with the same mtime and size, else records
+        it and returns False.
+        """
+        key = self.key(path)  # stat outside the lock, it can be slow on the team drive.
+        now = monotonic()
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) <= now:  # expire old entries
+                self._seen.popitem(last=False)
+            if key in self._seen or (self.manifest is not None and key[1] is not None and self.manifest.seen(key)):
+                self.hits += 1
+                return True
+            self.misses += 1
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+            return False
+
+    def status(self):
+        print(''.ljust(25, ' ') + 'Duplicate events: {} hits, {} misses, {} files remembered (ttl {}s, max {})'.format(
+            self.hits, self.misses, len(self._seen), self.ttl, self.size))
+        if self.manifest is not None:
+            print(''.ljust(25, ' ') + '{} processed files in the manifest, see History'.format(self.manifest.count()))
+
+
+class ReadyTracker(Thread):
+    """
+    Waits for files to finish being written, without holding up watchdog's event thread. A file is ready once its size
+    and mtime haven't changed for window seconds, it is then put on the queue it was added with.
+    """
+    def __init__(self, window=1.0, interval=0.25, timeout=120):
+        """
+        :param window: seconds a file's size and mtime must stay the same
+        :param interval: seconds between checks
+        :param timeout: seconds after which a file is released even if it never became stable, e.g. it was deleted
+        """
+        super(ReadyTracker, self).__init__()
+        self.daemon = True
+        self.window = window
+        self.interval = interval
+        self.timeout = timeout
+        self._pending = {}  # Dict: path: [queue, item, (size, mtime) or None, stable since, added]
+        self._lock = Lock()
+        self._stopping = False
+
+    def add(self, path, queue, item=None):
+        """
+        Tracks path until it is ready, then puts item on queue. Adding a path that is already tracked does nothing.
+        :param path: file path
+        :param queue: queue.Queue to put item on
+        :param item: what to put on queue, default the path
+        """
+        now = monotonic()
+        with self._lock:
+            if path not in self._pending:
+                self._pending[path] = [queue, path if item is None else item, None, now, now]
+
+    def run(self):
+        while not self._stopping:
+            sleep(self.interval)
+            for queue, item in self.check():
+                queue.put(item)
+
+    def check(self):
+        """Stats every tracked file once and returns [(queue, item)] for the files that are ready."""
+        with self._lock:
+            pending = list(self._pending.items())
+        now = monotonic()
+        ready = []
+        for path, entry in pending:  # stat outside the lock, it can be slow on the team drive.
+            try:
+                stat = os.stat(path)
+                size_mtime = (stat.st_size, stat.st_mtime)
+            except OSError:
+                size_mtime = None
+            if size_mtime != entry[2]:
+                entry[2], entry[3] = size_mtime, now
+            elif size_mtime is not None and now - entry[3] >= self.window:
+                ready.append(path)
+                continue
+            if now - entry[4] >= self.timeout:
+                ready.append(path)
+        with self._lock:
+            return [self._pending.pop(path)[:2] for path in ready]
+
+    def stop(self):
+        self._stopping = True
+
+
+class Consumer(Thread):
+    """Thread that calls func with each item put on queue, so slow work doesn't hold up the thread that queued it."""
+    def __init__(self, queue, func):
+        super(Consumer, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.func = func
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.func(item)
+            except Exception as e:  # Keep consuming, a dead thread would silently stop notifications or exports.
+                print(Message(repr(e)).red())
+
+
 class Egel(object):
     _original = ''
+    _boxes = None  # Dict: crop type: box, see Gel.detect
+
+    def __init__(self, clipboard):
+        self.clipboard = clipboard  # Clipboard.ClipboardProvider
 
     def grab(self):
         # Retrieves image from clipboard and makes sure the image is the right size
-        new = ImageGrab.grabclipboard()
-        # Alternate values may need to be added here, for some reason Shaheen's PC produces an image 1 px
-        # taller than everyone else's (505px). I haven't tested other dpis
-        assert (new.size[1] in {1575, 788, 504, 505, 394})  # These are the height values for different image dpi levels
+        new = self.clipboard.grab_image()
+        assert Gel.is_gel(new)
+        self._boxes = Gel.detect(new)[0]  # The scale and lane edges, or the fixed ratios if they aren't all found
         self._original = new
 
     def get(self):
@@ -310,35 +399,11 @@ class Egel(object):
             pass
 
     def crop(self, crop_type='standard'):
-        # crop is a box within an image defined in pixels (left, top, right, bottom)
-        crops = {'small': (self._original.size[1] / 5.54,       # Samples without scale
-                           self._original.size[1] / 71.7,
-                           self._original.size[0] - self._original.size[1] / 5.325,
-                           self._original.size[1]),
-                 'scale': (0,                                   # Scale only
-                           self._original.size[1] / 71.7,
-                           self._original.size[1] / 5.54,
-                           self._original.size[1]),
-                 'standard': (self._original.size[1] / 5.54,    # Samples with scale attached
-                              self._original.size[1] / 71.7,
-                              self._original.size[0] - self._original.size[1] / 168,
-                              self._original.size[1])}
-        img = self._original.crop(crops[crop_type])
-        img = img.rotate(270, expand=True)
-        img_out = BytesIO()
-        img.convert("RGB").save(img_out, "BMP")
-        img_final = img_out.getvalue()[14:]  # the first 15 bytes are header.
-        img_out.close()
-        return img_final
+        """Returns the cropped image ready for the clipboard, see Gel.crop()."""
+        return Gel.to_dib(Gel.crop(self._original, crop_type, self._boxes))
 
-    @staticmethod
-    def send_to_clipboard(*args):
-        for item in args:  # Can send multiple images to clipboard one after another.
-            win32clipboard.OpenClipboard()
-            win32clipboard.EmptyClipboard()
-            win32clipboard.SetClipboardData(win32clipboard.CF_DIB, item)
-            win32clipboard.CloseClipboard()
-            sleep(0.05)  # small wait for Office Clipboard.
+    def send_to_clipboard(self, *args):
+        self.clipboard.set_images(*args)  # Can send multiple images to clipboard one after another.
         print(''.ljust(25, ' ') + 'Clipboard image processed.')
 
 
@@ -346,48 +411,46 @@ class ClipboardWatcher(Thread):
     """
     Thread that watches the clipboard for Qiaxcel images and edits them for pasting into summary files.
     """
-    def __init__(self):
-        super(ClipboardWatcher, self).__init__()
-        self._wait = 1.5  # How often to check the clipboard, can be safely reduced if needed.
+    def __init__(self, clipboard):
+        """
+        :param clipboard: Clipboard.ClipboardProvider, e.g. Clipboard.WindowsClipboard, or None if there isn't one.
+        """
+        super(ClipboardWatcher, self).__init__(daemon=True)
+        self.clipboard = clipboard
         self._paused = False
-        self._stopping = False
-        self.image = Egel()
+        self.image = Egel(clipboard)
 
     def run(self):
         """
-        win32clipboard.GetClipboardSequenceNumber() changes every time the clipboard is used.
-        We check if it has changed and attempt to process if it has.
+        Waits for the clipboard to change and attempts to process it. The provider wakes the thread on each change,
+        so there is no polling.
         """
-        recent_value = win32clipboard.GetClipboardSequenceNumber()
-        while not self._stopping:
-            tmp_value = win32clipboard.GetClipboardSequenceNumber()
-            if not tmp_value == recent_value and not self._paused:  # if the clipboard has changed
-                recent_value = tmp_value
-                try:
-                    self.image.grab()
-                    self.image.get()
-                except AttributeError:
-                    pass  # given when clipboard object is not an image. Ignore
-                except AssertionError:
-                    pass  # given when image is not the right size. Ignore
-            else:
-                sleep(self._wait)
+        self.clipboard.start()
+        while self.clipboard.wait():
+            if self._paused:
+                continue
+            try:
+                self.image.grab()
+                self.image.get()
+            except AttributeError:
+                pass  # given when clipboard object is not an image. Ignore
+            except AssertionError:
+                pass  # given when image is not the right size. Ignore
 
     def toggle(self):
         """
-        Toggles image editing and reduces the poll rate.
+        Toggles image editing.
         :return:
         """
         self._paused = not self._paused
         if self._paused:
-            self._wait = 10
             print(Message(''.ljust(25, ' ') + 'Clipboard watcher OFF'))
         else:
-            self._wait = 2.
             print(Message(''.ljust(25, ' ') + 'Clipboard watcher ON'))
 
     def stop(self):
-        self._stopping = True
+        if self.clipboard is not None:
+            self.clipboard.stop()
 
 
 class InputLoop(Thread):
@@ -403,10 +466,10 @@ class InputLoop(Thread):
             labhandler.user_only: ['mine'],
             labhandler.show_all: ['all'],
             labhandler.auto_export: ['auto'],
-            export.multi_off: ['done', 'stop'],
-            export.multi_toggle: ['multi', 'mutli'],
-            export.last_file: ['last', 'prev', 'previous', 'last file', 'lastfile'],
-            export.to_file: ['to file', 'tofile', 'file'],
+            export.method('multi_off'): ['done', 'stop'],
+            export.method('multi_toggle'): ['multi', 'mutli'],
+            export.method('last_file'): ['last', 'prev', 'previous', 'last file', 'lastfile'],
+            export.method('to_file'): ['to file', 'tofile', 'file'],
             egel_watcher.toggle: ['egels', 'images', 'clip'],
             egel_watcher.image.get_scale: ['scale'],
             egel_watcher.image.get: ['egel'],
@@ -416,6 +479,9 @@ class InputLoop(Thread):
             self.stop: ['quit', 'exit', 'QQ', 'quti'],
             self.print_help: ['help', 'hlep'],
             watch.restart_observers: ['restart'],
+            scheduler.status: ['queue', 'status', 'jobs'],
+            labhandler.recent_events.status: ['dedupe', 'duplicates'],
+            Stats.log.print_stats: ['stats'],
         }
 
     def run(self):
@@ -423,19 +489,24 @@ class InputLoop(Thread):
         while not self._stopping:
             inp = self.get_input()
             if os.path.isfile(inp):
-                try:
-                    export.new(inp)
-                except TypeError:  # If the txt file is bad, export.py returns a NoneType, which causes this exception
-                    pass
-                except ValueError as e:
-                    print(e)
+                scheduler.submit(inp, 'pasted')
+            elif inp.lower().startswith('find '):  # find <mouse, plate barcode or assay>
+                Results.store.print_query(inp[5:])
+            elif inp.lower().startswith('history '):  # history <file path or name>
+                Manifest.manifest.print_history(inp[8:])
+            elif inp.lower().split(' ')[0] in ('missed', 'backfill'):  # missed/backfill [days or dates]
+                command, _, dates = inp.partition(' ')
+                backfill.missed(dates) if command.lower() == 'missed' else backfill.start(dates)
             else:
                 inp = inp.lower()
                 # Lookup command in instructions and call the method
                 cont = False
                 for key in self.instructions:
                     if inp in self.instructions[key]:
-                        key()
+                        try:
+                            key()
+                        except RuntimeError as e:  # The export engine failed to load, see ExportLoader.wait
+                            print(Message(str(e)).red())
                         cont = True
                         break
                 if cont:
@@ -472,6 +543,7 @@ class InputLoop(Thread):
         """
         inp = input('')
         if not inp:  # if blank input, read clipboard.
+            from pandas.io import clipboard  # Imported here, pandas is loaded in the background by ExportLoader.
             inp = clipboard.clipboard_get()
         inp = os.path.normpath(inp.strip('\'"'))
         inp = inp.strip()
@@ -501,6 +573,12 @@ class InputLoop(Thread):
                 'Done': ': Stop Multi export mode',
                 'ToFile': ': Export to a pre-existing file',
                 'Last': ': Export to the previous file',
+                'Queue': ': Show queued, running and failed exports',
+                'Stats': ': Show how long exports and notifications take',
+                'Find + ' + Message('name').yellow(): ': Results for a mouse, plate barcode or assay',
+                'History + ' + Message('file').yellow(): ': What happened to a file',
+                'Missed + ' + Message('days').yellow(): ': List your export files never processed',
+                'Backfill + ' + Message('days').yellow(): ': Process your missed export files',
                 'Images': ': Auto-process Qiaxcel images       ' + '(Toggle)'},
             'Other': {
                 'Install':   ': Start on Windows Startup',
@@ -564,9 +642,122 @@ class InputLoop(Thread):
 
     def stop(self):
         self._stopping = True
+        export.close()  # Save any unfinished Multi export.
         watch.stop_observe()
 
 
+class ExportLoader(Thread):
+    """
+    Loads the export engine (numpy, pandas, openpyxl and Export) in a background thread, so the watchers and
+    notifications start straight away. Export attributes can be used as normal, e.g. export.new(inp), they wait for
+    loading to finish the first time.
+    """
+    modules = ['numpy', 'pandas', 'openpyxl', 'Export']
+
+    def __init__(self):
+        super(ExportLoader, self).__init__()
+        self.daemon = True
+        self.export = None      # Export.Export: once loaded
+        self.timings = []       # List: (stage, seconds) for --profile-startup
+        self.error = None       # Exception: why loading failed
+        self._ready = Event()
+
+    def run(self):
+        try:
+            for name in self.modules:
+                start = perf_counter()
+                importlib.import_module(name)
+                self.timings.append(('import ' + name, perf_counter() - start))
+            start = perf_counter()
+            self.export = sys.modules['Export'].Export()
+            self.timings.append(('Export()', perf_counter() - start))
+        except SystemExit:  # Export quits if the Assays or Formulas file is missing, so quit the program too.
+            _thread.interrupt_main()
+        except Exception as e:  # Watchers and notifications keep running, exports fail with this error.
+            self.error = e
+            print(Message("Couldn't load the export engine, files won't be exported. " + repr(e)).red())
+        finally:
+            self._ready.set()
+
+    def wait(self):
+        """
+        Waits for the engine to load and returns the Export instance.
+        :raises RuntimeError: if the engine failed to load
+        """
+        self._ready.wait()
+        if self.error is not None:
+            raise RuntimeError("The export engine failed to load: " + repr(self.error)) from self.error
+        return self.export
+
+    def method(self, name):
+        """Returns a function that calls Export.name, so commands can be set up before the engine has loaded."""
+        return lambda *args: getattr(self.wait(), name)(*args)
+
+    def close(self):
+        """Saves any unfinished Multi export. Nothing to do if the engine hasn't loaded."""
+        if self.export is not None:
+            self.export.close()
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
+
+
+def month_start(day, months=0):
+    """
+    Returns the first day of day's month.
+    :param day: date or datetime
+    :param months: int months to move by, e.g. -1 for last month, 1 for next month.
+    """
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class MonthFolders(object):
+    """
+    Finds the month folders of Experiments and Results Export. Month names are set by people and therefore don't follow
+    a consistent scheme: 'Aug 2019', 'August 2019' and 'Sept 2019' are all looked for. Found folders are cached for
+    each (folder, month), so the team drive is only probed again for folders that haven't been found yet.
+    """
+    def __init__(self):
+        self._paths = {}  # Dict: (folder, first day of month): path
+        self._lock = Lock()
+
+    @staticmethod
+    def names(month):
+        """Returns the month names a folder may use, in the order they are looked for. The first is for new folders."""
+        names = [month.strftime('%b'), month.strftime('%B')]
+        if names[0] == 'Sep':
+            names.append('Sept')
+        return names
+
+    def find(self, folder, month, makedirs=False):
+        """
+        Returns the path of a month's folder, from the cache if it has been found before.
+        :param folder: str 'Experiments' or 'Export'
+        :param month: date in the month
+        :param makedirs: bool create the folder if it isn't found.
+        :return: str file path see Watcher.build_path(), or None if not found.
+        """
+        key = (folder, month_start(month))
+        with self._lock:
+            if key in self._paths:
+                return self._paths[key]
+        year = str(key[1].year)
+        paths = [Watcher.build_path(name, year, folder) for name in self.names(key[1])]
+        path = next((path for path in paths if os.path.isdir(path)), None)
+        if path is None and makedirs:
+            path = paths[0]
+            os.makedirs(path, exist_ok=True)
+        if path is not None:
+            with self._lock:
+                self._paths[key] = path
+        return path
+
+    def clear(self):
+        with self._lock:
+            self._paths.clear()
+
+
 class Watcher(Thread):
     """
     This class contains all observer functionality and checks and changes the state.
@@ -574,24 +765,41 @@ class Watcher(Thread):
     def __init__(self):
         super().__init__()
         self._stopping = False
-        self.obs = BaseObserver(emitter_class=MyEmitter, timeout=DEFAULT_OBSERVER_TIMEOUT)
-        self.date = strftime("%b %Y", localtime())  # for checking when month changes
+        self.obs = self.observer()
+        self.folders = MonthFolders()
+        self.month = month_start(date.today())  # for checking when month changes
+        self.rollover = self.next_rollover()
+        config.subscribe(self.paths_changed, sections=['File paths'])
 
         self.q_watch = self.experiment_curr = self.export_curr = self.experiment_last = self.export_last = None
         self.set_watch()
 
+    @staticmethod
+    def observer():
+        """Returns a new observer, using the emitter backend set in config.ini, see Emitters."""
+        emitter = Emitters.emitter_class(config.get('Watcher', 'Backend', fallback='auto'),
+                                         config.getfloat('Watcher', 'Settle', fallback=2))
+        return BaseObserver(emitter_class=emitter, timeout=DEFAULT_OBSERVER_TIMEOUT)
+
     def set_watch(self):
         # Schedule observer watch locations
         self.q_watch = self.obs.schedule(labhandler, path=config['File paths']['QIAxcel'])
-        self.experiment_curr = self.obs.schedule(labhandler, path=self.get_path("Experiments"))
-        self.export_curr = self.obs.schedule(labhandler, path=self.get_path("Export"))
-
-        experiment_path_last = self.get_path("Experiments", last_month=True)
-        export_path_last = self.get_path("Export", last_month=True)
-        self.experiment_last = self.obs.schedule(labhandler, path=experiment_path_last) \
-            if experiment_path_last is not None else False
-        self.export_last = self.obs.schedule(labhandler, path=export_path_last) \
-            if export_path_last is not None else False
+        self.experiment_curr = self.schedule_month("Experiments")
+        self.export_curr = self.schedule_month("Export")
+        self.experiment_last = self.schedule_month("Experiments", last_month=True)
+        self.export_last = self.schedule_month("Export", last_month=True)
+
+    def paths_changed(self, changed):
+        """Called by config when File paths change. Moves the watches to the new folders, the observer keeps running."""
+        if not changed & {('File paths', 'genotyping'), ('File paths', 'qiaxcel')}:
+            return
+        print('Watch folders changed in config.ini')
+        self.obs.unschedule_all()
+        self.folders.clear()
+        try:
+            self.set_watch()
+        except OSError as e:
+            print(Message("Can't watch the new folders: " + str(e)).red())
 
     def status(self):
         print('Observer Running') if self.obs.is_alive() else print('Observer Stopped')
@@ -602,30 +810,59 @@ class Watcher(Thread):
         while not self._stopping:  # Check if something has changed
             if local:
                 self.check_update_local()
-            if self.date != strftime("%b %Y", localtime()):  # If month has changed.
-                self.update_month()
             for n in range(600):  # a 10 minute loop
+                if datetime.now() >= self.rollover:  # Checked every second, so the new month is watched straight away.
+                    self.update_month()
                 if n % 30 == 0:  # every 30 seconds
                     self.check_update()
+                    self.find_next_month()
                 if self._stopping:
                     break
                 sleep(1)
 
+    def next_rollover(self):
+        """Returns the datetime the next month starts."""
+        start = month_start(self.month, 1)
+        return datetime(start.year, start.month, start.day)
+
+    def find_next_month(self, hours=1):
+        """
+        Looks for next month's folders in the last hours before the rollover, so they are already cached when the month
+        changes. Folders that haven't been made yet are made at the rollover.
+        """
+        if self.rollover - datetime.now() < timedelta(hours=hours):
+            for folder in ("Experiments", "Export"):
+                self.folders.find(folder, self.rollover)
+
     def update_month(self):
         """
-        Called when the month has changed. Updates which folders are being watched for file changes.
+        Called when the month has changed. Updates which folders are being watched for file changes. Only the month
+        watches are changed, the observer and other watches keep running.
         """
-        self.date = strftime("%b %Y", localtime())  # Update month
-        print('The month has changed to ' + self.date)
+        old = self.month
+        self.month = month_start(date.today())  # Update month
+        self.rollover = self.next_rollover()
+        print('The month has changed to ' + self.month.strftime('%b %Y'))
 
         if self.experiment_last:
             self.obs.unschedule(self.experiment_last)  # Unschedule last month watch
         if self.export_last:
             self.obs.unschedule(self.export_last)
-        self.experiment_last = self.experiment_curr  # Make current month watch last month
-        self.export_last = self.export_curr
-        self.experiment_curr = self.obs.schedule(labhandler, self.get_path("Experiments"))  # Schedule new current month
-        self.export_curr = self.obs.schedule(labhandler, self.get_path("Export"))
+        if month_start(self.month, -1) == old:
+            self.experiment_last = self.experiment_curr  # Make current month watch last month
+            self.export_last = self.export_curr
+        else:  # More than a month has passed, e.g. the computer was asleep.
+            self.obs.unschedule(self.experiment_curr)
+            self.obs.unschedule(self.export_curr)
+            self.experiment_last = self.schedule_month("Experiments", last_month=True)
+            self.export_last = self.schedule_month("Export", last_month=True)
+        self.experiment_curr = self.schedule_month("Experiments")  # Schedule new current month
+        self.export_curr = self.schedule_month("Export")
+
+    def schedule_month(self, folder, last_month=False):
+        """Schedules a watch on this or last month's folder. Returns the watch, or False if the folder wasn't found."""
+        path = self.get_path(folder, last_month)
+        return self.obs.schedule(labhandler, path=path) if path is not None else False
 
     @staticmethod
     def check_update():
@@ -634,10 +871,7 @@ class Watcher(Thread):
         in the config.ini. This is possible and necessary because this program is normally run from
         an exe on a network share, therefore cannot update if it is in use.
         """
-        if os.path.isfile(os.getcwd() + '/config.ini'):  # may have changed.
-            config.read(os.getcwd() + '/config.ini')
-        else:
-            config.read(os.path.normpath(os.path.dirname(argv[0]) + '/config.ini'))
+        config.reload()  # may have changed. Only re-read if it has been saved since last time.
 
         start = datetime.strptime(config['Update']['Start'], '%d.%m.%Y %H:%M')
         end = datetime.strptime(config['Update']['End'], '%d.%m.%Y %H:%M')
@@ -649,8 +883,8 @@ class Watcher(Thread):
 
     @staticmethod
     def check_update_local():
-        master = configparser.ConfigParser()
-        master.read(config['File paths']['master'] + '/config.ini')
+        master = Config.shared(config['File paths']['master'] + '/config.ini')
+        master.reload()
         if not master['Update']['Version'] == __version__:
             print('Please update to the latest version of the program!')
 
@@ -662,29 +896,10 @@ class Watcher(Thread):
         :param last_month: bool if true returns path for last month.
         :return: str file path see build_path()
         """
-        makedirs = True
-        date_t = date.today()
-        if last_month:
-            makedirs = False
-            first = date_t.replace(day=1)  # replace the day with the first of the month.
-            date_t = first - timedelta(days=1)  # subtract one day to get the last day of last month
-        month, year = date_t.strftime('%b %Y').split(' ')
-        path = self.build_path(month, year, folder)
-        if os.path.isdir(path):
-            return path
-        month_full = date_t.strftime('%B')
-        path2 = self.build_path(month_full, year, folder)
-        if os.path.isdir(path2):
-            return path2
-        if month == 'Sep':
-            path2 = self.build_path('Sept', year, folder)
-            if os.path.isdir(path2):
-                return path2
-        if makedirs:
-            os.makedirs(path, exist_ok=True)
-            return path
-        print("Cant find last month's " + folder + " path")
-        return None
+        path = self.folders.find(folder, month_start(date.today(), -1 if last_month else 0), makedirs=not last_month)
+        if path is None:
+            print("Cant find last month's " + folder + " path")
+        return path
 
     @staticmethod
     def build_path(month, year, folder):
@@ -695,10 +910,11 @@ class Watcher(Thread):
         :param folder: str 'Experiments' or 'Export'
         :return: str file path '\\file01-s0\\Team121\\Genotyping\\qPCR 2019\\Experiments\\Aug 2019'
         """
+        base = os.path.join(config['File paths']['Genotyping'], 'qPCR ' + year)
         if folder == "Experiments":
-            return config['File paths']['Genotyping'] + 'qPCR ' + year + '\\Experiments\\' + month + ' ' + year
+            return os.path.join(base, 'Experiments', month + ' ' + year)
         if folder == "Export":
-            return config['File paths']['Genotyping'] + 'qPCR ' + year + '\\Results Export\\' + month + ' ' + year
+            return os.path.join(base, 'Results Export', month + ' ' + year)
 
     def start_observe(self):
         self.obs.start()
@@ -716,61 +932,145 @@ class Watcher(Thread):
         sleep(2)
         self.status()
 
-        self.obs = BaseObserver(emitter_class=MyEmitter, timeout=DEFAULT_OBSERVER_TIMEOUT)
+        self.obs = self.observer()
+        self.folders.clear()  # Folders may have been renamed.
         self.set_watch()
         self.obs.start()
         self.status()
 
 
-class MyEmitter(observers.read_directory_changes.WindowsApiEmitter):
+class Backfill(object):
     """
-    This class is used to catch an un-catchable exception in watchdog
-    that would occur when the connection to the network drive was
-    temporarily lost
-    This can still sometimes cause a crash if the program is run from
-    the network drive, but this is to do with the build method of the
-    exe. A single exe build may fix but antivirus prevents it.
-    Currently recommend installing to a local drive C:// - not U://
+    Finds the user's export files that were never processed, e.g. saved while Monitor was closed or the team drive was
+    unavailable, in the Results Export month folders. 'missed' lists them, 'backfill' exports each to its own workbook.
+    A file is done if it has a workbook of the same name, or the manifest has it as exported (Multi and ToFile
+    exports). The results store isn't used, plates are added to it before a Multi sheet is saved and by --import.
     """
-    message = deque(maxlen=2)  # This is used by thread_print to prevent duplicate messages from threads.
+    def __init__(self, watcher, user, workers=4):
+        """
+        :param watcher: Watcher, whose month folders are searched
+        :param user: str username, only files with it in their path are found
+        :param workers: int number of files exported at once
+        """
+        self.watcher = watcher
+        self.user = user.lower()
+        self.workers = workers
+        self._running = Lock()
 
-    def queue_events(self, timeout):  # Subclass queue events - this is where the exception occurs
-        try:
-            super().queue_events(timeout)
-        except OSError as e:    # Catch the exception and print error
-            self.thread_print(str(e))
-            self.thread_print('Lost connection to team drive!')
-            connected = False
-            while not connected:  # resume when connection to network drive is restored
+    @staticmethod
+    def date_range(text):
+        """
+        Reads the dates of a missed or backfill command: blank for this and last month, a number of days, or
+        'YYYY-MM-DD [YYYY-MM-DD]'. Raises ValueError if it can't be read.
+        :return: tuple of dates (since, until), inclusive
+        """
+        words, today = text.split(), date.today()
+        if not words:
+            return month_start(today, -1), today
+        if len(words) == 1 and words[0].isdigit():
+            return today - timedelta(days=int(words[0])), today
+        dates = [datetime.strptime(word, '%Y-%m-%d').date() for word in words[:2]]
+        return dates[0], dates[1] if len(dates) > 1 else today
+
+    def find(self, since, until):
+        """
+        Returns the paths of the user's unprocessed export files modified from since to until, oldest first.
+        :param since: date
+        :param until: date, inclusive
+        """
+        files = []  # List: (modified time, path)
+        month = month_start(since)
+        while month <= until:
+            folder = self.watcher.folders.find('Export', month)
+            month = month_start(month, 1)
+            if folder is None:
+                continue
+            try:
+                entries = list(os.scandir(folder))
+            except OSError as e:
+                print(Message("Can't read " + folder + ': ' + str(e)).red())
+                continue
+            for entry in entries:
+                if not entry.name.lower().endswith('.txt') or self.user not in entry.path.lower():
+                    continue
                 try:
-                    self.on_thread_start()  # need to re-set the directory handle.
-                    connected = True
-                    self.thread_print('Reconnected!')
+                    stat = entry.stat()
                 except OSError:
-                    sleep(10)
-                    self.thread_print('Reconnecting...')
+                    continue
+                if since <= date.fromtimestamp(stat.st_mtime) <= until \
+                        and not Manifest.manifest.seen((entry.path, stat.st_mtime, stat.st_size)) \
+                        and not os.path.isfile(os.path.splitext(entry.path)[0] + '.xlsx'):
+                    files.append((stat.st_mtime, entry.path))
+        return [path for modified, path in sorted(files)]
 
-    def thread_print(self, msg):
+    def missed(self, text=''):
         """
-        Prevents duplicate print statements from threads. If it has been sent recently, it is not re sent.
-        message is a deque with length 2.
+        Lists the unprocessed export files, without exporting them.
+        :param text: str dates, see date_range()
+        :return: list of paths
         """
-        if msg not in self.message:
-            print(msg)
-            self.message.append(msg)
+        try:
+            since, until = self.date_range(text)
+        except ValueError:
+            print(Message("Enter a number of days or dates, e.g. 'missed 7' or 'missed 2019-08-01 2019-08-14'").red())
+            return []
+        start = perf_counter()
+        files = self.find(since, until)
+        print(''.ljust(25, ' ') + Message('{} missed exports from {} to {}'.format(
+            len(files), since.strftime('%d.%m.%y'), until.strftime('%d.%m.%y'))).white()
+              + ' ({:.1f} s)'.format(perf_counter() - start))
+        for path in files:
+            print(''.ljust(27, ' ') + datetime.fromtimestamp(os.path.getmtime(path)).strftime('%d.%m %H:%M  ')
+                  + os.path.basename(path))
+        return files
+
+    def start(self, text=''):
+        """Lists the unprocessed export files, then exports them in the background. see missed() for text."""
+        if self._running.locked():
+            print(''.ljust(25, ' ') + 'A backfill is already running.')
+            return
+        files = self.missed(text)
+        if files:
+            Thread(target=self.run, args=(files,), daemon=True).start()
+
+    def run(self, files):
+        """Exports files on worker threads, each to its own workbook, printing progress as each finishes."""
+        with self._running:
+            try:
+                engine = export.wait()
+            except RuntimeError as e:
+                print(Message(str(e)).red())
+                return
+            start, failed = perf_counter(), 0
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                jobs = [pool.submit(engine.export_file, path) for path in files]
+                for n, job in enumerate(as_completed(jobs), 1):
+                    path, error, seconds = job.result()
+                    failed += bool(error)
+                    status = Message('Failed: ' + error).red() if error else Message('Done').green()
+                    print(''.ljust(25, ' ') + 'Backfill {}/{}  {} {}'.format(n, len(files), os.path.basename(path),
+                                                                            status))
+            print(Message(' Backfill finished: {} exported, {} failed in {:.1f} s'.format(
+                len(files) - failed, failed, perf_counter() - start)).timestamp(machine='Export'))
+
+
+def console_closed(event):
+    """
+    Console control handler. Closing the console window, logging off or shutting down end the program without running
+    atexit, so an unfinished Multi export is saved here. Returns False so the program still ends.
+    """
+    if event in (2, 5, 6):  # CTRL_CLOSE_EVENT, CTRL_LOGOFF_EVENT, CTRL_SHUTDOWN_EVENT
+        export.close()
+    return False
 
 
 if __name__ == '__main__':
     colorama_init()  # Init colorama to enable coloured text output via ANSI escape codes on windows console.
     q_lock = Lock()  # Locks used when reading or writing q_cnt or v_cnt since they are in multiple threads.
     v_lock = Lock()
-    config = configparser.ConfigParser()
-    if os.path.isfile(os.getcwd() + '/config.ini'):
-        config.read(os.getcwd() + '/config.ini')  # config.ini = ANSI
-    else:
-        config.read(os.path.normpath(os.path.dirname(argv[0]) + '/config.ini'))
+    config = Config.shared()  # Also used by Export
 
-    local = True if win32file.GetDriveType(os.getcwd().split(':')[0] + ':') == 3 else False
+    local = True if win32file is None or win32file.GetDriveType(os.getcwd().split(':')[0] + ':') == 3 else False
     if not local:
         print('You may wish to install this program to your computer to prevent possible crashes')
     else:  # if we are running locally and a startup entry exists for the remote version, we should
@@ -779,15 +1079,39 @@ if __name__ == '__main__':
                                              "Start Menu\\Programs\\Startup\\Lab Helper.cmd")):
             InputLoop.startup(silent=True)
 
-    egel_watcher = ClipboardWatcher()  # Instantiate classes
+    startup = [('Monitor imports', perf_counter() - _import_start)]  # (stage, seconds) for --profile-startup
+    start = perf_counter()
+    export = ExportLoader()  # Loads the export engine in the background
+    export.start()
+    atexit.register(export.close)  # Saves an unfinished Multi export
+    if os.name == 'nt':
+        console_handler = ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.c_uint)(console_closed)  # Kept so it isn't freed
+        ctypes.windll.kernel32.SetConsoleCtrlHandler(console_handler, True)
+
+    scheduler = Jobs.ExportScheduler(export.method('new'), workers=config.getint('Jobs', 'Workers', fallback=1),
+                                     size=config.getint('Jobs', 'Queue', fallback=20),
+                                     retries=config.getint('Jobs', 'Retries', fallback=4),
+                                     backoff=config.getfloat('Jobs', 'Backoff', fallback=2))
+    egel_watcher = ClipboardWatcher(Clipboard.provider())  # Instantiate classes
     labhandler = LabHandler()
-    export = Export.Export()
 
     watch = Watcher()
+    backfill = Backfill(watch, labhandler.user, workers=config.getint('Jobs', 'Backfill', fallback=4))
     in_loop = InputLoop()
     watch.start()  # Start threads
-    egel_watcher.start()
+    labhandler.start()
+    scheduler.start()
+    if egel_watcher.clipboard is not None:
+        egel_watcher.start()
     in_loop.start()
+    startup.append(('Watchers started', perf_counter() - start))
+
+    if '--profile-startup' in argv:
+        export.join()  # Timings are printed whether or not the engine loaded
+        print(Message('Startup profile').white())
+        for stage, seconds in startup + export.timings:
+            print('  ' + stage.ljust(20) + '{:.2f} s'.format(seconds))
+        print('  ' + 'Export engine ready'.ljust(20) + '{:.2f} s'.format(perf_counter() - start))
 
     try:
         while True:  # Check if something has changed
@@ -797,5 +1121,6 @@ if __name__ == '__main__':
                 sleep(4)
     except KeyboardInterrupt:  # on keyboard interrupt (Ctrl + C)
         watch.obs.stop()  # Stop observer + Threads (if alive)
+        export.close()
         egel_watcher.stop()
         print('\nbye!')
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+A local store of every exported plate's results, so results for a mouse, plate barcode or assay can be found without
+opening workbooks. Export adds each plate as it is exported. Existing export files can be imported:
+
+    python Results.py --import <export files or directories> --jobs N
+    python Results.py --find PMGB12.3a --since 2019-08-01
+
+The store is an SQLite database, results.sqlite in the local GenoTools folder, indexed by Mouse, Plate Barcode,
+Assay Name and run date.
+Genotype, Result and Confirmed are only stored when GenoTools calculates them, Output = values or cached in config.ini
+[Export]. Otherwise they are left for Excel's formulas and stored as NULL.
+"""
+import argparse
+import getpass
+import os
+import platform
+import sqlite3
+from datetime import datetime
+from multiprocessing import Pool
+from threading import Lock
+from time import perf_counter, strftime
+
+from colorama import init as colorama_init
+
+from Config import cache_dir
+from Message import Message
+
+COLUMNS = [  # (store column, Export samples column)
+    ('well', 'Well '), ('omitted', 'Omitted '), ('sample', 'Sample'), ('mouse', 'Mouse'), ('target', 'Target'),
+    ('reporter', 'Reporter'), ('rq', 'RQ   '), ('ct', 'Cт'), ('dct', 'ΔCт'), ('ddct', 'ΔΔCт'),
+    ('plate_barcode', 'Plate Barcode'), ('assay_type', 'Assay Type'), ('assay_name', 'Assay Name'),
+    ('het_control', 'Het Control?'), ('x_linked', 'X-Linked?'), ('omitted_endo', 'Omitted_endo'),
+    ('genotype', 'Genotype'), ('result', 'Result'), ('confirmed', 'Confirmed')]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exports (
+    id INTEGER PRIMARY KEY, file TEXT NOT NULL, path TEXT, run_date TEXT, exported TEXT, user TEXT, computer TEXT,
+    UNIQUE (file, run_date));
+CREATE TABLE IF NOT EXISTS results (
+    export_id INTEGER NOT NULL REFERENCES exports (id) ON DELETE CASCADE, run_date TEXT,
+    """ + ', '.join(column + (' TEXT COLLATE NOCASE' if column in ('mouse', 'plate_barcode', 'assay_name') else '')
+                    for column, _ in COLUMNS) + """);
+CREATE INDEX IF NOT EXISTS results_mouse ON results (mouse);
+CREATE INDEX IF NOT EXISTS results_plate ON results (plate_barcode);
+CREATE INDEX IF NOT EXISTS results_assay ON results (assay_name);
+CREATE INDEX IF NOT EXISTS results_date ON results (run_date);
+CREATE INDEX IF NOT EXISTS results_export ON results (export_id);
+"""
+
+
+def run_date(info, path=None):
+    """
+    Returns the run end time from an export file's header as 'YYYY-MM-DD HH:MM:SS', or the file's modified time if the
+    header doesn't have it.
+    :param info: Export.ExportInfo
+    :param path: export file path
+    """
+    value = info.fields.get('Experiment Run End Time', '')
+    try:  # e.g. '2019-08-14 10:24:03 AM BST', the time zone is dropped.
+        return datetime.strptime(' '.join(value.split()[:3]), '%Y-%m-%d %I:%M:%S %p').strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        pass
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
+    except (OSError, TypeError):
+        return None
+
+
+def _value(value):
+    """Converts a dataframe value for SQLite: NaN to None, numpy numbers to python numbers."""
+    if value != value:  # NaN
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ResultsStore(object):
+    """
+    The results database. Each call opens its own connection, so the store can be used from any thread, and from batch
+    worker processes one at a time.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: database file, default results.sqlite in Config.cache_dir()
+        """
+        self._path = path
+        self._ready = False
+        self._lock = Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(cache_dir(), 'results.sqlite')
+        return self._path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA foreign_keys = ON')
+        if not self._ready:
+            with self._lock:
+                connection.executescript(SCHEMA)
+                existing = {row[1] for row in connection.execute('PRAGMA table_info(results)')}
+                for column, _ in COLUMNS:  # Columns added since the store was made, e.g. genotype.
+                    if column not in existing:
+                        connection.execute('ALTER TABLE results ADD COLUMN ' + column)
+                self._ready = True
+        return connection
+
+    def add(self, info, samples, path):
+        """
+        Adds an exported plate. A plate exported again (same file name and run time) replaces the earlier results.
+        :param info: Export.ExportInfo of the export file
+        :param samples: pd.DataFrame, see Export.store_samples()
+        :param path: export file path
+        :return: int number of rows added
+        """
+        date = run_date(info, path)
+        frame = samples.reindex(columns=[column for _, column in COLUMNS])
+        rows = [[_value(value) for value in row] for row in frame.itertuples(index=False, name=None)]
+        connection = self.connect()
+        try:
+            with connection:  # One transaction
+                connection.execute('DELETE FROM exports WHERE file = ? AND run_date IS ?',
+                                   (os.path.basename(path), date))
+                export_id = connection.execute(
+                    'INSERT INTO exports (file, path, run_date, exported, user, computer) VALUES (?, ?, ?, ?, ?, ?)',
+                    (os.path.basename(path), path, date, strftime('%Y-%m-%d %H:%M:%S'), getpass.getuser(),
+                     platform.node())).lastrowid
+                connection.executemany(
+                    'INSERT INTO results (export_id, run_date, ' + ', '.join(column for column, _ in COLUMNS)
+                    + ') VALUES (' + ', '.join('?' * (len(COLUMNS) + 2)) + ')',
+                    [[export_id, date] + row for row in rows])
+        finally:
+            connection.close()
+        return len(rows)
+
+    def query(self, term, since=None, until=None, limit=500):
+        """
+        Finds results whose Mouse, Plate Barcode or Assay Name is term, ignoring case, newest run first.
+        :param term: str mouse, plate barcode or assay name
+        :param since: str 'YYYY-MM-DD', earliest run date
+        :param until: str 'YYYY-MM-DD', latest run date, inclusive
+        :param limit: max rows returned
+        :return: list of dicts: column: value, with the export file name
+        """
+        where, args = ['(r.mouse = ? OR r.plate_barcode = ? OR r.assay_name = ?)'], [term] * 3
+        if since:
+            where.append('r.run_date >= ?')
+            args.append(since)
+        if until:
+            where.append('r.run_date < ?')
+            args.append(until + ' 99')  # Any time on that day
+        connection = self.connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            rows = connection.execute(
+                'SELECT r.*, e.file FROM results r JOIN exports e ON e.id = r.export_id WHERE ' + ' AND '.join(where)
+                + ' ORDER BY r.run_date DESC, r.well LIMIT ?', args + [limit]).fetchall()
+        finally:
+            connection.close()
+        return [dict(row) for row in rows]
+
+    def print_query(self, term, since=None, until=None, limit=500):
+        """Prints the results of query() as a table."""
+        start = perf_counter()
+        rows = self.query(term.strip(), since, until, limit)
+        seconds = perf_counter() - start
+        if not rows:
+            print(''.ljust(25, ' ') + 'No results for ' + term)
+            return
+        print(Message('Results for {} ({} rows in {:.0f} ms)'.format(term, len(rows), seconds * 1000)).white())
+        print('  ' + 'Run date'.ljust(18) + 'Plate'.ljust(12) + 'Well'.rjust(5) + '  ' + 'Sample'.ljust(14)
+              + 'Target'.ljust(14) + 'Assay'.ljust(14) + 'Cт'.rjust(13) + 'RQ'.rjust(8) + '  Genotype')
+        for row in rows:
+            ct = row['ct'] if isinstance(row['ct'], str) else '' if row['ct'] is None else '{:.3f}'.format(row['ct'])
+            rq = '' if row['rq'] is None else '{:.3f}'.format(row['rq'])
+            line = ('  ' + (row['run_date'] or '')[:16].ljust(18) + str(row['plate_barcode'] or '')[:11].ljust(12)
+                    + str(row['well']).rjust(5) + '  ' + str(row['sample'])[:13].ljust(14)
+                    + str(row['target'])[:13].ljust(14) + str(row['assay_name'])[:13].ljust(14) + ct.rjust(13)
+                    + rq.rjust(8) + '  ' + str(row['genotype'] or ''))
+            print(Message(line).yellow() if row['omitted'] in (True, 1, 'true', 'True') else line)
+        if len(rows) == limit:
+            print(''.ljust(25, ' ') + 'Only the newest {} shown.'.format(limit))
+
+
+store = ResultsStore()  # The store shared by Monitor and Export.
+
+
+_import_export = None  # Export instance of an import worker process, set by _import_init()
+
+
+def _import_init():
+    """Pool initializer. Each worker loads the assay and formula files once."""
+    global _import_export
+    import Export
+    _import_export = Export.Export()
+    _import_export.headless = True
+
+
+def _import_job(inp):
+    """
+    Reads one export file in an import worker, without writing a workbook.
+    :return: tuple (file path, error message or None, ExportInfo or None, samples or None)
+    """
+    try:
+        _import_export.prepare(inp)
+    except (ValueError, OSError, KeyError) as e:
+        return inp, ' '.join(str(e).split('\n')[:2]), None, None
+    return inp, None, _import_export.info, _import_export.store_samples()
+
+
+def backfill(paths, jobs=None, results=None):
+    """
+    Imports existing export files into the store. Files are read by worker processes and added by this one.
+    :param paths: list of export files and/or directories containing them
+    :param jobs: int number of worker processes, defaults to the number of CPUs
+    :param results: ResultsStore, default the shared store
+    :return: list of (file path, error message or None)
+    """
+    import Export
+    results = results or store
+    files = Export.find_exports(paths)
+    if not files:
+        print('No export files found.')
+        return []
+    start = perf_counter()
+    done, rows = [], 0
+    if jobs == 1:
+        _import_init()
+        jobs_done = map(_import_job, files)
+    else:
+        pool = Pool(processes=jobs, initializer=_import_init)
+        jobs_done = pool.imap(_import_job, files, chunksize=1)
+    try:
+        for n, (inp, error, info, samples) in enumerate(jobs_done, 1):
+            if not error:
+                rows += results.add(info, samples, inp)
+            done.append((inp, error))
+            print('\r  {}/{} files imported'.format(n, len(files)), end='', flush=True)
+    finally:
+        if jobs != 1:
+            pool.close()
+            pool.join()
+    failed = [(inp, error) for inp, error in done if error]
+    print('\n' + Message('Import summary').white())
+    for inp, error in failed:
+        print('  ' + os.path.basename(inp).ljust(40) + ' ' + Message('Skipped: ' + error).red())
+    print('{} files ({} results) imported, {} skipped in {:.2f}s'.format(len(done) - len(failed), rows, len(failed),
+                                                                         perf_counter() - start))
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find exported results, or import existing export files.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--find', metavar='TERM', help='mouse, plate barcode or assay name')
+    group.add_argument('--import', dest='paths', nargs='+', metavar='PATH',
+                       help='export files, or directories of export files, to import')
+    parser.add_argument('--since', help='earliest run date, YYYY-MM-DD')
+    parser.add_argument('--until', help='latest run date, YYYY-MM-DD')
+    parser.add_argument('--limit', type=int, default=500, help='max results shown')
+    parser.add_argument('--jobs', type=int, default=None, help='number of import processes (default: CPU count)')
+    parser.add_argument('--db', default=None, help='database file (default: results.sqlite in the local folder)')
+    args = parser.parse_args()
+    colorama_init()  # Enables coloured text on the windows console.
+    if args.db:
+        store = ResultsStore(args.db)
+    if args.find:
+        store.print_query(args.find, args.since, args.until, args.limit)
+    else:
+        backfill(args.paths, jobs=args.jobs, results=store)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Timings for exports and notifications. Each export or event is one json line in stats.jsonl in the local GenoTools
+folder, with the time, row count and memory use after each stage. The log is rotated when it gets large.
+The Stats command prints percentiles of recent timings for each machine and stage.
+"""
+import ctypes
+import getpass
+import json
+import math
+import os
+import platform
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter, strftime
+
+from Config import cache_dir
+from Message import Message
+
+
+if os.name == 'nt':
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    ctypes.windll.psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters),
+                                                         wintypes.DWORD]
+
+    def memory():
+        """Returns (current, peak) memory use of this process in MB."""
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                                 counters.cb)
+        return counters.WorkingSetSize / 2 ** 20, counters.PeakWorkingSetSize / 2 ** 20
+else:
+    import resource
+
+    def memory():
+        """Returns (current, peak) memory use of this process in MB."""
+        try:
+            with open('/proc/self/statm') as f:
+                current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        except OSError:
+            current = None
+        return current, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # ru_maxrss is in KB on Linux
+
+
+class Stages(object):
+    """
+    The stage timings of one export or event, written to the log as one record by write().
+    Memory is the process's, so it includes anything else running at the time, e.g. another export. The peak can't be
+    reset, so each stage records how much it raised the process's peak since the last stage (or since the start), which
+    is 0 unless the stage used more memory than the process had ever used before.
+    """
+    def __init__(self, machine, file=None):
+        """
+        :param machine: str e.g. 'Export', 'Viia7' or 'Qiaxcel'
+        :param file: file path, only the name is kept
+        """
+        self.machine = machine
+        self.file = os.path.basename(file) if file else None
+        self.stages = OrderedDict()  # Dict: stage: {'s': seconds, 'rows': rows, 'mb': memory, 'peak_rise_mb': rise}
+        self.start = perf_counter()
+        self._peak = memory()[1]     # Float: the process's peak memory when the last stage finished
+
+    def add(self, stage, seconds, rows=None):
+        """Adds a stage that has just finished. Memory is measured now."""
+        current, peak = memory()
+        self.stages[stage] = {'s': round(seconds, 5), 'rows': rows,
+                              'mb': current and round(current, 1), 'peak_rise_mb': round(peak - self._peak, 1)}
+        self._peak = peak
+
+    def write(self):
+        log.write({'time': strftime('%Y-%m-%d %H:%M:%S'), 'machine': self.machine, 'file': self.file,
+                   'computer': platform.node(), 'user': getpass.getuser(),
+                   'total': round(perf_counter() - self.start, 5), 'stages': self.stages})
+
+
+class StatsLog(object):
+    """
+    An append only jsonl log, rotated to .1, .2 ... when it is bigger than max_kb. Writing is one short line per
+    export or event, so it is cheap enough to leave on.
+    """
+    def __init__(self, path=None, max_kb=1024, backups=2):
+        """
+        :param path: log file, default stats.jsonl in Config.cache_dir()
+        :param max_kb: size at which the log is rotated
+        :param backups: rotated logs kept
+        """
+        self._path = path
+        self.max_kb = max_kb
+        self.backups = backups
+        self._lock = Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(cache_dir(), 'stats.jsonl')
+        return self._path
+
+    def write(self, record):
+        """Appends a record. Failing to write is ignored, stats must never stop an export."""
+        try:
+            line = json.dumps(record, ensure_ascii=False) + '\n'
+            with self._lock:
+                if os.path.isfile(self.path) and os.path.getsize(self.path) > self.max_kb * 1024:
+                    self.rotate()
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except (OSError, TypeError, ValueError):
+            pass
+
+    def rotate(self):
+        for n in range(self.backups, 0, -1):
+            older = self.path + '.' + str(n)
+            newer = self.path + '.' + str(n - 1) if n > 1 else self.path
+            if os.path.isfile(newer):
+                os.replace(newer, older)
+
+    def read(self, last=1000):
+        """Returns the last records, oldest first, from the log and the most recent rotated log if needed."""
+        records = []
+        for path in (self.path, self.path + '.1'):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in reversed(lines):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # A line cut short, e.g. by a crash.
+                if len(records) >= last:
+                    return records[::-1]
+        return records[::-1]
+
+    def print_stats(self, last=1000):
+        """Prints percentiles of the last records' timings, for each machine and stage."""
+        records = self.read(last)
+        if not records:
+            print(''.ljust(25, ' ') + 'No stats yet.')
+            return
+        timings = OrderedDict()  # Dict: (machine, stage): ([seconds], [rows], [peak rise mb])
+        for record in records:
+            for stage, values in list(record['stages'].items()) + [('total', {'s': record['total']})]:
+                seconds, rows, peak = timings.setdefault((record['machine'], stage), ([], [], []))
+                seconds.append(values['s'])
+                if values.get('rows') is not None:
+                    rows.append(values['rows'])
+                if values.get('peak_rise_mb') is not None:  # Older records have the process's peak, peak_mb
+                    peak.append(values['peak_rise_mb'])
+        print(Message('Stats from the last {} records, since {}'.format(len(records), records[0]['time'])).white())
+        print('  ' + 'Machine'.ljust(9) + 'Stage'.ljust(16) + 'n'.rjust(5) + 'p50 ms'.rjust(10) + 'p90 ms'.rjust(10)
+              + 'p99 ms'.rjust(10) + 'rows'.rjust(7) + '+peak MB'.rjust(9))
+        for (machine, stage), (seconds, rows, peak) in sorted(timings.items(), key=lambda item: item[0][0]):
+            seconds.sort()
+            print('  ' + machine.ljust(9) + stage.ljust(16) + str(len(seconds)).rjust(5)
+                  + ''.join('{:10.1f}'.format(percentile(seconds, p) * 1000) for p in (50, 90, 99))
+                  + (str(int(percentile(sorted(rows), 50))) if rows else '').rjust(7)
+                  + ('{:.0f}'.format(max(peak)) if peak else '').rjust(9))
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+log = StatsLog()  # The log shared by Monitor and Export.
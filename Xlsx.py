@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Adds worksheets to an existing xlsx file without loading or re-saving the rest of the workbook.
+
+An xlsx file is a zip of xml parts. The new sheet is written to its own small workbook first (see Export.write_sheet),
+then its worksheet part is copied into the existing zip, and the few small manifests that list sheets and styles are
+re-written. Existing sheets, images etc. are never parsed or re-formatted, only copied across to the new zip, which is
+written next to the workbook and then replaces it, so a workbook on the team drive is never left half written.
+A sheet exported again can replace its earlier version the same way, see replace_sheets.
+New sheets are formatted by editing their xml too, from a template formatted once, see SheetTemplate.
+"""
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from io import BytesIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+WORKSHEET_REL = REL + '/worksheet'
+WORKSHEET_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+CONTENT_TYPES = '[Content_Types].xml'
+
+
+def sheet_names(xlsx_file):
+    """Returns the list of sheet names in an xlsx file, reading only the workbook part."""
+    with zipfile.ZipFile(xlsx_file) as zf:
+        return [name for name, part in _sheet_parts(zf)]
+
+
+def append_sheet(xlsx_file, sheet_xlsx, active=True):
+    """
+    Copies the first sheet of sheet_xlsx into xlsx_file as its last sheet.
+    :param xlsx_file: str path of the existing workbook
+    :param sheet_xlsx: bytes of a workbook holding the new sheet, as saved by openpyxl
+    :param active: bool if True, the workbook opens on the new sheet
+    :return: str name of the new sheet
+    """
+    return append_sheets(xlsx_file, [sheet_xlsx], active=active)[0]
+
+
+def append_sheets(xlsx_file, sheet_xlsxs, active=True):
+    """
+    Copies the first sheet of each of sheet_xlsxs into xlsx_file, after its existing sheets. The manifests are only
+    re-written once, however many sheets are added.
+    :param xlsx_file: str path of the existing workbook
+    :param sheet_xlsxs: list of bytes of workbooks holding the new sheets, as saved by openpyxl
+    :param active: bool if True, the workbook opens on the last new sheet
+    :return: list of str names of the new sheets
+    """
+    with zipfile.ZipFile(xlsx_file) as zf:
+        workbook_part = _workbook_part(zf)
+        rels_part = _rels_part(workbook_part)
+        styles_part = _related_part(zf, workbook_part, '/styles')
+        workbook = zf.read(workbook_part).decode('utf-8')
+        rels = zf.read(rels_part).decode('utf-8')
+        types = zf.read(CONTENT_TYPES).decode('utf-8')
+        styles = zf.read(styles_part).decode('utf-8')
+
+        base = posixpath.dirname(workbook_part)
+        parts = set(zf.namelist())
+        rel_ids = set(re.findall(r'\bId="([^"]+)"', rels))
+        sheet_ids = [int(i) for i in re.findall(r'<(?:\w+:)?sheet\b[^>]*?\bsheetId="(\d+)"', workbook)]
+        prefix = _prefix(workbook, 'sheets')
+        names, sheets = [], {}
+        for sheet_xlsx in sheet_xlsxs:
+            with zipfile.ZipFile(BytesIO(sheet_xlsx)) as src:
+                name, src_part = _sheet_parts(src)[0]
+                sheet = src.read(src_part).decode('utf-8')
+                src_styles = src.read(_related_part(src, _workbook_part(src), '/styles')).decode('utf-8')
+                strings = _shared_strings(src)
+            styles, xf_ids, dxf_ids = _merge_styles(src_styles, styles)
+
+            # Pick names for the new part that aren't used yet.
+            n = len(sheet_ids) + 1
+            while posixpath.join(base, 'worksheets/sheet{}.xml'.format(n)) in parts:
+                n += 1
+            part = posixpath.join(base, 'worksheets/sheet{}.xml'.format(n))
+            n = len(rel_ids) + 1
+            while 'rId{}'.format(n) in rel_ids:
+                n += 1
+            rel_id = 'rId{}'.format(n)
+            sheet_id = max(sheet_ids, default=0) + 1
+            parts.add(part)
+            rel_ids.add(rel_id)
+            sheet_ids.append(sheet_id)
+
+            # Add the sheet to the workbook, its relationships and the content types.
+            entry = '<{0}sheet xmlns:r="{1}" name="{2}" sheetId="{3}" r:id="{4}"/>'.format(
+                prefix, REL, escape(name, {'"': '&quot;'}), sheet_id, rel_id)
+            workbook = _insert_before(workbook, '</{}sheets>'.format(prefix), entry)
+            rels = _insert_before(rels, '</{}Relationships>'.format(_prefix(rels, 'Relationships')),
+                                  '<Relationship Id="{}" Type="{}" Target="{}"/>'.format(
+                                      rel_id, WORKSHEET_REL, posixpath.relpath(part, base)))
+            types = _insert_before(types, '</{}Types>'.format(_prefix(types, 'Types')),
+                                   '<Override PartName="/{}" ContentType="{}"/>'.format(part, WORKSHEET_TYPE))
+            sheets[part] = _localise_sheet(sheet, strings, xf_ids, dxf_ids)
+            names.append(name)
+
+        if active:
+            view = re.search(r'<(?:\w+:)?workbookView\b[^>]*?/?>', workbook)
+            if view:
+                tag = re.sub(r'\sactiveTab="\d+"', '', view.group())
+                tag = re.sub(r'(\s*/?>)$', r' activeTab="{}"\1'.format(len(sheet_ids) - 1), tag)  # The last sheet.
+                workbook = workbook[:view.start()] + tag + workbook[view.end():]
+
+    sheets.update({workbook_part: workbook, rels_part: rels, CONTENT_TYPES: types, styles_part: styles})
+    _rewrite(xlsx_file, sheets)
+    return names
+
+
+def replace_sheets(xlsx_file, sheet_xlsxs):
+    """
+    Replaces sheets of xlsx_file with new versions of them. Only the replaced sheets' parts and the styles are
+    re-written, the rest of the workbook is copied unchanged.
+    :param xlsx_file: str path of the existing workbook
+    :param sheet_xlsxs: dict of sheet name: bytes of a workbook holding the new version as its first sheet
+    """
+    with zipfile.ZipFile(xlsx_file) as zf:
+        styles_part = _related_part(zf, _workbook_part(zf), '/styles')
+        styles = zf.read(styles_part).decode('utf-8')
+        parts = dict(_sheet_parts(zf))
+        sheets = {}
+        for name, sheet_xlsx in sheet_xlsxs.items():
+            if not parts.get(name):
+                raise KeyError('There is no sheet {} in {}'.format(name, xlsx_file))
+            with zipfile.ZipFile(BytesIO(sheet_xlsx)) as src:
+                sheet = src.read(_sheet_parts(src)[0][1]).decode('utf-8')
+                src_styles = src.read(_related_part(src, _workbook_part(src), '/styles')).decode('utf-8')
+                strings = _shared_strings(src)
+            styles, xf_ids, dxf_ids = _merge_styles(src_styles, styles)
+            sheets[parts[name]] = _localise_sheet(sheet, strings, xf_ids, dxf_ids)
+        sheets[styles_part] = styles
+    _rewrite(xlsx_file, sheets)
+
+
+@contextmanager
+def replacing(path):
+    """
+    Opens a temporary file next to path to write to, and replaces path with it once the block finishes. If writing
+    fails, path is left as it was.
+    :param path: str path of the file to write
+    """
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            yield file
+        if os.path.exists(path):
+            shutil.copymode(path, temp)  # mkstemp makes the file private to this user.
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def set_cached_values(sheet_xlsx, values):
+    """
+    Saves the results of formulas with them, so they show without Excel recalculating. openpyxl can only write formula
+    cells with an empty result.
+    :param sheet_xlsx: bytes of a workbook as saved by openpyxl
+    :param values: dict cell: result, e.g. {'K2': 'Het', 'Q2': 0.5}. Only formula cells of the first sheet are changed.
+    :return: bytes of the workbook
+    """
+    def cell(m):
+        ref, attrs, formula = m.group(1), m.group(2), m.group(3)
+        if ref not in values:
+            return m.group()
+        value = values[ref]
+        attrs = re.sub(r'\st="\w*"', '', attrs)
+        if isinstance(value, str):
+            attrs, value = attrs + ' t="str"', escape(value)
+        elif isinstance(value, bool):
+            attrs, value = attrs + ' t="b"', int(value)
+        elif value is None or value != value:
+            value = 0  # A formula giving a blank cell shows 0.
+        return '<c r="{}"{}>{}<v>{}</v></c>'.format(ref, attrs, formula, value)
+
+    out = BytesIO()
+    with zipfile.ZipFile(BytesIO(sheet_xlsx)) as src, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+        part = _sheet_parts(src)[0][1]
+        for info in src.infolist():
+            data = src.read(info)
+            if info.filename == part:
+                data = re.sub(r'<c r="([A-Z]+\d+)"([^>]*)>(<f>.*?</f>)(?:<v\s*/>|<v></v>)?</c>', cell,
+                              data.decode('utf-8'), flags=re.S).encode('utf-8')
+            dst.writestr(info, data)
+    return out.getvalue()
+
+
+class SheetTemplate(object):
+    """
+    The formatting of a worksheet, taken once from a formatted template: its styles, column widths, conditional
+    formatting and the style of each column's header and data cells. apply() gives a sheet written without any
+    formatting the template's, by editing its xml, so cells aren't styled one by one in openpyxl.
+    """
+    def __init__(self, template_xlsx):
+        """
+        :param template_xlsx: bytes of a workbook as saved by openpyxl, whose first sheet has a header row and one data
+                              row, formatted as every sheet should be.
+        """
+        with zipfile.ZipFile(BytesIO(template_xlsx)) as zf:
+            sheet = zf.read(_sheet_parts(zf)[0][1]).decode('utf-8')
+            self.styles = zf.read(_related_part(zf, _workbook_part(zf), '/styles')).decode('utf-8')
+        cols = re.search(r'<(?:\w+:)?cols\b.*?</(?:\w+:)?cols>', sheet, re.S)
+        self.cols = cols.group() if cols else ''
+        self.conditional = ''.join(re.findall(r'<conditionalFormatting\b.*?</conditionalFormatting>', sheet, re.S))
+        self.rows = max([int(row) for row in re.findall(r'<c r="[A-Z]+(\d+)"', sheet)] + [1]) - 1  # Data rows
+        self.header, data = {}, {}  # Dict: column letter: style of its header, and of its data cells
+        for column, row, style in re.findall(r'<c r="([A-Z]+)(\d+)"[^>]*?\ss="(\d+)"', sheet):
+            if row == '1':
+                self.header[column] = style
+            else:
+                data.setdefault(style, []).append(column)
+        # One pattern for each data style, matching the cells of its columns that don't have a style of their own.
+        self.data = [(re.compile(r'<c r="((?:{})\d+)"(?![^>]*?\ss=")'.format('|'.join(columns))),
+                      r'<c r="\1" s="{}"'.format(style)) for style, columns in data.items()]
+
+    def apply(self, sheet_xlsx, rows):
+        """
+        Formats the first sheet of a workbook like the template.
+        :param sheet_xlsx: bytes of a workbook as saved by openpyxl, with a header row and no formatting but its own
+                           header and number formats
+        :param rows: int number of data rows, conditional formatting ranges are moved to match
+        :return: bytes of the workbook
+        """
+        out = BytesIO()
+        with zipfile.ZipFile(BytesIO(sheet_xlsx)) as src, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+            part = _sheet_parts(src)[0][1]
+            styles_part = _related_part(src, _workbook_part(src), '/styles')
+            styles, xf_ids, dxf_ids = _merge_styles(src.read(styles_part).decode('utf-8'), self.styles)
+            for info in src.infolist():
+                data = src.read(info)
+                if info.filename == part:
+                    data = self.format(data.decode('utf-8'), rows, xf_ids).encode('utf-8')
+                elif info.filename == styles_part:
+                    data = styles.encode('utf-8')
+                dst.writestr(info, data)
+        return out.getvalue()
+
+    def format(self, sheet, rows, xf_ids):
+        """Returns the xml of a worksheet with the template's formatting. see apply()"""
+        def header(m):
+            column, attrs = m.group(1), m.group(2)
+            style = re.search(r'\ss="(\d+)"', attrs)
+            attrs = re.sub(r'\ss="\d+"', '', attrs)
+            if column in self.header:
+                attrs = ' s="{}"'.format(self.header[column]) + attrs
+            elif style:
+                attrs = ' s="{}"'.format(xf_ids[int(style.group(1))]) + attrs
+            return '<c r="{}1"{}'.format(column, attrs)
+
+        start = sheet.index('<sheetData')
+        end = sheet.index('</row>', start) + len('</row>') if '</row>' in sheet else start
+        first = re.sub(r'<c r="([A-Z]+)1"([^>]*?)(?=/?>)', header, sheet[start:end])
+        body = sheet[end:]
+        body = re.sub(r'(<c r="[A-Z]+\d+"[^>]*?\s)s="(\d+)"',  # The sheet's own styles, e.g. date formats.
+                      lambda m: '{}s="{}"'.format(m.group(1), xf_ids[int(m.group(2))]), body)
+        for pattern, replacement in self.data:
+            body = pattern.sub(replacement, body)
+
+        def sqref(m):  # Ranges end as many rows after the template's last row as the sheet has more rows.
+            return 'sqref="{}"'.format(re.sub(r':([A-Z]+)(\d+)', lambda r: ':{}{}'.format(
+                r.group(1), int(r.group(2)) - self.rows + rows), m.group(1)))
+
+        head = re.sub(r'<(?:\w+:)?cols\b.*?</(?:\w+:)?cols>', '', sheet[:start], flags=re.S) + self.cols
+        conditional = re.sub(r'sqref="([^"]*)"', sqref, self.conditional)
+        i = body.index('</sheetData>') + len('</sheetData>')
+        return head + first + body[:i] + conditional + body[i:]
+
+
+def _workbook_part(zf):
+    """Returns the name of the workbook part, normally xl/workbook.xml."""
+    for rel in ElementTree.fromstring(zf.read('_rels/.rels')).iter('{%s}Relationship' % PACKAGE_REL):
+        if rel.get('Type').endswith('/officeDocument'):
+            return rel.get('Target').lstrip('/')
+    raise ValueError("That file doesn't look like an excel workbook.")
+
+
+def _rels_part(part):
+    """Returns the name of the relationships part of a part. e.g. xl/workbook.xml -> xl/_rels/workbook.xml.rels"""
+    return posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+
+
+def _related_parts(zf, part):
+    """Returns a dict of relationship Id: (Type, part name) for the parts that part refers to."""
+    related = {}
+    for rel in ElementTree.fromstring(zf.read(_rels_part(part))).iter('{%s}Relationship' % PACKAGE_REL):
+        target = rel.get('Target')
+        if target.startswith('/'):
+            target = target.lstrip('/')
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(part), target))
+        related[rel.get('Id')] = (rel.get('Type'), target)
+    return related
+
+
+def _related_part(zf, part, rel_type):
+    """Returns the name of the first part of rel_type that part refers to. e.g. the styles part of the workbook."""
+    for rtype, target in _related_parts(zf, part).values():
+        if rtype.endswith(rel_type):
+            return target
+    raise ValueError("That file doesn't look like an excel workbook.")
+
+
+def _sheet_parts(zf):
+    """Returns a list of (sheet name, part name) for every sheet in the workbook, in tab order."""
+    workbook_part = _workbook_part(zf)
+    related = _related_parts(zf, workbook_part)
+    sheets = ElementTree.fromstring(zf.read(workbook_part)).iter('{%s}sheet' % MAIN)
+    return [(sheet.get('name'), related.get(sheet.get('{%s}id' % REL), (None, None))[1]) for sheet in sheets]
+
+
+def _shared_strings(zf):
+    """Returns the inner xml of each shared string, which can be used as an inline string. openpyxl 3 inlines them."""
+    try:
+        sst = zf.read(_related_part(zf, _workbook_part(zf), '/sharedStrings')).decode('utf-8')
+    except (KeyError, ValueError):
+        return []
+    return [m.group(1) or '' for m in re.finditer(r'<si\b[^>]*?(?:/>|>(.*?)</si>)', sst, re.S)]
+
+
+def _prefix(xml, tag):
+    """Returns the namespace prefix used on tag, e.g. 'x:', usually ''."""
+    m = re.search(r'<(\w+:)?{}\b'.format(tag), xml)
+    if not m:
+        raise ValueError("That file doesn't look like an excel workbook.")
+    return m.group(1) or ''
+
+
+def _insert_before(xml, closing_tag, new):
+    i = xml.rindex(closing_tag)
+    return xml[:i] + new + xml[i:]
+
+
+def _rewrite(xlsx_file, parts):
+    """
+    Re-writes xlsx_file with new versions of parts (dict of name: str), see replacing(). Other entries are copied in
+    their order, and parts that aren't in the zip yet are added at the end.
+    """
+    parts = dict(parts)
+    with replacing(xlsx_file) as file:  # The old file is closed before it is replaced.
+        with zipfile.ZipFile(xlsx_file) as zf, zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as out:
+            for info in zf.infolist():
+                xml = parts.pop(info.filename, None)
+                # writestr() takes the compression of info, so each entry is stored as it was in the old file.
+                out.writestr(info, zf.read(info) if xml is None else xml.encode('utf-8'))
+            for name, xml in parts.items():
+                out.writestr(name, xml.encode('utf-8'))
+
+
+# Styles. Cells refer to styles by their position in lists in styles.xml, so the new sheet's styles are added to the
+# workbook's lists (unless an identical one is already there) and its cells are re-numbered to match.
+
+# Element order in styles.xml, collections must be added in this order if they are missing.
+STYLE_ORDER = ['numFmts', 'fonts', 'fills', 'borders', 'cellStyleXfs', 'cellXfs', 'cellStyles', 'dxfs',
+               'tableStyles', 'colors', 'extLst']
+
+
+def _items(xml, collection, item):
+    """Returns the xml of each item in a collection of styles.xml, e.g. each font in fonts."""
+    block = _block(xml, collection)
+    if not block:
+        return []
+    return re.findall(r'<{0}\b[^>]*?(?:/>|>.*?</{0}>)'.format(item), block.group(), re.S)
+
+
+def _attr(element, name):
+    return re.search(r'\b{}="([^"]*)"'.format(name), element).group(1)
+
+
+def _block(xml, collection):
+    return re.search(r'<{0}\b[^>]*?(?:/>|>.*?</{0}>)'.format(collection), xml, re.S)
+
+
+def _add_items(xml, collection, item, new):
+    """
+    Adds each item in new to collection, unless an identical one is already there.
+    :return: (str new styles xml, list of the position of each new item in the collection)
+    """
+    existing = _items(xml, collection, item)
+    ids, added = [], []
+    for element in new:
+        if element not in existing:
+            existing.append(element)
+            added.append(element)
+        ids.append(existing.index(element))
+    if not added:
+        return xml, ids
+
+    block = _block(xml, collection)
+    if not block:  # Add an empty collection in the right place.
+        following = STYLE_ORDER[STYLE_ORDER.index(collection) + 1:]
+        m = re.search(r'<(?:{})\b|</styleSheet>'.format('|'.join(following)), xml)
+        xml = xml[:m.start()] + '<{} count="0"/>'.format(collection) + xml[m.start():]
+        block = _block(xml, collection)
+    text = block.group()
+    if text.endswith('/>'):
+        text = text[:-2].rstrip() + '></{}>'.format(collection)
+    end = text.rindex('</')
+    text = text[:end] + ''.join(added) + text[end:]
+    opening = text[:text.index('>')]
+    text = re.sub(r'\bcount="\d+"', 'count="{}"'.format(len(existing)), opening, count=1) + text[len(opening):]
+    return xml[:block.start()] + text + xml[block.end():], ids
+
+
+def _merge_styles(src, styles):
+    """
+    Adds the styles used by src to styles.
+    :return: (str new styles xml, list of new cellXfs positions, list of new dxfs positions) - the lists are indexed by
+             the position in src.
+    """
+    # Custom number formats are identified by numFmtId rather than position. Ids under 164 are built in to excel.
+    fmt_ids, codes = {}, {}
+    for element in _items(styles, 'numFmts', 'numFmt'):
+        codes[_attr(element, 'formatCode')] = int(_attr(element, 'numFmtId'))
+    next_id = max(list(codes.values()) + [163]) + 1
+    for element in _items(src, 'numFmts', 'numFmt'):
+        code, src_id = _attr(element, 'formatCode'), int(_attr(element, 'numFmtId'))
+        if code not in codes:
+            codes[code] = next_id
+            next_id += 1
+            element = re.sub(r'\bnumFmtId="\d+"', 'numFmtId="{}"'.format(codes[code]), element)
+            styles, _ = _add_items(styles, 'numFmts', 'numFmt', [element])
+        fmt_ids[src_id] = codes[code]
+
+    # The first font, fill and border (and second fill) are the defaults, and are used as they are in the workbook.
+    ids = {}
+    for collection, item, defaults in [('fonts', 'font', 1), ('fills', 'fill', 2), ('borders', 'border', 1)]:
+        styles, new = _add_items(styles, collection, item, _items(src, collection, item)[defaults:])
+        ids[item + 'Id'] = list(range(defaults)) + new
+
+    def renumber(m):
+        attr, i = m.group(1), int(m.group(2))
+        return '{}="{}"'.format(attr, fmt_ids.get(i, i) if attr == 'numFmtId' else ids[attr][i])
+
+    xfs = [re.sub(r'\b(numFmtId|fontId|fillId|borderId)="(\d+)"', renumber, xf)
+           for xf in _items(src, 'cellXfs', 'xf')[1:]]
+    styles, xf_ids = _add_items(styles, 'cellXfs', 'xf', xfs)
+    styles, dxf_ids = _add_items(styles, 'dxfs', 'dxf', _items(src, 'dxfs', 'dxf'))
+    return styles, [0] + xf_ids, dxf_ids
+
+
+def _localise_sheet(sheet, strings, xf_ids, dxf_ids):
+    """Re-numbers the styles of a worksheet to match the workbook it is added to, and makes shared strings inline."""
+    def cell(m):
+        attrs, body = m.group(1), m.group(3)
+        attrs = re.sub(r'\bs="(\d+)"', lambda s: 's="{}"'.format(xf_ids[int(s.group(1))]), attrs)
+        if re.search(r'\bt="s"', attrs):
+            attrs = re.sub(r'\bt="s"', 't="inlineStr"', attrs)
+            body = '<is>' + strings[int(re.search(r'<v>(\d+)</v>', body).group(1))] + '</is>'
+        return '<c{}/>'.format(attrs) if body is None else '<c{}>{}</c>'.format(attrs, body)
+
+    sheet = re.sub(r'<c\b([^>]*?)(/>|>(.*?)</c>)', cell, sheet, flags=re.S)
+    return re.sub(r'\bdxfId="(\d+)"', lambda m: 'dxfId="{}"'.format(dxf_ids[int(m.group(1))]), sheet)
@@ -11,6 +11,7 @@ packages = ["idna", "os", "time", "datetime", "watchdog", "ctypes", "collections
 options = {
     'build_exe': {
         'packages': packages,
+        'includes': ['Export'],  # Imported in the background by Monitor.ExportLoader, so not found by cx_Freeze
         "include_msvcr": True,
         "include_files": ['config.ini', 'assays.txt', 'Formulas.xlsx'],
         'excludes': ['tkinter'],
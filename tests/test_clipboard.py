@@ -0,0 +1,68 @@
+import os
+import sys
+from time import monotonic, sleep
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Clipboard
+import Monitor
+from test_gel import gel_image, grid_screenshot
+
+
+def wait_for(condition, timeout=5):
+    end = monotonic() + timeout
+    while not condition() and monotonic() < end:
+        sleep(0.01)
+    return condition()
+
+
+def start_watcher():
+    clipboard = Clipboard.MemoryClipboard()
+    watcher = Monitor.ClipboardWatcher(clipboard)
+    watcher.start()
+    return clipboard, watcher
+
+
+def test_watcher_crops_copied_gel():
+    clipboard, watcher = start_watcher()
+    try:
+        clipboard.copy(gel_image()[0])
+        assert wait_for(lambda: clipboard.history)
+        sleep(0.1)
+        assert len(clipboard.history) == 1  # Its own output isn't taken for another copy.
+        assert clipboard.history[0][:4] == (40).to_bytes(4, 'little')  # BITMAPINFOHEADER size
+    finally:
+        watcher.stop()
+        watcher.join(5)
+    assert not watcher.is_alive()
+
+
+def test_watcher_ignores_other_images():
+    clipboard, watcher = start_watcher()
+    try:
+        clipboard.copy(grid_screenshot(1200, 800))
+        clipboard.copy(Image.new('RGB', (10, 10)))
+        clipboard.copy(None)
+        assert wait_for(lambda: clipboard._changes.empty())
+        sleep(0.1)
+        assert clipboard.history == []
+    finally:
+        watcher.stop()
+        watcher.join(5)
+
+
+def test_paused_watcher_ignores_gel():
+    clipboard, watcher = start_watcher()
+    try:
+        watcher.toggle()
+        clipboard.copy(gel_image()[0])
+        assert wait_for(lambda: clipboard._changes.empty())
+        sleep(0.1)
+        assert clipboard.history == []
+        watcher.toggle()
+        clipboard.copy(gel_image()[0])
+        assert wait_for(lambda: clipboard.history)
+    finally:
+        watcher.stop()
+        watcher.join(5)
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Formulas
+
+COLUMNS = ['Sample', 'Ct']  # Columns A and B
+
+
+def evaluate(formula, **columns):
+    frame = pd.DataFrame(columns)
+    return Formulas.Evaluator({'Out': formula}, COLUMNS + ['Out']).evaluate(frame)['Out']
+
+
+def test_if_skips_division_by_zero_not_taken():
+    out = evaluate('=IF(B{0}=0,"",1/B{0})', Sample=['a', 'b', 'c'], Ct=[0.0, 4.0, np.nan])
+    assert list(out) == ['', 0.25, '']
+
+
+def test_if_skips_text_in_arithmetic_not_taken():
+    out = evaluate('=IF(ISBLANK(A{0}),A{0}+1,"x")', Sample=['Undetermined', None], Ct=[1.0, 2.0])
+    assert list(out) == ['x', 1.0]
+
+
+def test_if_without_else_is_false():
+    out = evaluate('=IF(B{0}>1,B{0})', Sample=['a', 'b'], Ct=[2.0, 1.0])
+    assert list(out) == [2.0, False]
+
+
+def test_error_on_taken_branch_raises():
+    with pytest.raises(Formulas.FormulaError):
+        evaluate('=IF(B{0}=0,1/B{0},"")', Sample=['a'], Ct=[0.0])
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Gel
+
+
+def gel_image(width=1500, height=504):
+    """A synthetic Qiaxcel image: top border, scale with ticks, lanes with bands, marker lane and right border."""
+    edges = Gel.ratio_edges((width, height))
+    top, scale, small, right = (int(edges[edge]) for edge in ('top', 'scale', 'small', 'right'))
+    random = np.random.RandomState(0)
+    pixels = np.full((height, width), 255, np.float32)
+    pixels[:top] = 120
+    for y in range(top + 10, height, 25):
+        pixels[y:y + 2, 5:scale - 8] = 30
+    pixels[top:, scale:right] = 215
+    for x in range(scale + 3, small, 12):
+        pixels[top:, x:x + 10] = 200
+        for y in random.randint(top, height - 3, 3):
+            pixels[y:y + 2, x:x + 10] = 40
+    pixels[top:, small:right] = 235
+    pixels[:, right:] = 90
+    return Image.fromarray(pixels.astype(np.uint8)).convert('RGB'), (top, scale, small, right)
+
+
+def grid_screenshot(width, height, cell=(64, 20)):
+    """A white spreadsheet-like screenshot with grey grid lines and a 1 pixel border."""
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for x in range(0, width, cell[0]):
+        draw.line([(x, 0), (x, height)], fill=(210, 210, 210))
+    for y in range(0, height, cell[1]):
+        draw.line([(0, y), (width, y)], fill=(210, 210, 210))
+    draw.rectangle([0, 0, width - 1, height - 1], outline=(0, 0, 0))
+    return image
+
+
+def test_gel_edges_detected():
+    image, truth = gel_image()
+    boxes, confidence = Gel.detect(image)
+    assert Gel.is_gel(image)
+    assert confidence == 1
+    found = (boxes['scale'][1], boxes['scale'][2], boxes['small'][2], boxes['standard'][2])
+    assert all(abs(got - want) <= 2 for got, want in zip(found, truth))
+
+
+@pytest.mark.parametrize('size', [(1200, 800), (1000, 700), (1366, 768), (900, 600), (1920, 1080)])
+def test_screenshot_is_not_gel(size):
+    assert not Gel.is_gel(grid_screenshot(*size))
+
+
+def test_partial_detection_uses_ratios():
+    image, truth = gel_image()
+    ImageDraw.Draw(image).rectangle((0, 0, image.size[0], 60), fill=(0, 0, 0))
+    boxes, confidence = Gel.detect(image)
+    assert confidence < 1
+    assert boxes == Gel.edge_boxes(Gel.ratio_edges(image.size), image.size)